@@ -4,47 +4,226 @@
 import pandas as pd
 import numpy as np
 from pathlib import Path
-import matplotlib.pyplot as plt
 
-from countryinfo import CountryInfo
+import batch
+import instrument
+import storage
+from databases import JhuData, date_labels
+from population import (country_population, county_population, lookup,
+                        state_population)
 
-import plots
-from databases import JhuData
-plt.style.use('seaborn')
+
+
+class Panel:
+    """ Cumulative metrics of many entities on one shared date index.
+
+    Values stay in the arrays they came from (a JHU table, a shared memory
+    block, ...); each metric has the row position of every entity in its
+    array. Rolling daily averages and case fatality are computed for all
+    entities of the panel at once, on first use, and memoized.
+
+    Arguments:
+        dates: DatetimeIndex of the value columns
+        values: Mapping of metric name to entity x date array
+        rows: Mapping of metric name to the row of each entity in its array
+            (all rows in order if a metric is missing)
+        window: Rolling average window in days
+    """
+
+    def __init__(self, dates, values, rows=None, window=7):
+        self.dates = pd.DatetimeIndex(dates)
+        self.values = dict(values)
+        self.rows = {metric: np.asarray(rows[metric]) if rows and metric in rows
+                     else np.arange(len(array))
+                     for metric, array in self.values.items()}
+        self.window = window
+        self._derived = {}
+
+
+    def __len__(self):
+        return len(next(iter(self.rows.values()), []))
+
+
+    def row(self, metric, position):
+        """ Values of one entity, a view into the source array."""
+        return self.values[metric][self.rows[metric][position]]
+
+
+    def _matrix(self, metric):
+        return self.values[metric][self.rows[metric]]
+
+
+    def per_day(self, metric):
+        """ Rolling average of daily differences of every entity."""
+        key = ('per_day', metric)
+        if key not in self._derived:
+            self._derived[key] = batch.per_day(self._matrix(metric), self.window)
+        return self._derived[key]
+
+
+    def case_fatality(self):
+        """ Case fatality of every entity and date."""
+        if 'case_fatality' not in self._derived:
+            self._derived['case_fatality'] = batch.case_fatality(self._matrix('fatalities'),
+                                                                 self._matrix('cases'))
+        return self._derived['case_fatality']
+
+
+    def take(self, positions):
+        """ Panel of the entities at positions only, with copied values."""
+        return Panel(self.dates, {metric: self._matrix(metric)[positions]
+                                  for metric in self.values},
+                     window=self.window)
+
+
+
+class _Derived:
+    """ Per-entity attribute computed from the panel on first access and
+    memoized. Assigning a value overrides it."""
+
+    def __init__(self, metric, kind):
+        self.metric = metric
+        self.kind = kind
+
+
+    def __get__(self, entity, owner=None):
+        if entity is None:
+            return self
+        key = (self.metric, self.kind)
+        if key not in entity._cache:
+            entity._cache[key] = entity._derive(self.metric, self.kind)
+        return entity._cache[key]
+
+
+    def __set__(self, entity, value):
+        entity._cache[(self.metric, self.kind)] = value
+
+
+
+def _add_metric_attributes(cls):
+    """ Define the lazy per-metric attributes of a Container class."""
+    for metric in cls.metrics:
+        for attrname, kind in [('{}_series', 'series'), ('total_{}', 'total'),
+                               ('{}_per_day', 'per_day'), ('{}_per_capita', 'per_capita')]:
+            attrname = attrname.format(metric)
+            if attrname not in cls.__dict__:
+                setattr(cls, attrname, _Derived(metric, kind))
 
 
 
 class Container():
+    """ Time series of one entity. For every name in metrics, the attributes
+    {metric}_series (cumulative), total_{metric} (latest value),
+    {metric}_per_day (rolling average of daily values) and
+    {metric}_per_capita (per day per million residents) are derived lazily
+    from a Panel shared with the other entities built alongside it.
+    """
+
+    __slots__ = ('name', 'window', 'population', '_panel', '_position', '_cache')
+    metrics = ('cases', 'fatalities')
+
     def __init__(self, name, window=7):
         self.name = name
         self.window = window
+        self.population = np.nan
+        self._panel = None
+        self._position = 0
+        self._cache = {}
+
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        _add_metric_attributes(cls)
+
+
+    def __getstate__(self):
+        # Pickle only this entity's rows, not the whole shared panel
+        state = {slot: getattr(self, slot) for slot in Container.__slots__
+                 if slot not in ('_panel', '_position', '_cache')}
+        state['_panel'] = self._panel.take([self._position]) if self._panel is not None else None
+        return state
+
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+        self._position = 0
+        self._cache = {}
+
+
+    def _attach(self, panel, position):
+        self._panel = panel
+        self._position = position
+        self._cache = {}
+
+
+    def _derive(self, metric, kind):
+        panel = self._panel
+        if kind == 'series':
+            return pd.Series(panel.row(metric, self._position), index=panel.dates,
+                             name=self.name, copy=False)
+        if kind == 'total':
+            return panel.row(metric, self._position)[-1]
+        if kind == 'per_day':
+            return pd.Series(panel.per_day(metric)[self._position], index=panel.dates,
+                             name=self.name, copy=False)
+        if kind == 'per_capita':
+            return batch.normalize(getattr(self, '{}_per_day'.format(metric)),
+                                   self.population)
+        if kind == 'case_fatality':
+            return pd.Series(panel.case_fatality()[self._position], index=panel.dates,
+                             name=self.name, copy=False)
+        raise AttributeError(kind)
+
+
+    @classmethod
+    def _from_panel(cls, names, window, panel):
+        ''' Build one object per name, attached to consecutive rows of a
+        panel. Returns dict of name to object.
+        '''
+        entities = {}
+        for position, name in enumerate(names):
+            entity = cls.__new__(cls)
+            Container.__init__(entity, name, window)
+            entity._attach(panel, position)
+            entities[name] = entity
+        return entities
+
+
+    @property
+    def case_fatality_series(self):
+        if 'case_fatality' not in self._cache:
+            self._cache['case_fatality'] = self._derive('fatalities', 'case_fatality')
+        return self._cache['case_fatality']
+
+
+    @property
+    def case_fatality(self):
+        return self.case_fatality_series.iloc[-1]
 
 
-    def _load(self, data):
-        series = data.loc[self.name]
-        series.index = pd.to_datetime(series.index)
-        return series
+    @property
+    def first_record(self):
+        return self._panel.dates[0]
 
 
-    def _record(self, series, attrname):
-        setattr(self, '{}_series'.format(attrname), series)
-        setattr(self, 'total_{}'.format(attrname), series.iloc[-1])
-        setattr(self, '{}_per_day'.format(attrname), diff(series, self.window))
+    @property
+    def last_record(self):
+        return self._panel.dates[-1]
 
 
     def get_params(self):
         self.calculate_fatality_rate()
-        self.first_record, self.last_record = self.cases_series.index[[0, -1]]
 
 
     def calculate_fatality_rate(self):
         """ Calculate case fatality as a function of confirmed cases
         and fatality time series data."""
-        self.case_fatality_series = self.fatalities_series.divide(self.cases_series)
-        self.case_fatality = self.case_fatality_series.iloc[-1]
+        self._cache.pop('case_fatality', None)
+        return self.case_fatality
 
 
-    def dailycaseplot(self, per_capita=False, gca=None, label=None):
+    def dailycaseplot(self, per_capita=False, gca=None, label=None, downsample=None):
         ''' Summary plot of confirmed cases per day. Plots bar plot of raw data
         behind a rolling average. Rolling average window and date range
         of data during class instantiation.
@@ -53,6 +232,8 @@ class Container():
             per_capita: Plot data per 100k residents
             gca: Existing matplotlib axes to plot two (optional)
             label: Custom label for data legend. Uses name attribute by default
+            downsample: Reduce long series to the axes width with 'lttb' or
+                'minmax' (optional)
         '''
         if label is None:
             label = self.name
@@ -60,11 +241,13 @@ class Container():
         rolling_average = self.cases_per_day
         ylabel = 'Cases per Day'
 
-        plotter = plots.DailyPlotter(gca, label, ylabel)
+        # Plotting is imported on first use to keep analytics headless
+        import plots
+        plotter = plots.DailyPlotter(gca, label, ylabel, downsample)
         plotter.summary_plot(data, rolling_average, per_capita, self.population)
 
 
-    def dailyfatalityplot(self, per_capita=False, gca=None, label=None):
+    def dailyfatalityplot(self, per_capita=False, gca=None, label=None, downsample=None):
         ''' Summary plot of COVID-19 deaths per day. Plots bar plot of raw data
         behind a rolling average. Rolling average window and date range
         of data during class instantiation.
@@ -73,6 +256,8 @@ class Container():
             per_capita: Plot data per 100k residents
             gca: Existing matplotlib axes to plot two (optional)
             label: Custom label for data legend. Uses name attribute by default
+            downsample: Reduce long series to the axes width with 'lttb' or
+                'minmax' (optional)
         '''
         if label is None:
             label = self.name
@@ -80,11 +265,12 @@ class Container():
         rolling_average = self.fatalities_per_day
         ylabel = 'Fatalities per Day'
 
-        plotter = plots.DailyPlotter(gca, label, ylabel)
+        import plots
+        plotter = plots.DailyPlotter(gca, label, ylabel, downsample)
         plotter.summary_plot(data, rolling_average, per_capita, self.population)
 
 
-    def dailyhospitalizationplot(self, per_capita=False, gca=None, label=None):
+    def dailyhospitalizationplot(self, per_capita=False, gca=None, label=None, downsample=None):
         ''' Summary plot of daily VOVID-19 hospitalizations. Plots bar plot of
         raw data behind a rolling average. Rolling average window and date range
         of data during class instantiation.
@@ -93,6 +279,8 @@ class Container():
             per_capita: Plot data per 100k residents
             gca: Existing matplotlib axes to plot two (optional)
             label: Custom label for data legend. Uses name attribute by default
+            downsample: Reduce long series to the axes width with 'lttb' or
+                'minmax' (optional)
         '''
         if label is None:
             label = self.name
@@ -100,44 +288,137 @@ class Container():
         rolling_average = self.hospitalizations_per_day
         ylabel = 'Hospitalizations per Day'
 
-        plotter = plots.DailyPlotter(gca, label, ylabel)
+        import plots
+        plotter = plots.DailyPlotter(gca, label, ylabel, downsample)
         plotter.summary_plot(data, rolling_average, per_capita, self.population)
 
 
 
+
+_add_metric_attributes(Container)
+
+
+
 class Country(Container):
 
+    __slots__ = ()
+
+    @instrument.traced
     def __init__(self, name, window=7):
         # TODO: Allow custom label for country name (i.e. abbreviations) - put it in as plot label
         # TODO: Need to allow for different time windows
         super().__init__(name, window)
 
         all_data = JhuData()
-        self._record(self._load(all_data.global_cases()), 'cases')
-        self._record(self._load(all_data.global_fatalities()), 'fatalities')
+        self._attach(self._panel_for([name], window, all_data), 0)
+        self.population = country_population(self.name)
+
+
+    @staticmethod
+    def _panel_for(names, window, all_data):
+        frames = {'cases': all_data.global_cases(), 'fatalities': all_data.global_fatalities()}
+        rows = {}
+        for metric, frame in frames.items():
+            rows[metric] = frame.index.get_indexer(names)
+            if (rows[metric] < 0).any():
+                raise KeyError([name for name, row in zip(names, rows[metric]) if row < 0])
+        dates = list(date_labels(frames['cases'].columns).values())
+        return Panel(dates, {metric: frame.to_numpy() for metric, frame in frames.items()},
+                     rows, window)
+
 
-        self.population = CountryInfo(self.name).population()
-        self.get_params()
+    @classmethod
+    @instrument.traced
+    def many(cls, names, window=7):
+        ''' Build a Country for every entry in names from a single load of
+        the JHU global time series.'''
+        names = list(names)
+        unique_names = list(dict.fromkeys(names))
+        panel = cls._panel_for(unique_names, window, JhuData())
+
+        entities = cls._from_panel(unique_names, window, panel)
+        population = country_population(unique_names)
+        for entity in entities.values():
+            entity.population = population[entity.name]
+        return [entities[name] for name in names]
 
 
 
 class State(Container):
 
+    __slots__ = ()
+    _metrics = {'cases': 'total_cases',
+                'fatalities': 'total_deaths',
+                'hospitalizations': 'total_hospitalizations',
+                'fully_vaccinated': 'series_complete_yes',
+                'partial_plus_vaccinated': 'administered_dose1_recip'}
+    metrics = tuple(_metrics)
+
+    @instrument.traced
     def __init__(self, name, window=7):
         super().__init__(name, window)
 
         self.record_data()
-        #TODO: Clean up exception handling
-        try:
-            self.population = JhuData().us_population(groupby='state').loc[self.name]
-        except:
-            self.population = np.nan
-        self.get_params()
+        self.population = state_population(self.name)
+
+
+    @classmethod
+    @instrument.traced
+    def many(cls, names, window=7, data=None):
+        ''' Build a State for every entry in names from a single read of the
+        combined US database, or from data (e.g. a shared.SharedDataset).'''
+        names = list(names)
+        unique_names = list(dict.fromkeys(names))
+        all_data = cls._read_combined(states=unique_names, data=data)
+        panel = cls._panel_for(unique_names, window, all_data)
+
+        entities = cls._from_panel(unique_names, window, panel)
+        population = state_population(unique_names)
+        for entity in entities.values():
+            entity.population = population[entity.name]
+        return [entities[name] for name in names]
+
+
+    @classmethod
+    def _panel_for(cls, names, window, all_data):
+        """ Panel of every metric from combined data indexed by state and
+        date, unstacked once into a state x metric x date block."""
+        columns = list(cls._metrics.values())
+        wide = all_data[columns].unstack('date')
+        wide = wide.reindex(names)
+        if wide.isna().all(axis=1).any():
+            raise KeyError([name for name in names if name not in all_data.index.levels[0]])
+        dates = wide.columns.get_level_values('date')[:wide.shape[1]//len(columns)]
+        block = wide.to_numpy(dtype=float).reshape(len(names), len(columns), len(dates))
+        instrument.count('frames_copied')
+        return Panel(pd.to_datetime(dates),
+                     {metric: block[:, ii] for ii, metric in enumerate(cls._metrics)},
+                     window=window)
+
+
+    @staticmethod
+    def _read_combined(states=None, data=None):
+        if data is not None:
+            all_data = data.combined()
+            if states is not None:
+                all_data = all_data[all_data['state'].isin(states)]
+            return all_data.set_index(['state', 'date'])
+        if storage.current_store() is not None:
+            all_data = storage.read_combined(states=states)
+            return all_data.set_index(['state', 'date'])
 
+        #TODO: Needs capability to load from database module directly without csv dependency
+        url = Path('https://raw.githubusercontent.com/lucascarter0')
+        url = url.joinpath('covid19-analytics/master/us_combined_covid_data.csv')
+        all_data = pd.read_csv(url)
+        return all_data.set_index(['state', 'date'])
 
+
+    @instrument.traced
     def record_data(self):
-        ''' Load raw data from combined covid data in Github repo
-        or in local repo.
+        ''' Load raw data from the most recent local store of the combined
+        covid data (see storage.read_combined), otherwise from the Github
+        repo.
 
         Attributes that are recorded:
             positive cases
@@ -146,77 +427,111 @@ class State(Container):
             percentage of population fully vaccinated
             percentage of population receiving at least partial dose
         '''
-
-        #TODO: Needs capability to load from database module directly without csv dependency
-        try:
-            url = Path('https://raw.githubusercontent.com/lucascarter0')
-            url = url.joinpath('covid19-analytics/master/us_combined_covid_data.csv')
-            all_data = pd.read_csv(url)
-        except:
-            all_data = pd.read_csv('us_combined_covid_data.csv')
-        all_data = all_data.set_index(['state', 'date'])
-
-        self._record(self._load(all_data['total_cases']),
-                     attrname='cases')
-        self._record(self._load(all_data['total_deaths']),
-                     attrname='fatalities')
-        self._record(self._load(all_data['total_hospitalizations']),
-                     attrname='hospitalizations')
-        self._record(self._load(all_data['series_complete_yes']),
-                     attrname='fully_vaccinated')
-        self._record(self._load(all_data['administered_dose1_recip']),
-                     attrname='partial_plus_vaccinated')
+        all_data = self._read_combined(states=[self.name])
+        self._attach(self._panel_for([self.name], self.window, all_data), 0)
 
 
 
 class County(Container):
 
-    def __init__(self, name, window=7):
-        super().__init__(name, window)
-
-        all_data = JhuData()
-        data = all_data.us_cases()
-
-        self._record(self.__load(data), 'cases')
-
-        data = self.getpopulation(all_data.us_fatalities(groupby='county'))
-        self._record(self.__load(data), 'fatalities')
-
-        self.get_params()
-
+    __slots__ = ('_metadata',)
 
-    def __load(self, data):
-        series = data.loc[self.name]
-        for index in series.index:
-            try:
-                pd.to_datetime(index)
-            except:
-                setattr(self, index.lower(), series[index])
-                series = series.drop(index, axis=0)
-        series.index = pd.to_datetime(series.index)
-        return series
-
-
-    def getpopulation(self, data):
-        if 'Population' in data.columns:
-            self.population = data.loc[self.name, 'Population']
-            data = data.drop('Population', axis=1)
-        return data
+    @instrument.traced
+    def __init__(self, name, window=7, data=None):
+        super().__init__(name, window)
 
+        all_data = data if data is not None else JhuData()
+        cases = all_data.us_county_table('cases')
+        fatalities = all_data.us_county_table('fatalities')
+        self.name = cases.name(name)
+        self._attach(self._panel_for([self.name], window, cases, fatalities), 0)
+        self.__load(cases)
+        self.__population(fatalities)
 
 
-def normalize(series, population, per=1000000):
-    """ Return series as a proportion of population.
+    def __getattr__(self, name):
+        # County metadata (fips, state, latitude, ...) as attributes
+        try:
+            metadata = object.__getattribute__(self, '_metadata')
+        except AttributeError:
+            metadata = {}
+        if name in metadata:
+            return metadata[name]
+        raise AttributeError(name)
+
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['_metadata'] = self._metadata
+        return state
+
+
+    @staticmethod
+    def _panel_for(names, window, cases, fatalities):
+        """ Panel over rows of the county tables, without copying values."""
+        fatality_values = fatalities.values
+        if not fatalities.dates.equals(cases.dates):
+            fatality_values = fatalities.frame().reindex(columns=cases.dates).to_numpy()
+        return Panel(cases.dates, {'cases': cases.values, 'fatalities': fatality_values},
+                     {'cases': [cases.locate(name) for name in names],
+                      'fatalities': [fatalities.locate(name) for name in names]},
+                     window)
+
+
+    @classmethod
+    @instrument.traced
+    def many(cls, names, window=7, data=None):
+        ''' Build a County for every entry in names ("County, State" or FIPS
+        code) from a single load of the JHU US time series, or from data
+        (e.g. a shared.SharedDataset).'''
+        all_data = data if data is not None else JhuData()
+        cases = all_data.us_county_table('cases')
+        fatalities = all_data.us_county_table('fatalities')
+        names = [cases.name(name) for name in names]
+        unique_names = list(dict.fromkeys(names))
+        panel = cls._panel_for(unique_names, window, cases, fatalities)
+
+        entities = cls._from_panel(unique_names, window, panel)
+        positions = [cases.locate(name) for name in unique_names]
+        records = cases.metadata.iloc[positions].to_dict('records')
+        for entity, record in zip(entities.values(), records):
+            entity._metadata = {label.lower(): value for label, value in record.items()}
+            entity.__population(fatalities)
+        return [entities[name] for name in names]
+
+
+    def __load(self, table):
+        self._metadata = {label.lower(): value
+                          for label, value in table.record(self.name).items()}
+
+
+    def __population(self, fatalities):
+        """ Census population by FIPS code, falling back to the population
+        column of the JHU fatalities data for areas without a census entry."""
+        self.population = county_population(getattr(self, 'fips', np.nan))
+        if np.isnan(self.population) and fatalities.population is not None:
+            self.population = fatalities.population.iloc[fatalities.locate(self.name)]
+
+
+
+@instrument.traced
+def normalize(series, population=None, per=1000000):
+    """ Return series as a proportion of population. If population is not
+    given it is looked up from the series name, or from the row labels of an
+    entity x date dataframe, through the population module.
 
     Example:
         Fatalities per million residents.
         normalize(State.cases_per_day, per=1000000)
     """
-    return series.divide(population).apply(lambda x: x*per)
+    if population is None:
+        population = lookup(series.index if series.ndim == 2 else series.name)
+    return batch.normalize(series, population, per)
 
 
+@instrument.traced
 def diff(series, window):
     """ Daily difference of cumulative data. Series is returned as rolling
     average with smoothing window defined by window argument.
     """
-    return series.diff().rolling(window=window).mean()
+    return batch.per_day(series, window)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Whole-matrix analytics over wide time series frames.
+
+Functions take the entity x date frames returned by JhuData (or any 2-D
+array-like, or a single Series) and compute daily differences, rolling
+averages, per-capita scaling, case fatality, growth rates, doubling times
+and reproduction numbers for every row at once with NumPy. Set axis=0 for
+frames laid out date x entity.
+"""
+import math
+
+import numpy as np
+import pandas as pd
+
+
+
+# Fewest new cases in a window for growth and Rt estimates; below this the
+# ratios are noise and Rt only repeats its prior (Cori et al. suggest 12)
+MIN_CASES = 12
+
+
+
+def _values(data, axis=1):
+    """ Return data as a float array with dates along the last axis."""
+    values = np.asarray(data, dtype=float)
+    if values.ndim == 1:
+        return values[np.newaxis, :]
+    return values.T if axis == 0 else values
+
+
+
+def _wrap(values, like, axis=1):
+    """ Return values in the same container and orientation as like."""
+    if np.ndim(like) == 1:
+        values = values[0]
+        if isinstance(like, pd.Series):
+            return pd.Series(values, index=like.index, name=like.name)
+        return values
+    if axis == 0:
+        values = values.T
+    if isinstance(like, pd.DataFrame):
+        return pd.DataFrame(values, index=like.index, columns=like.columns)
+    return values
+
+
+
+def _daily_delta(values):
+    delta = np.empty_like(values)
+    delta[:, 0] = np.nan
+    np.subtract(values[:, 1:], values[:, :-1], out=delta[:, 1:])
+    return delta
+
+
+
+def _rolling_mean(values, window):
+    """ Trailing mean over window columns from cumulative sums, O(N) in the
+    number of values whatever the window. Like pandas rolling().mean(), a
+    window containing NaN gives NaN."""
+    result = np.full(values.shape, np.nan)
+    if window < 1 or window > values.shape[1]:
+        return result
+
+    missing = np.isnan(values)
+    padding = np.zeros((values.shape[0], 1))
+    totals = np.concatenate([padding, np.cumsum(np.where(missing, 0., values), axis=1)], axis=1)
+    gaps = np.concatenate([padding, np.cumsum(missing, axis=1)], axis=1)
+
+    means = (totals[:, window:] - totals[:, :-window])/window
+    means[gaps[:, window:] - gaps[:, :-window] > 0] = np.nan
+    result[:, window - 1:] = means
+    return result
+
+
+
+def daily_delta(data, axis=1):
+    """ Daily difference of cumulative data for every row."""
+    return _wrap(_daily_delta(_values(data, axis)), data, axis)
+
+
+
+def rolling_mean(data, window, axis=1):
+    """ Trailing rolling average with smoothing window for every row."""
+    return _wrap(_rolling_mean(_values(data, axis), window), data, axis)
+
+
+
+def per_day(data, window, axis=1):
+    """ Rolling average of daily differences of cumulative data, the
+    *_per_day series of Container objects."""
+    return _wrap(_rolling_mean(_daily_delta(_values(data, axis)), window), data, axis)
+
+
+
+def normalize(data, population, per=1000000, axis=1):
+    """ Scale every row by per/population. population is a scalar or one
+    value per row; a Series is aligned to the rows of a DataFrame."""
+    if isinstance(population, pd.Series) and isinstance(data, pd.DataFrame):
+        population = population.reindex(data.columns if axis == 0 else data.index)
+    population = np.asarray(population, dtype=float).reshape(-1, 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = _values(data, axis)/population*per
+    return _wrap(values, data, axis)
+
+
+
+def case_fatality(fatalities, cases, axis=1):
+    """ Ratio of fatalities to confirmed cases for every row and date.
+    pandas inputs are aligned on both axes first."""
+    if isinstance(fatalities, (pd.Series, pd.DataFrame)) and \
+            isinstance(cases, (pd.Series, pd.DataFrame)):
+        fatalities, cases = fatalities.align(cases)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = _values(fatalities, axis)/_values(cases, axis)
+    return _wrap(values, fatalities, axis)
+
+
+
+def summarize(cases, fatalities, window=7, population=None, per=1000000, axis=1):
+    """ Compute the derived series of every entity in one call. Returns dict
+    of frames shaped like the inputs: cases_per_day, fatalities_per_day and
+    case_fatality, plus the per-capita rates of the first two when population
+    is given."""
+    summary = {'cases_per_day': per_day(cases, window, axis),
+               'fatalities_per_day': per_day(fatalities, window, axis),
+               'case_fatality': case_fatality(fatalities, cases, axis)}
+    if population is not None:
+        for name in ['cases_per_day', 'fatalities_per_day']:
+            summary[name + '_per_capita'] = normalize(summary[name], population,
+                                                      per, axis)
+    return summary
+
+
+
+def serial_interval(mean=4.7, sd=2.9, days=21):
+    """ Discretized gamma serial interval distribution. Returns weights of
+    lags 1 to days (summing to one), the pdf evaluated at each day's
+    midpoint."""
+    shape = (mean/sd)**2
+    scale = sd**2/mean
+    midpoints = np.arange(1, days + 1) - 0.5
+    log_pdf = (shape - 1)*np.log(midpoints) - midpoints/scale \
+        - math.lgamma(shape) - shape*math.log(scale)
+    weights = np.exp(log_pdf)
+    return weights/weights.sum()
+
+
+
+def _incidence(values, smoothing):
+    """ Daily new counts of cumulative values, negative corrections
+    clipped to zero, as a trailing rolling mean over smoothing days."""
+    daily = _daily_delta(values)
+    daily[daily < 0] = 0.
+    if smoothing > 1:
+        daily = _rolling_mean(daily, smoothing)
+    return daily
+
+
+
+def _growth_rate(incidence, window, min_cases):
+    rate = np.full(incidence.shape, np.nan)
+    if window < 1 or window >= incidence.shape[1]:
+        return rate
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logs = np.log(incidence)
+        rate[:, window:] = (logs[:, window:] - logs[:, :-window])/window
+    # Ratios of a handful of cases, or of none, say nothing about growth
+    few = ~(_rolling_mean(incidence, window)*window >= min_cases)
+    rate[:, window:][few[:, window:] | few[:, :-window]] = np.nan
+    rate[~np.isfinite(rate)] = np.nan
+    return rate
+
+
+
+def _doubling_time(rate):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(rate > 0, math.log(2)/rate, np.nan)
+
+
+
+def _reproduction_number(incidence, weights, window, prior, min_cases):
+    """ Cori et al. posterior mean of Rt over trailing windows: new cases
+    divided by the infectiousness of earlier cases weighted by the serial
+    interval, with a gamma(shape, scale) prior. NaN where the window has
+    fewer than min_cases new cases or infectiousness, as the estimate would
+    then only repeat the prior."""
+    known = np.nan_to_num(incidence)
+    infectiousness = np.zeros(incidence.shape)
+    for lag, weight in enumerate(weights[:incidence.shape[1] - 1], 1):
+        infectiousness[:, lag:] += weight*known[:, :-lag]
+
+    shape, scale = prior
+    cases = _rolling_mean(incidence, window)*window
+    pressure = _rolling_mean(infectiousness, window)*window
+    rt = (shape + cases)/(1/scale + pressure)
+    rt[~((cases >= min_cases) & (pressure >= min_cases))] = np.nan
+    # Not enough history before one full serial interval
+    rt[:, :min(len(weights), rt.shape[1])] = np.nan
+    return rt
+
+
+
+def growth_rate(cases, window=7, smoothing=7, axis=1, min_cases=MIN_CASES):
+    """ Exponential growth rate per day of smoothed daily cases over the
+    trailing window, from cumulative cases of every row. NaN where either
+    window compared has fewer than min_cases new cases."""
+    incidence = _incidence(_values(cases, axis), smoothing)
+    return _wrap(_growth_rate(incidence, window, min_cases), cases, axis)
+
+
+
+def doubling_time(cases, window=7, smoothing=7, axis=1, min_cases=MIN_CASES):
+    """ Days for smoothed daily cases to double at the current growth rate,
+    NaN where cases are not growing or too few to tell."""
+    rate = _growth_rate(_incidence(_values(cases, axis), smoothing), window, min_cases)
+    return _wrap(_doubling_time(rate), cases, axis)
+
+
+
+def reproduction_number(cases, window=7, smoothing=7, si_mean=4.7, si_sd=2.9,
+                        prior=(1., 5.), axis=1, min_cases=MIN_CASES):
+    """ Effective reproduction number Rt of every row from cumulative cases,
+    estimated over trailing windows with a gamma serial interval of mean
+    si_mean and standard deviation si_sd days. NaN (unknown) where a window
+    has fewer than min_cases new cases or infectiousness."""
+    incidence = _incidence(_values(cases, axis), smoothing)
+    rt = _reproduction_number(incidence, serial_interval(si_mean, si_sd), window,
+                              prior, min_cases)
+    return _wrap(rt, cases, axis)
+
+
+
+def transmission(cases, window=7, smoothing=7, si_mean=4.7, si_sd=2.9,
+                 prior=(1., 5.), axis=1, min_cases=MIN_CASES):
+    """ Growth rate, doubling time and Rt of every row in one pass over
+    cumulative cases, sharing the smoothed daily incidence. Returns dict of
+    frames shaped like cases: growth_rate, doubling_time and rt."""
+    incidence = _incidence(_values(cases, axis), smoothing)
+    rate = _growth_rate(incidence, window, min_cases)
+    rt = _reproduction_number(incidence, serial_interval(si_mean, si_sd), window,
+                              prior, min_cases)
+    return {'growth_rate': _wrap(rate, cases, axis),
+            'doubling_time': _wrap(_doubling_time(rate), cases, axis),
+            'rt': _wrap(rt, cases, axis)}
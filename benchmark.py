@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark harness for the loading, combining and plotting stages.
+
+Synthetic fixtures with the JHU time series and HealthData.gov schemas are
+generated at configurable sizes and seeded into an offline download cache,
+so every stage runs against the real code paths without network access.
+Each stage is timed (best of several repeats) and its peak traced memory is
+measured in a separate run. Results are appended to a JSON file together
+with the current git commit, and compared against the previous run of the
+same size to flag regressions.
+
+Usage:
+    python benchmark.py --counties 3300 --days 365 1100 3000
+"""
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import batch
+import cache
+import databases
+import utils
+
+
+
+RESULTS_PATH = 'benchmark_results.json'
+REPO_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+STATES = [state for state in utils.us_state_abbrev]
+
+
+
+def _date_label(day):
+    return '{}/{}/{:%y}'.format(day.month, day.day, day)
+
+
+
+def jhu_us_fixture(counties, days, deaths=False, seed=0):
+    """ CSV bytes shaped like time_series_covid19_{confirmed,deaths}_US.csv."""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2020-01-22', periods=days)
+    states = [STATES[ii % len(STATES)] for ii in range(counties)]
+    names = ['County {}'.format(ii) for ii in range(counties)]
+    fips = [1000*(STATES.index(state) + 1) + ii for ii, state in enumerate(states)]
+
+    metadata = pd.DataFrame({'UID': [84000000 + code for code in fips],
+                             'iso2': 'US',
+                             'iso3': 'USA',
+                             'code3': 840,
+                             'FIPS': np.array(fips, dtype=float),
+                             'Admin2': names,
+                             'Province_State': states,
+                             'Country_Region': 'US',
+                             'Lat': rng.uniform(25, 49, counties),
+                             'Long_': rng.uniform(-125, -67, counties),
+                             'Combined_Key': ['{}, {}, US'.format(name, state)
+                                              for name, state in zip(names, states)]})
+    if deaths:
+        metadata['Population'] = rng.integers(1000, 1000000, counties)
+
+    daily = rng.poisson(5 if deaths else 150, size=(counties, days))
+    counts = pd.DataFrame(np.cumsum(daily, axis=1),
+                          columns=[_date_label(day) for day in dates])
+    return pd.concat([metadata, counts], axis=1).to_csv(index=False).encode()
+
+
+
+def jhu_global_fixture(days, countries=200, deaths=False, seed=0):
+    """ CSV bytes shaped like time_series_covid19_{confirmed,deaths}_global.csv."""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2020-01-22', periods=days)
+    metadata = pd.DataFrame({'Province/State': np.nan,
+                             'Country/Region': ['Country {}'.format(ii) for ii in range(countries)],
+                             'Lat': rng.uniform(-60, 70, countries),
+                             'Long': rng.uniform(-180, 180, countries)})
+    daily = rng.poisson(50 if deaths else 2000, size=(countries, days))
+    counts = pd.DataFrame(np.cumsum(daily, axis=1),
+                          columns=[_date_label(day) for day in dates])
+    return pd.concat([metadata, counts], axis=1).to_csv(index=False).encode()
+
+
+
+def healthgov_fixtures(days, seed=0):
+    """ JSON bytes shaped like the HealthData.gov hospitalization and CDC
+    vaccination endpoints, one row per state and day."""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2020-01-22', periods=days).strftime('%Y-%m-%dT00:00:00.000')
+    abbrevs = [utils.us_state_abbrev[state] for state in STATES]
+    date_column = np.repeat(dates, len(abbrevs))
+    state_column = np.tile(abbrevs, days)
+    rows = len(date_column)
+
+    hospital = pd.DataFrame({'date': date_column,
+                             'state': state_column,
+                             'previous_day_admission_adult_covid_confirmed': rng.poisson(40, rows),
+                             'previous_day_admission_pediatric_covid_confirmed': rng.poisson(3, rows),
+                             'adult_icu_bed_covid_utilization_numerator': rng.poisson(200, rows),
+                             'adult_icu_bed_covid_utilization_denominator': rng.poisson(900, rows) + 1})
+    vaccine = pd.DataFrame({'date': date_column,
+                            'location': state_column,
+                            'series_complete_yes': rng.integers(0, 10000000, rows),
+                            'administered_dose1_recip': rng.integers(0, 12000000, rows)})
+    return (hospital.to_json(orient='records').encode(),
+            vaccine.to_json(orient='records').encode())
+
+
+
+def seed_cache(directory, counties, days):
+    """ Point the shared download cache at directory, offline, and store
+    fixtures under the URLs JhuData requests. Returns dict of raw fixtures.
+    The caller restores the previous shared cache when done, as run does."""
+    download_cache = cache.configure(directory=directory, offline=True, max_bytes=None)
+    jhu = databases.JhuData()
+    fixtures = {'cases': jhu_us_fixture(counties, days),
+                'fatalities': jhu_us_fixture(counties, days, deaths=True, seed=1),
+                'global_cases': jhu_global_fixture(days),
+                'global_fatalities': jhu_global_fixture(days, deaths=True, seed=1)}
+    fixtures['hospital'], fixtures['vaccine'] = healthgov_fixtures(days)
+
+    download_cache.put(jhu._us_url('cases'), fixtures['cases'])
+    download_cache.put(jhu._us_url('fatalities'), fixtures['fatalities'])
+    timeseries = jhu._timeseries_baseurl
+    download_cache.put(timeseries + '/time_series_covid19_confirmed_global.csv',
+                       fixtures['global_cases'])
+    download_cache.put(timeseries + '/time_series_covid19_deaths_global.csv',
+                       fixtures['global_fatalities'])
+    return fixtures
+
+
+
+def stages(fixtures, counties):
+    """ Benchmarked stages as name to (setup, function of setup result)."""
+    jhu = databases.JhuData()
+    county_names = ['County {}, {}'.format(ii, STATES[ii % len(STATES)])
+                    for ii in range(counties)]
+
+    def parsed_healthgov():
+        hospital = databases.HealthGovData._parse(io.BytesIO(fixtures['hospital']))
+        vaccine = databases.HealthGovData._parse(io.BytesIO(fixtures['vaccine']))
+        return (hospital.set_index('date').sort_index(),
+                vaccine.set_index('date').sort_index())
+
+    def combine_inputs():
+        hospital, vaccine = parsed_healthgov()
+        hospital = databases.summarize_hospitalizations(hospital)
+        hospital['state'] = hospital['state'].map(utils.us_state_abbrev_inverse)
+        vaccine['state'] = vaccine['location'].map(utils.us_state_abbrev_inverse)
+        vaccine = vaccine.drop('location', axis=1)
+        return (hospital, vaccine,
+                jhu.us_cases(groupby='state'), jhu.us_fatalities(groupby='state'))
+
+    def plot_compare(entities):
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        import plots
+        plots.plot_compare(entities, 'cases')
+        plt.close('all')
+
+    import analytics
+    return {
+        'jhu_parse_us_county': (lambda: io.BytesIO(fixtures['cases']),
+                                lambda buffer: jhu._parse_us(buffer, 'county')),
+        'jhu_parse_us_state': (lambda: io.BytesIO(fixtures['cases']),
+                               lambda buffer: jhu._parse_us(buffer, 'state')),
+        'jhu_parse_global': (lambda: io.BytesIO(fixtures['global_cases']),
+                             jhu._parse_global),
+        'healthgov_parse': (lambda: None, lambda _: parsed_healthgov()),
+        'summarize_hospitalizations': (lambda: parsed_healthgov()[0],
+                                       databases.summarize_hospitalizations),
+        'combine_databases': (combine_inputs,
+                              lambda inputs: databases.combine_databases(*inputs)),
+        'transmission': (lambda: jhu.us_county_table('cases').frame(), batch.transmission),
+        'county_construct': (lambda: county_names[len(county_names)//2],
+                             analytics.County),
+        'county_many': (lambda: county_names, analytics.County.many),
+        'plot_compare': (lambda: analytics.County.many(county_names[:10]),
+                         plot_compare),
+    }
+
+
+
+def measure(setup, func, repeat=3):
+    """ Best wall time over repeat runs, and peak traced memory of one run."""
+    timings = []
+    for _ in range(repeat):
+        argument = setup()
+        gc.collect()
+        start = time.perf_counter()
+        func(argument)
+        timings.append(time.perf_counter() - start)
+
+    argument = setup()
+    gc.collect()
+    tracemalloc.start()
+    func(argument)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': min(timings), 'peak_mb': peak/1024**2}
+
+
+
+def import_times(modules=('databases', 'analytics', 'plots'), repeat=3):
+    """ Best wall time to import each module in a fresh interpreter,
+    started in the repository whatever the working directory."""
+    pythonpath = os.pathsep.join([REPO_DIRECTORY] + [path for path in
+                                  [os.environ.get('PYTHONPATH')] if path])
+    env = dict(os.environ, MPLBACKEND='Agg', PYTHONPATH=pythonpath)
+    times = {}
+    for module in modules:
+        statement = ('import time; start = time.perf_counter(); import {}; '
+                     'print(time.perf_counter() - start)').format(module)
+        timings = []
+        for _ in range(repeat):
+            output = subprocess.check_output([sys.executable, '-c', statement],
+                                             cwd=REPO_DIRECTORY, env=env)
+            timings.append(float(output.decode().split()[-1]))
+        times[module] = min(timings)
+    return times
+
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=REPO_DIRECTORY, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+
+def run(counties=3300, days=365, repeat=3, only=None, checkpoint=None):
+    """ Run every stage (or those named in only) at one fixture size and
+    return the result record. checkpoint(record) is called after each stage
+    with the results so far, so they survive a later failure."""
+    record = {'commit': git_commit(),
+              'timestamp': datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(),
+              'pandas': pd.__version__,
+              'counties': counties,
+              'days': days,
+              'stages': {},
+              'imports': {}}
+    results = record['stages']
+    previous = cache.get_cache()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            fixtures = seed_cache(directory, counties, days)
+            for name, (setup, func) in stages(fixtures, counties).items():
+                if only and name not in only:
+                    continue
+                results[name] = measure(setup, func, repeat)
+                print('{:<28} {:>9.3f} s {:>10.1f} MB'.format(
+                    name, results[name]['seconds'], results[name]['peak_mb']))
+                if checkpoint is not None:
+                    checkpoint(record)
+    finally:
+        # The seeded cache is offline and its directory is gone
+        cache._default_cache = previous
+
+    if not only or 'import' in only:
+        record['imports'] = import_times()
+        for module, seconds in record['imports'].items():
+            print('{:<28} {:>9.3f} s'.format('import ' + module, seconds))
+        if checkpoint is not None:
+            checkpoint(record)
+
+    return record
+
+
+
+def save_history(history, path):
+    """ Write history to path, replacing the file in one rename."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fid:
+        json.dump(history, fid, indent=2)
+    os.replace(tmp_path, path)
+
+
+
+def compare(record, history, threshold=1.2):
+    """ Print stages at least threshold times slower than in the last run of
+    history with the same fixture size."""
+    previous = [entry for entry in history
+                if entry['counties'] == record['counties'] and entry['days'] == record['days']]
+    if not previous:
+        return
+    previous = previous[-1]
+    for name, result in record['stages'].items():
+        if name in previous['stages']:
+            ratio = result['seconds']/previous['stages'][name]['seconds']
+            if ratio >= threshold:
+                print('Regression in {}: {:.2f}x slower than {}'.format(
+                    name, ratio, previous['commit']))
+    for module, seconds in record.get('imports', {}).items():
+        if module in previous.get('imports', {}):
+            ratio = seconds/previous['imports'][module]
+            if ratio >= threshold:
+                print('Regression in import {}: {:.2f}x slower than {}'.format(
+                    module, ratio, previous['commit']))
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--counties', type=int, default=3300)
+    parser.add_argument('--days', type=int, nargs='+', default=[365])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stage', action='append', dest='only',
+                        help='Only run the named stage (repeatable), '
+                             '"import" for import times')
+    parser.add_argument('--output', default=RESULTS_PATH)
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='Slowdown ratio reported as a regression')
+    args = parser.parse_args()
+
+    try:
+        with open(args.output) as fid:
+            history = json.load(fid)
+    except (OSError, ValueError):
+        history = []
+
+    for days in args.days:
+        print('{} counties x {} days'.format(args.counties, days))
+        checkpoint = lambda record: save_history(history + [record], args.output)
+        record = run(args.counties, days, args.repeat, args.only, checkpoint)
+        compare(record, history, args.threshold)
+        history.append(record)
+        save_history(history, args.output)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk download cache shared by the JHU and HealthData.gov loaders.
+
+Raw response bytes and the frames parsed from them are stored under a cache
+directory, keyed by URL. Entries younger than the TTL are served without any
+network traffic; older entries are revalidated with ETag/If-Modified-Since
+headers so unchanged files are not downloaded again. The directory is kept
+under a size cap by evicting least recently used entries.
+
+Every file is written to a uniquely named temporary file and renamed into
+place, so threads and processes sharing the directory never see a partial
+file. Cache hits only update the modification time of the entry's metadata
+file, which is what the LRU eviction orders by.
+"""
+import hashlib
+import io
+import json
+import os
+import pickle
+import tempfile
+import time
+from email.utils import formatdate
+from pathlib import Path
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+import instrument
+
+
+
+DEFAULT_DIRECTORY = Path(os.environ.get('COVID19_CACHE_DIR',
+                                        Path.home().joinpath('.cache', 'covid19-analytics')))
+DEFAULT_TTL = 6*60*60
+DEFAULT_MAX_BYTES = 2*1024**3
+# Part of every parsed-frame key. Loaders pass their own parser version so
+# frames pickled by an older parser are never served to newer code.
+FRAME_VERSION = 1
+
+
+
+class DownloadCache:
+    """ URL-keyed cache of raw downloads and parsed frames.
+
+    Arguments:
+        directory: Cache directory (created on first write)
+        ttl: Seconds an entry is served without revalidation
+        max_bytes: Size cap of the cache directory, enforced by LRU eviction
+        offline: Never touch the network, serve whatever is cached
+        timeout: Socket timeout for downloads in seconds
+    """
+
+    def __init__(self, directory=None, ttl=DEFAULT_TTL,
+                 max_bytes=DEFAULT_MAX_BYTES, offline=False, timeout=60):
+        self.directory = Path(directory) if directory is not None else DEFAULT_DIRECTORY
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.timeout = timeout
+        # Bytes in the directory at the last scan plus those written since,
+        # so eviction only scans the directory once over max_bytes
+        self._size = None
+
+
+    def _key(self, url):
+        return hashlib.sha1(str(url).encode('utf-8')).hexdigest()
+
+
+    def _paths(self, url):
+        key = self._key(url)
+        return (self.directory.joinpath(key + '.raw'),
+                self.directory.joinpath(key + '.json'))
+
+
+    def _read_meta(self, meta_path):
+        try:
+            with open(meta_path) as fid:
+                return json.load(fid)
+        except (OSError, ValueError):
+            return None
+
+
+    def _write(self, path, write):
+        """ Write path with write(binary file) through a uniquely named
+        temporary file, replaced into place in one rename."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(prefix=path.name + '.', suffix='.tmp',
+                                        dir=str(self.directory))
+        try:
+            with os.fdopen(fd, 'wb') as fid:
+                write(fid)
+            size = os.path.getsize(tmp_name)
+            try:
+                size -= path.stat().st_size
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_name, path)
+        except BaseException:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+            raise
+        if self._size is not None:
+            self._size += size
+
+
+    def _write_meta(self, meta_path, meta):
+        self._write(meta_path, lambda fid: fid.write(json.dumps(meta).encode('utf-8')))
+
+
+    def _touch(self, meta_path):
+        """ Mark an entry as used now for LRU eviction."""
+        try:
+            os.utime(meta_path)
+        except FileNotFoundError:
+            # Evicted by another process meanwhile
+            pass
+
+
+    def _refresh(self, url):
+        """ Bring the cached copy of url up to date, downloading only when
+        it is missing, expired and changed upstream. Returns (metadata,
+        downloaded bytes or None if the cached file is current)."""
+        raw_path, meta_path = self._paths(url)
+        meta = self._read_meta(meta_path)
+        cached = meta is not None and raw_path.exists()
+
+        if cached and (self.offline or time.time() - meta['fetched'] < self.ttl):
+            self._touch(meta_path)
+            instrument.count('cache_hits')
+            return meta, None
+        if self.offline:
+            raise ConnectionError('{} is not cached and cache is offline'.format(url))
+
+        request = Request(url)
+        if cached:
+            if meta.get('etag'):
+                request.add_header('If-None-Match', meta['etag'])
+            if meta.get('last_modified'):
+                request.add_header('If-Modified-Since', meta['last_modified'])
+
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                content = response.read()
+                headers = response.headers
+        except HTTPError as error:
+            if error.code == 304 and cached:
+                instrument.count('cache_revalidations')
+                meta['fetched'] = time.time()
+                self._write_meta(meta_path, meta)
+                return meta, None
+            raise
+        except URLError:
+            # Serve a stale copy rather than failing when upstream is down
+            if cached:
+                return meta, None
+            raise
+
+        instrument.count('bytes_downloaded', len(content))
+        return self._store(url, content, headers.get('ETag'),
+                           headers.get('Last-Modified')), content
+
+
+    def _content(self, url, content):
+        """ content if downloaded, otherwise the cached bytes of url."""
+        if content is not None:
+            return content
+        try:
+            return self._paths(url)[0].read_bytes()
+        except FileNotFoundError:
+            # Evicted by another process since it was validated
+            content = self._refresh(url)[1]
+            return content if content is not None else self._paths(url)[0].read_bytes()
+
+
+    @instrument.traced
+    def fetch(self, url):
+        """ Return raw bytes for url, downloading only when the cached copy
+        is missing, expired and changed upstream."""
+        url = str(url)
+        return self._content(url, self._refresh(url)[1])
+
+
+    def put(self, url, content):
+        """ Store content as the download of url, e.g. to seed the cache
+        from a local mirror before working offline."""
+        self._store(str(url), content)
+        return content
+
+
+    def _store(self, url, content, etag=None, last_modified=None):
+        raw_path, meta_path = self._paths(url)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        digest = hashlib.sha1(content).hexdigest()
+        old_meta = self._read_meta(meta_path)
+        if old_meta is not None and old_meta.get('digest') != digest:
+            self._drop_frames(url)
+
+        self._write(raw_path, lambda fid: fid.write(content))
+        now = time.time()
+        meta = {'url': url,
+                'etag': etag,
+                'last_modified': last_modified or formatdate(now, usegmt=True),
+                'digest': digest,
+                'fetched': now}
+        self._write_meta(meta_path, meta)
+        self.evict()
+        return meta
+
+
+    def frame(self, url, parser, key='', version=FRAME_VERSION):
+        """ Return parser(file-like of raw bytes) for url. The parsed result
+        is pickled alongside the raw download and reused for as long as the
+        raw bytes are unchanged. key distinguishes different parsers applied
+        to the same url, version different revisions of the same parser."""
+        url = str(url)
+        meta, content = self._refresh(url)
+        data = self._load_pickle(self._frame_path(url, key, meta.get('digest'), version))
+        if data is None:
+            # Keyed by the bytes actually parsed, whatever another writer did
+            content = self._content(url, content)
+            data = parser(io.BytesIO(content))
+            self._dump_pickle(self._frame_path(url, key, hashlib.sha1(content).hexdigest(),
+                                               version), data)
+        return data
+
+
+    def incremental_frame(self, url, parser, updater, key='', version=FRAME_VERSION):
+        """ Like frame, but when the raw download has changed the last frame
+        materialized for url, key and version is brought up to date with
+        updater(previous, file-like of raw bytes) instead of parsing the
+        whole download again with parser."""
+        url = str(url)
+        meta, content = self._refresh(url)
+        data = self._load_pickle(self._frame_path(url, key, meta.get('digest'), version))
+        if data is not None:
+            return data
+
+        content = self._content(url, content)
+        frame_path = self._frame_path(url, key, hashlib.sha1(content).hexdigest(), version)
+        last_path = self.directory.joinpath('{}-{}.last'.format(
+            self._key(url), self._parser_key(key, version)))
+        previous = self._load_pickle(last_path)
+        if previous is None:
+            data = parser(io.BytesIO(content))
+        else:
+            data = updater(previous, io.BytesIO(content))
+        self._dump_pickle(frame_path, data)
+        self._dump_pickle(last_path, data)
+        return data
+
+
+    def load_object(self, name):
+        """ Return data saved with save_object under name, or None. Used
+        for results built from many downloads, such as consolidated panels."""
+        meta_path = self._paths(name)[1]
+        data = self._load_pickle(self.directory.joinpath(self._key(name) + '-object.pkl'))
+        if data is not None:
+            self._touch(meta_path)
+        return data
+
+
+    def save_object(self, name, data):
+        """ Pickle data under name, subject to the same LRU eviction as
+        downloads."""
+        self._write_meta(self._paths(name)[1], {'url': name, 'fetched': time.time()})
+        self._dump_pickle(self.directory.joinpath(self._key(name) + '-object.pkl'), data)
+
+
+    def _parser_key(self, key, version):
+        return self._key('{}:{}'.format(key, version))[:12]
+
+
+    def _frame_path(self, url, key, digest, version=FRAME_VERSION):
+        if digest is None:
+            return None
+        return self.directory.joinpath('{}-{}-{}.pkl'.format(
+            self._key(url), self._parser_key(key, version), digest[:12]))
+
+
+    def _load_pickle(self, path):
+        if path is None or not path.exists():
+            return None
+        try:
+            with open(path, 'rb') as fid:
+                return pickle.load(fid)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+
+    def _dump_pickle(self, path, data):
+        if not self.directory.exists():
+            return
+        self._write(path, lambda fid: pickle.dump(data, fid, protocol=pickle.HIGHEST_PROTOCOL))
+        self.evict()
+
+
+    def _drop_frames(self, url):
+        for path in self.directory.glob(self._key(url) + '-*.pkl'):
+            self._remove(path)
+
+
+    def _remove(self, path):
+        try:
+            size = path.stat().st_size
+            path.unlink()
+        except FileNotFoundError:
+            return
+        if self._size is not None:
+            self._size -= size
+
+
+    def _entries(self):
+        """ Group cache files by url key with last access time (modification
+        time of the metadata file) and size. Writes in progress are left
+        out."""
+        entries = {}
+        for path in self.directory.glob('*'):
+            if path.suffix == '.tmp':
+                continue
+            key = path.name.split('.')[0].split('-')[0]
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # Replaced or evicted by another thread while listing
+                continue
+            entry = entries.setdefault(key, {'files': [], 'size': 0, 'accessed': 0})
+            entry['files'].append(path)
+            entry['size'] += stat.st_size
+            if path.suffix == '.json':
+                entry['accessed'] = stat.st_mtime
+        return entries
+
+
+    def size(self):
+        """ Total size of cache directory in bytes."""
+        if not self.directory.exists():
+            return 0
+        return sum(entry['size'] for entry in self._entries().values())
+
+
+    def evict(self):
+        """ Remove least recently used entries until the cache fits
+        within max_bytes. The directory is only scanned once the bytes
+        known to this cache exceed max_bytes; the scan also counts what
+        other processes sharing the directory wrote."""
+        if self.max_bytes is None or not self.directory.exists():
+            return
+        if self._size is not None and self._size <= self.max_bytes:
+            return
+        entries = self._entries()
+        total = sum(entry['size'] for entry in entries.values())
+        for entry in sorted(entries.values(), key=lambda x: x['accessed']):
+            if total <= self.max_bytes:
+                break
+            for path in entry['files']:
+                path.unlink(missing_ok=True)
+            total -= entry['size']
+        self._size = total
+
+
+    def clear(self):
+        """ Remove every cached entry."""
+        if self.directory.exists():
+            for path in self.directory.glob('*'):
+                path.unlink(missing_ok=True)
+        self._size = None
+
+
+
+_default_cache = DownloadCache()
+
+
+
+def get_cache():
+    """ Cache shared by every loader that is not given one explicitly."""
+    return _default_cache
+
+
+
+def configure(**kwargs):
+    """ Replace the shared cache. Accepts the DownloadCache arguments, e.g.
+    configure(ttl=0) to always revalidate or configure(offline=True)."""
+    global _default_cache
+    _default_cache = DownloadCache(**kwargs)
+    return _default_cache
@@ -2,12 +2,31 @@
 # -*- coding: utf-8 -*-
 """
 """
-from datetime import date
+import io
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial, reduce
+from pathlib import Path
 from posixpath import join
+from urllib.error import HTTPError, URLError
 
+import numpy as np
 import pandas as pd
 
+import cache
+import instrument
+import storage
 import utils
+from pipeline import Pipeline
+
+
+
+# Bump whenever a parser's output changes so frames cached by the old
+# parser are parsed again
+PARSER_VERSION = 1
 
 
 
@@ -16,37 +35,129 @@ class HealthGovData:
     __hospital_baseurl = 'https://healthdata.gov/resource/g62h-syeh.json'
     __vaccine_baseurl = 'https://data.cdc.gov/resource/unsk-b7fc.json'
 
-
-    def __init__(self):
-        days_of_pandemic = (date.today() - date(2020, 1, 1)).days
-        self._parse_limit = len(utils.us_state_abbrev)*days_of_pandemic
+    # Columns used downstream, the frame of an endpoint without rows
+    __hospital_columns = {'date': 'datetime64[ns]', 'state': object,
+                          'previous_day_admission_adult_covid_confirmed': float,
+                          'previous_day_admission_pediatric_covid_confirmed': float,
+                          'adult_icu_bed_covid_utilization_numerator': float,
+                          'adult_icu_bed_covid_utilization_denominator': float}
+    __vaccine_columns = {'date': 'datetime64[ns]', 'location': object,
+                         'series_complete_yes': float,
+                         'administered_dose1_recip': float}
+
+
+    def __init__(self, download_cache=None, hospital_url=None, vaccine_url=None,
+                 compact=False, float32=False, page_size=10000, workers=4,
+                 retries=3, retry_delay=1.):
+        self.page_size = page_size
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._cache = download_cache if download_cache is not None else cache.get_cache()
+        self._hospital_baseurl = hospital_url or self.__hospital_baseurl
+        self._vaccine_baseurl = vaccine_url or self.__vaccine_baseurl
+        self.compact = compact
+        self.float32 = float32
         print('Initializing Healthcare.gov database')
 
 
-    def _load(self, url):
-        df = pd.read_json(url)
-        df.date = pd.to_datetime(df.date)
+    def _load(self, baseurl, columns):
+        ''' Download every row of a Socrata endpoint in $offset/$limit pages
+        across a pool of workers. Each page is parsed as it arrives and kept
+        in the download cache, so an interrupted run restarted within the
+        cache TTL only fetches the pages that did not complete. An endpoint
+        without rows gives an empty frame of columns (mapping of column name
+        to dtype).'''
+        count = self._row_count(baseurl)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            if count is not None:
+                pages = range(math.ceil(count/self.page_size))
+                frames = list(pool.map(self._load_page, self._page_urls(baseurl, pages)))
+            else:
+                # Row count unavailable: fetch a page per worker at a time
+                # until a page comes back short
+                frames, batch = [], []
+                while all(len(df) == self.page_size for df in batch):
+                    pages = range(len(frames), len(frames) + self.workers)
+                    batch = list(pool.map(self._load_page, self._page_urls(baseurl, pages)))
+                    frames += batch
+
+        frames = [df for df in frames if len(df)]
+        if not frames:
+            empty = pd.DataFrame({column: pd.Series(dtype=dtype)
+                                  for column, dtype in columns.items()})
+            return empty.set_index('date')
+        df = pd.concat(frames, ignore_index=True)
         df = df.set_index('date').sort_index()
         return df
 
 
-    def load_hosptializations(self):
-        hospital_url = '{}?$limit={}'.format(self.__hospital_baseurl, self._parse_limit)
+    def _page_urls(self, baseurl, pages):
+        return ['{}?$order=:id&$limit={}&$offset={}'.format(baseurl, self.page_size,
+                                                            page*self.page_size)
+                for page in pages]
+
 
-        df = self._load(hospital_url)
+    def _row_count(self, baseurl):
+        """ Number of rows of endpoint, None if the count query fails."""
+        url = '{}?$select=count(*)'.format(baseurl)
+        try:
+            content = self._retry(self._cache.fetch, url)
+            return int(next(iter(json.loads(content)[0].values())))
+        except (OSError, ValueError, IndexError, StopIteration):
+            return None
+
+
+    def _load_page(self, url):
+        return self._retry(self._cache.frame, url, self._parse, key='healthgov',
+                           version=PARSER_VERSION)
+
+
+    def _retry(self, func, *args, **kwargs):
+        """ Call func, retrying with exponential backoff on network and
+        server errors."""
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except (URLError, OSError) as error:
+                client_error = isinstance(error, HTTPError) and error.code < 500
+                if client_error or self._cache.offline or attempt == self.retries:
+                    raise
+                time.sleep(self.retry_delay*2**attempt)
+
+
+    @staticmethod
+    def _parse(buffer):
+        with instrument.span('read_json'):
+            df = pd.read_json(buffer)
+        instrument.count('rows_parsed', df.shape[0])
+        instrument.count('columns_parsed', df.shape[1])
+        if len(df):
+            df.date = pd.to_datetime(df.date)
+        return df
+
+
+    @instrument.traced
+    def load_hosptializations(self):
+        df = self._load(self._hospital_baseurl, self.__hospital_columns)
         df = summarize_hospitalizations(df)
         df['state'] = df['state'].map(utils.us_state_abbrev_inverse)
-        return df
+        return self._compact(df)
 
 
+    @instrument.traced
     def load_vaccinations(self):
         """ Load US vaccination data through HealthData.gov API. """
-        vaccine_url = '{}?$limit={}'.format(self.__vaccine_baseurl, self._parse_limit)
-
-        df = self._load(vaccine_url)
+        df = self._load(self._vaccine_baseurl, self.__vaccine_columns)
         df['state'] = df['location'].map(utils.us_state_abbrev_inverse)
         df = df.drop('location', axis=1)
-        return df
+        return self._compact(df)
+
+
+    def _compact(self, df):
+        if not self.compact:
+            return df
+        return compact_frame(df, float32=self.float32, report=True)
 
 
 
@@ -61,31 +172,73 @@ class JhuData():
     __global_column_drop = ['Lat', 'Long', 'Province/State']
     __state_column_drop = ['UID', 'code3', 'FIPS', 'Latitude', 'Longitude']
 
-    def __init__(self):
+    def __init__(self, download_cache=None, baseurl=None,
+                 incremental=False, revision_window=7, compact=False):
 
-        self.__baseurl = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data'
+        self.__baseurl = baseurl or 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data'
+        self._cache = download_cache if download_cache is not None else cache.get_cache()
+        self.incremental = incremental
+        self.revision_window = revision_window
+        self.compact = compact
         self._timeseries_baseurl = join(self.__baseurl,
                                         'csse_covid_19_time_series')
         self._daily_report_baseurl = join(self.__baseurl,
                                           'csse_covid_19_daily_reports_us')
 
 
-    def _load_global_url(self, url):
-        data = pd.read_csv(url, index_col=1)
+    def _load_global_url(self, url, start=None, end=None):
+        key = 'global-{}-{}'.format(start, end)
+        parser = lambda buffer: self._parse_global(buffer, start, end)
+        return self._compact(self._cache.frame(url, parser, key=key,
+                                               version=PARSER_VERSION))
+
+
+    def _compact(self, data):
+        if not self.compact:
+            return data
+        return compact_frame(data, report=True)
+
+
+    def _parse_global(self, buffer, start=None, end=None):
+        with instrument.span('read_csv'):
+            data = pd.read_csv(buffer, index_col=1,
+                               usecols=window_columns(buffer, start, end))
+        instrument.count('rows_parsed', data.shape[0])
+        instrument.count('columns_parsed', data.shape[1])
         data = data.drop(self.__global_column_drop, axis=1)
-        data = data.groupby('Country/Region').sum()
+        with instrument.span('groupby', by='Country/Region'):
+            data = data.groupby('Country/Region').sum()
 
         return data
 
 
-    def _load_us_url(self, url, groupby='county', drop=None):
-        data = pd.read_csv(url, index_col=1)
+    def _load_us_url(self, url, groupby='county', drop=None, start=None, end=None):
+        key = 'us-{}-{}-{}-{}'.format(groupby.lower(), drop, start, end)
+        parser = lambda buffer: self._parse_us(buffer, groupby, drop, start, end)
+        if self.incremental:
+            updater = lambda previous, buffer: self._update_us(previous, buffer,
+                                                               groupby, drop,
+                                                               start, end)
+            data = self._cache.incremental_frame(url, parser, updater, key=key,
+                                                 version=PARSER_VERSION)
+        else:
+            data = self._cache.frame(url, parser, key=key, version=PARSER_VERSION)
+        return self._compact(data)
+
+
+    def _parse_us(self, buffer, groupby='county', drop=None, start=None, end=None):
+        with instrument.span('read_csv'):
+            data = pd.read_csv(buffer, index_col=1,
+                               usecols=window_columns(buffer, start, end))
+        instrument.count('rows_parsed', data.shape[0])
+        instrument.count('columns_parsed', data.shape[1])
         data = data.rename(columns=self.__column_rename)
 
         data = data.set_index(county_state_index(data))
 
         if groupby.lower() == 'state':
-            data = data.groupby('State').sum()
+            with instrument.span('groupby', by='State'):
+                data = data.groupby('State').sum(numeric_only=True)
             if drop is None:
                 drop = self.__state_column_drop
             #TODO: Make sure this works as intended vs what's commented out
@@ -96,52 +249,421 @@ class JhuData():
             #         data = data.drop(columns=drop)
 
         # Convert dates to datetime format if columns are only dates
-        try:
-            data.columns = pd.to_datetime(data.columns)
+        dates = date_labels(data.columns)
+        if len(dates) == len(data.columns):
+            data.columns = pd.DatetimeIndex(list(dates.values()), name='date')
+        data.index.name = groupby
+
+        return data
+
+
+    def _update_us(self, previous, buffer, groupby='county', drop=None,
+                   start=None, end=None):
+        ''' Bring a previously parsed US frame up to date by reading only the
+        date columns it does not have yet, plus the last revision_window days
+        it does have (JHU back-revises recent counts). Falls back to a full
+        parse if the set of counties changed.'''
+        header = pd.read_csv(buffer, nrows=0).columns
+        dates = {label: day for label, day in date_labels(header).items()
+                 if in_window(day, start, end)}
+        previous_dates = date_labels(previous.columns)
+
+        known = sorted(previous_dates.values())
+        recheck = set(known[-self.revision_window:]) if self.revision_window else set()
+        known = set(known)
+        labels = [label for label, day in dates.items()
+                  if day not in known or day in recheck]
+        if not labels:
+            return previous
+
+        buffer.seek(0)
+        data = pd.read_csv(buffer, usecols=['Admin2', 'Province_State'] + labels)
+        data = data.rename(columns=self.__column_rename)
+        data = data.set_index(county_state_index(data))
+        if groupby.lower() == 'state':
+            data = data.drop(columns='County').groupby('State').sum()
+        else:
+            data = data.drop(columns=['County', 'State'])
+
+        if not data.index.equals(previous.index):
+            buffer.seek(0)
+            return self._parse_us(buffer, groupby, drop, start, end)
+
+        if isinstance(previous.columns, pd.DatetimeIndex):
+            data.columns = pd.to_datetime(data.columns, format='%m/%d/%y')
+        stale = [label for label, day in previous_dates.items() if day in recheck]
+        data = pd.concat([previous.drop(columns=stale), data], axis=1)
+        if isinstance(previous.columns, pd.DatetimeIndex):
             data.columns.name = 'date'
-        except TypeError:
-            pass
         data.index.name = groupby
 
         return data
 
 
-    def global_cases(self):
+    @instrument.traced
+    def global_cases(self, start=None, end=None):
         url = join(self._timeseries_baseurl,
                    'time_series_covid19_confirmed_global.csv')
-        return self._load_global_url(url)
+        return self._load_global_url(url, start, end)
 
 
-    def global_fatalities(self):
+    @instrument.traced
+    def global_fatalities(self, start=None, end=None):
         url = join(self._timeseries_baseurl,
                    'time_series_covid19_deaths_global.csv')
-        return self._load_global_url(url)
+        return self._load_global_url(url, start, end)
 
 
-    def us_cases(self, groupby='county'):
-        url = join(self._timeseries_baseurl,
-                   'time_series_covid19_confirmed_US.csv')
-        return self._load_us_url(url, groupby=groupby)
+    def _us_url(self, kind):
+        filename = {'cases': 'time_series_covid19_confirmed_US.csv',
+                    'fatalities': 'time_series_covid19_deaths_US.csv'}[kind]
+        return join(self._timeseries_baseurl, filename)
 
 
-    def us_fatalities(self, groupby='county'):
-        url = join(self._timeseries_baseurl,
-                   'time_series_covid19_deaths_US.csv')
-        to_drop = self.__state_column_drop.append('Population')
-        return self._load_us_url(url, groupby=groupby, drop=to_drop)
+    @instrument.traced
+    def us_cases(self, groupby='county', start=None, end=None):
+        """ US confirmed cases by county or state. Only the date columns
+        between start and end (inclusive, optional) are parsed."""
+        url = self._us_url('cases')
+        return self._load_us_url(url, groupby=groupby, start=start, end=end)
+
+
+    @instrument.traced
+    def us_fatalities(self, groupby='county', start=None, end=None):
+        """ US fatalities by county or state. Only the date columns
+        between start and end (inclusive, optional) are parsed."""
+        url = self._us_url('fatalities')
+        to_drop = self.__state_column_drop + ['Population']
+        return self._load_us_url(url, groupby=groupby, drop=to_drop,
+                                 start=start, end=end)
 
 
+    @instrument.traced
     def us_population(self, groupby='county'):
-        url = join(self._timeseries_baseurl,
-                   'time_series_covid19_deaths_US.csv')
+        url = self._us_url('fatalities')
         df = self._load_us_url(url, groupby=groupby)
         return df['Population'] if 'Population' in df.columns else None
 
 
+    @instrument.traced
+    def daily_reports(self, start=None, end=None, source=None, processes=None, workers=8):
+        ''' State x date panel of the JHU US daily reports, which carry
+        testing, hospitalization and rate fields missing from the time series.
+
+        Report files are read from source, a base URL (the JHU repository by
+        default, through the download cache) or a local directory mirror of
+        MM-DD-YYYY.csv files. Files are parsed across a process pool and
+        their columns normalized across report vintages (see
+        DAILY_REPORT_COLUMNS). The consolidated panel is kept in the download
+        cache, so later calls only parse days not ingested yet plus the last
+        revision_window days.
+
+        Arguments:
+            start, end: Optional inclusive date window
+            processes: Parser processes (defaults to the number of CPUs,
+                0 or 1 parses in this process)
+            workers: Concurrent downloads for a URL source
+
+        Returns dataframe indexed by state and date.
+        '''
+        source = str(source or self._daily_report_baseurl)
+        local = Path(source).is_dir()
+        if local:
+            files = {}
+            for path in Path(source).glob('*.csv'):
+                day = pd.to_datetime(path.stem, format='%m-%d-%Y', errors='coerce')
+                if not pd.isnull(day):
+                    files[day] = path
+        else:
+            last_day = pd.Timestamp(end) if end is not None else pd.Timestamp.today().normalize()
+            files = {day: join(source, '{:%m-%d-%Y}.csv'.format(day))
+                     for day in pd.date_range(DAILY_REPORTS_START, last_day)}
+        files = {day: location for day, location in files.items()
+                 if in_window(day, start, end)}
+
+        name = 'daily-reports-{}-{}'.format(source, PARSER_VERSION)
+        stored = self._cache.load_object(name) or {'panel': None, 'absent': set()}
+        panel, absent = stored['panel'], stored['absent']
+        known = set(pd.DatetimeIndex(panel['date'].unique())) if panel is not None else set()
+        # Recent reports are revised, and missing recent ones may still appear
+        recheck = set(sorted(known)[-self.revision_window:]) if self.revision_window else set()
+        retry_after = pd.Timestamp.today().normalize() - pd.Timedelta(days=self.revision_window)
+        days = sorted(day for day in files
+                      if (day not in known or day in recheck)
+                      and (day not in absent or day >= retry_after))
+
+        if days:
+            with ThreadPoolExecutor(max_workers=1 if local else workers) as pool:
+                contents = list(pool.map(self._read_report, [files[day] for day in days]))
+            absent = (absent - set(days)) | {day for day, content in zip(days, contents)
+                                             if content is None}
+            found = [(day, content) for day, content in zip(days, contents)
+                     if content is not None]
+            reports = _map_processes(parse_daily_report, found, processes)
+            instrument.count('reports_parsed', len(reports))
+
+            parsed = {day for day, _ in found}
+            frames = [panel[~panel['date'].isin(parsed)]] if panel is not None else []
+            # Nothing to concatenate when no report in the window is published yet
+            if frames or reports:
+                panel = pd.concat(frames + reports, ignore_index=True)
+                panel['state'] = panel['state'].astype(str)
+                panel = panel.sort_values(['state', 'date'], ignore_index=True)
+                panel['state'] = panel['state'].astype('category')
+            self._cache.save_object(name, {'panel': panel, 'absent': absent})
+
+        if panel is None:
+            panel = pd.DataFrame(columns=['state', 'date'] + DAILY_REPORT_FIELDS)
+        if start is not None:
+            panel = panel[panel['date'] >= pd.Timestamp(start)]
+        if end is not None:
+            panel = panel[panel['date'] <= pd.Timestamp(end)]
+        return self._compact(panel.set_index(['state', 'date']))
+
+
+    def _read_report(self, location):
+        """ Raw bytes of a daily report file or URL, None if it has not
+        been published."""
+        if isinstance(location, Path):
+            return location.read_bytes()
+        try:
+            return self._cache.fetch(location)
+        except HTTPError as error:
+            if error.code == 404:
+                return None
+            raise
+        except ConnectionError:
+            # Offline cache without this report
+            return None
+
+
+    @instrument.traced
+    def us_county_table(self, kind='cases'):
+        """ County time series ('cases' or 'fatalities') split into metadata
+        and dates, with lookups by "County, State" and by FIPS."""
+        url = self._us_url(kind)
+        # Built from the county frame so incremental refreshes carry over
+        return self._cache.frame(url, lambda buffer: CountyTable(self._load_us_url(url)),
+                                 key='us-table-{}'.format(self.compact),
+                                 version=PARSER_VERSION)
+
+
+
+class CountyTable:
+    """ JHU county time series with metadata columns split from date
+    columns once, and hashed row lookups by "County, State" name and FIPS.
+
+    Attributes:
+        metadata: Dataframe of non-date columns (UID, FIPS, County, ...)
+        values: Array of counts, one row per county
+        dates: DatetimeIndex of the value columns
+        population: Series of county population if the source has one
+    """
+
+    def __init__(self, data):
+        dates = date_labels(data.columns)
+        self.metadata = data.drop(columns=list(dates))
+        self.population = self.metadata.pop('Population') \
+            if 'Population' in self.metadata.columns else None
+        self.values = data[list(dates)].to_numpy()
+        self.dates = pd.DatetimeIndex(list(dates.values()), name='date')
+        self.names = data.index
+        self._build_lookups()
+
+
+    @classmethod
+    def from_arrays(cls, values, names, dates, metadata, population=None):
+        """ Table over an existing county x date array without copying it,
+        e.g. one held in shared memory."""
+        table = cls.__new__(cls)
+        table.metadata = metadata
+        table.population = population
+        table.values = values
+        table.dates = pd.DatetimeIndex(dates, name='date')
+        table.names = pd.Index(names)
+        table._build_lookups()
+        return table
+
+
+    def _build_lookups(self):
+        self._positions = {name: ii for ii, name in enumerate(self.names)}
+        self._fips = {}
+        if 'FIPS' in self.metadata.columns:
+            for ii, fips in enumerate(self.metadata['FIPS']):
+                if not pd.isnull(fips):
+                    self._fips[int(fips)] = ii
+
+
+    def locate(self, key):
+        """ Row position of a county given "County, State" or a FIPS code
+        (int, float or numeric string)."""
+        if key in self._positions:
+            return self._positions[key]
+        try:
+            return self._fips[int(float(key))]
+        except (KeyError, TypeError, ValueError):
+            raise KeyError(key) from None
+
+
+    def name(self, key):
+        return self.names[self.locate(key)]
+
+
+    def series(self, key):
+        position = self.locate(key)
+        return pd.Series(self.values[position], index=self.dates,
+                         name=self.names[position])
+
+
+    def record(self, key):
+        """ Metadata of a county as a dict of column to value."""
+        return self.metadata.iloc[self.locate(key)].to_dict()
+
+
+    def frame(self, keys=None):
+        """ Wide county x date frame for keys (all counties by default)."""
+        if keys is None:
+            return pd.DataFrame(self.values, index=self.names, columns=self.dates)
+        positions = [self.locate(key) for key in keys]
+        return pd.DataFrame(self.values[positions], index=self.names[positions],
+                            columns=self.dates)
+
+
+
+DAILY_REPORTS_START = '2020-04-12'
+
+# Daily report columns of every vintage mapped to panel column names
+DAILY_REPORT_COLUMNS = {'Confirmed': 'confirmed',
+                        'Deaths': 'deaths',
+                        'Recovered': 'recovered',
+                        'Active': 'active',
+                        'Incident_Rate': 'incident_rate',
+                        'Total_Test_Results': 'total_test_results',
+                        'People_Tested': 'total_test_results',
+                        'Testing_Rate': 'testing_rate',
+                        'People_Hospitalized': 'people_hospitalized',
+                        'Hospitalization_Rate': 'hospitalization_rate',
+                        'Case_Fatality_Ratio': 'case_fatality_ratio',
+                        'Mortality_Rate': 'case_fatality_ratio'}
+DAILY_REPORT_FIELDS = list(dict.fromkeys(DAILY_REPORT_COLUMNS.values()))
+
+
+
+def parse_daily_report(day, content):
+    """ Parse one JHU US daily report (raw CSV bytes) into one row per
+    state with date and DAILY_REPORT_FIELDS columns, whatever the vintage
+    of the report. Fields a vintage lacks are NaN."""
+    data = pd.read_csv(io.BytesIO(content), encoding='utf-8-sig')
+    data.columns = data.columns.str.strip()
+    state = 'Province_State' if 'Province_State' in data.columns else 'Province/State'
+
+    report = pd.DataFrame({'state': data[state].astype(str).str.strip(),
+                           'date': pd.Timestamp(day)})
+    for column, field in DAILY_REPORT_COLUMNS.items():
+        if column in data.columns and field not in report.columns:
+            report[field] = pd.to_numeric(data[column], errors='coerce').astype(float)
+    report = report.reindex(columns=['state', 'date'] + DAILY_REPORT_FIELDS)
+    return report.drop_duplicates('state', keep='last')
+
+
+
+def _map_processes(func, items, processes=None):
+    """ [func(*item) for item in items] across a process pool, or in this
+    process if processes is 0 or 1."""
+    processes = os.cpu_count() if processes is None else processes
+    if processes <= 1 or len(items) < 2:
+        return [func(*item) for item in items]
+    with ProcessPoolExecutor(processes) as executor:
+        return list(executor.map(func, *zip(*items),
+                                 chunksize=max(1, len(items)//(processes*4))))
+
+
+
+def in_window(day, start=None, end=None):
+    """ True if day falls between optional start and end dates (inclusive)."""
+    return (start is None or day >= pd.Timestamp(start)) and \
+        (end is None or day <= pd.Timestamp(end))
+
+
+
+def window_columns(buffer, start=None, end=None):
+    """ Header labels of a JHU time series CSV restricted to the metadata
+    columns plus dates between start and end, for use as read_csv usecols.
+    Returns None (every column) without a window. Rewinds buffer."""
+    if start is None and end is None:
+        return None
+    header = pd.read_csv(buffer, nrows=0).columns
+    buffer.seek(0)
+    dates = date_labels(header)
+    return [label for label in header
+            if label not in dates or in_window(dates[label], start, end)]
+
+
+
+def date_labels(labels):
+    """ Map the date labels of a JHU time series header (m/d/yy strings or
+    already converted timestamps) to timestamps, skipping metadata labels."""
+    if isinstance(labels, pd.DatetimeIndex):
+        return dict(zip(labels, labels))
+    dates = pd.to_datetime(pd.Index(labels).astype(str), format='%m/%d/%y', errors='coerce')
+    return {label: day for label, day in zip(labels, dates) if not pd.isnull(day)}
+
+
+
+CATEGORICAL_COLUMNS = ['state', 'State', 'County', 'Country', 'Country/Region',
+                       'iso2', 'iso3']
+
+
+
+def memory_usage(df):
+    """ Deep memory use of dataframe in bytes, including the index."""
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+
+def _smallest_int(low, high):
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return dtype
+    return np.int64
+
+
+
+def compact_frame(df, float32=False, categories=CATEGORICAL_COLUMNS, report=False):
+    """ Return a lower memory copy of dataframe. Integer columns are
+    downcast together to the smallest integer type holding all of them, so a
+    wide count frame stays a single block. Float columns become float32 if
+    float32 is set, and key columns listed in categories become categoricals.
+    If report is set, prints memory use before and after."""
+    before = memory_usage(df) if report else None
+    dtypes = {}
+
+    integers = df.select_dtypes(include='integer')
+    if integers.shape[1]:
+        dtype = _smallest_int(integers.min().min(), integers.max().max())
+        dtypes.update({column: dtype for column in integers.columns})
+    if float32:
+        dtypes.update({column: np.float32
+                       for column in df.select_dtypes(include='float64').columns})
+    for column in categories:
+        if column in df.columns and df[column].dtype.name != 'category':
+            dtypes[column] = 'category'
+
+    if dtypes:
+        df = df.astype(dtypes)
+        instrument.count('frames_copied')
+    if report:
+        print('Compacted frame from {:.1f} MB to {:.1f} MB'.format(
+            before/1024**2, memory_usage(df)/1024**2))
+    return df
+
+
 
 def county_state_index(data):
-    """ Append state name to county in dataframe including county and state columns."""
-    return data.County.str.cat(data.State, sep=', ')
+    """ Append state name to county in dataframe including county and state columns.
+    Rows without a county (territories, cruise ships) are named by state alone."""
+    return data.County.str.cat(data.State, sep=', ').fillna(data.State)
 
 
 
@@ -152,6 +674,7 @@ def icu_utilization(df):
 
 
 
+@instrument.traced
 def summarize_hospitalizations(df):
     hospitalization_cols = ['previous_day_admission_adult_covid_confirmed',
                             'previous_day_admission_pediatric_covid_confirmed']
@@ -163,39 +686,131 @@ def summarize_hospitalizations(df):
 
 
 
-def combine_databases(hospital_data, vaccine_data, jhu_cases, jhu_deaths):
-    cases = jhu_cases.stack()
-    cases.name = 'total_cases'
-    cases = cases.reset_index()
-
-    deaths = jhu_deaths.stack()
-    deaths.name = 'total_deaths'
-    deaths = deaths.reset_index()
-
-    combined = pd.merge(hospital_data.reset_index(),
-                        vaccine_data.reset_index(),
-                        on=['state', 'date'])
-
-    combined = pd.merge(combined, cases, on=['state', 'date'])
-    combined = pd.merge(combined, deaths, on=['state', 'date'])
+def _source_keys(states, dates, state_labels, date_labels):
+    """ Integer join keys state code * number of dates + date code, with a
+    mask of the rows whose state and date are both known."""
+    state_codes = pd.Categorical(state_labels, categories=states).codes.astype(np.int64)
+    date_codes = dates.get_indexer(date_labels).astype(np.int64)
+    keys = state_codes*len(dates) + date_codes
+    return keys, (state_codes >= 0) & (date_codes >= 0)
+
+
+
+def _positions(keys, valid, result_keys):
+    """ Row of each result key within a source, -1 where the source has no
+    such row. If a key repeats the last row wins."""
+    rows = np.flatnonzero(valid)
+    order = np.argsort(keys[rows], kind='stable')
+    sorted_keys = keys[rows][order]
+    found = np.searchsorted(sorted_keys, result_keys, side='right') - 1
+    hit = found >= 0
+    hit[hit] = sorted_keys[found[hit]] == result_keys[hit]
+    return np.where(hit, rows[order[np.maximum(found, 0)]], -1)
+
+
+
+def _take(values, positions):
+    if (positions >= 0).all():
+        return values.take(positions)
+    return pd.api.extensions.take(values, positions, allow_fill=True)
+
+
+
+@instrument.traced
+def combine_databases(hospital_data, vaccine_data, jhu_cases, jhu_deaths,
+                      compact=False, float32=False, how='inner'):
+    """ Join HealthData.gov hospitalization and vaccination frames (indexed
+    by date, with a state column) with JHU state x date case and death
+    frames into one row per state and date.
+
+    Every source is mapped to a shared sorted integer (state, date) key and
+    the result is gathered column by column in a single pass. how is 'inner'
+    (rows present in every source), 'left' (rows of hospital_data) or
+    'outer' (rows present in any source). Sources are expected to hold one
+    row per state and date."""
+    if how not in ('inner', 'left', 'outer'):
+        raise TypeError('Join type {} not supported'.format(how))
+
+    long_sources = [hospital_data, vaccine_data]
+    wide_sources = [jhu_cases, jhu_deaths]
+    states = pd.Index(sorted(set(hospital_data['state'].dropna())
+                             | set(vaccine_data['state'].dropna())
+                             | set(jhu_cases.index) | set(jhu_deaths.index)))
+    dates = pd.DatetimeIndex(np.unique(np.concatenate(
+        [pd.to_datetime(df.index).values for df in long_sources]
+        + [pd.to_datetime(df.columns).values for df in wide_sources])))
+
+    keys = [_source_keys(states, dates, df['state'], pd.to_datetime(df.index))
+            for df in long_sources]
+    for df in wide_sources:
+        state_labels = np.repeat(df.index.values, df.shape[1])
+        date_labels = np.tile(pd.to_datetime(df.columns).values, df.shape[0])
+        keys.append(_source_keys(states, dates, state_labels, date_labels))
+
+    unique_keys = [np.unique(source_keys[valid]) for source_keys, valid in keys]
+    if how == 'inner':
+        result_keys = reduce(np.intersect1d, unique_keys)
+    elif how == 'left':
+        result_keys = unique_keys[0]
+    else:
+        result_keys = reduce(np.union1d, unique_keys)
+    positions = [_positions(source_keys, valid, result_keys)
+                 for source_keys, valid in keys]
+
+    columns = {'date': dates[result_keys % len(dates)],
+               'state': pd.Categorical.from_codes(result_keys//len(dates),
+                                                  categories=states)}
+    suffixes = ['_x', '_y']
+    shared = set(hospital_data.columns) & set(vaccine_data.columns)
+    for df, suffix, rows in zip(long_sources, suffixes, positions):
+        for column in df.columns.drop('state'):
+            name = column + suffix if column in shared else column
+            columns[name] = _take(df[column].array, rows)
+    for df, name, rows in zip(wide_sources, ['total_cases', 'total_deaths'], positions[2:]):
+        columns[name] = _take(df.to_numpy().ravel(), rows)
+
+    combined = pd.DataFrame(columns)
+    if compact:
+        combined = compact_frame(combined, float32=float32, report=True)
     return combined
 
 
 
-def load_us_database(save=True):
+@instrument.traced
+def load_us_database(save=True, fmt=None, path=None, compact=False, float32=False,
+                     processes=False, how='inner'):
     """ Combine HealthData.gov and JHU databases into combined dataframe
     at state-level resolution. If save option is set to true, will save
-    as CSV in PWD."""
-    hospitalizations = HealthGovData().load_hosptializations()
-    vaccinations = HealthGovData().load_vaccinations()
-    state_cases = JhuData().us_cases(groupby='state')
-    state_fatalities = JhuData().us_fatalities(groupby='state')
-
-    df = combine_databases(hospitalizations, vaccinations,
-                           state_cases, state_fatalities)
-
-    df = df.set_index('date')
+    a snapshot in PWD, as a Parquet dataset partitioned by state by default,
+    as CSV with fmt='csv' or upserted into the SQLite store with
+    fmt='sqlite' together with the JHU state and county frames. compact,
+    float32 and the join type how are passed on to combine_databases.
+
+    The four sources are downloaded and parsed concurrently on a thread
+    pool, or on a process pool if processes is set, and the wall time of
+    each stage is printed."""
+    healthgov = HealthGovData()
+    jhu = JhuData()
+
+    pipeline = Pipeline(verbose=True)
+    pipeline.add('hospitalizations', healthgov.load_hosptializations, process=processes)
+    pipeline.add('vaccinations', healthgov.load_vaccinations, process=processes)
+    pipeline.add('cases', partial(jhu.us_cases, groupby='state'), process=processes)
+    pipeline.add('fatalities', partial(jhu.us_fatalities, groupby='state'), process=processes)
+    pipeline.add('combined',
+                 partial(combine_databases, compact=compact, float32=float32, how=how),
+                 'hospitalizations', 'vaccinations', 'cases', 'fatalities')
+    results = pipeline.run()
+
+    df = results['combined'].set_index('date')
     if save:
-        df.to_csv('us_combined_covid_data.csv')
+        frames = None
+        if (fmt or '').lower() == 'sqlite':
+            # The store also keeps the JHU wide frames for indexed lookups
+            frames = {'state_cases': results['cases'],
+                      'state_fatalities': results['fatalities'],
+                      'county_cases': jhu.us_county_table('cases').frame(),
+                      'county_fatalities': jhu.us_county_table('fatalities').frame()}
+        storage.save_snapshot(df, path=path, fmt=fmt, frames=frames)
 
     return df
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Aggregate time series over named groupings of entities.
+
+A Grouping maps group labels (G7, South Atlantic, a metro area, ...) to
+member entities (countries, states or "County, State" names). Its membership
+is turned into a sparse groups x entities matrix aligned to the rows of a
+wide frame, so every group total is computed in one sparse matrix product
+over the entity x date values. Population is carried through the same
+product to give population-weighted per-capita rates.
+
+scipy is used for the sparse matrices when installed, otherwise a dense
+NumPy matrix is used.
+
+Example:
+    cases = JhuData().us_cases(groupby='state')
+    result = census_divisions().aggregate(cases, state_population(cases.index))
+    result['per_capita']
+"""
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+import utils
+from population import census
+
+try:
+    from scipy import sparse
+except ImportError:
+    sparse = None
+
+
+
+REGIONS = {1: 'Northeast', 2: 'Midwest', 3: 'South', 4: 'West'}
+
+DIVISIONS = {1: 'New England', 2: 'Middle Atlantic', 3: 'East North Central',
+             4: 'West North Central', 5: 'South Atlantic', 6: 'East South Central',
+             7: 'West South Central', 8: 'Mountain', 9: 'Pacific'}
+
+
+
+class Grouping:
+    """ Named groups of entities.
+
+    Arguments:
+        name: Name of the grouping
+        groups: Mapping of group label to member entity labels. Groups may
+            overlap (e.g. G7 and G20).
+    """
+
+    def __init__(self, name, groups):
+        self.name = name
+        self.groups = {label: list(dict.fromkeys(members))
+                       for label, members in groups.items()}
+        self._matrices = {}
+
+
+    def __repr__(self):
+        return 'Grouping({!r}, {} groups)'.format(self.name, len(self.groups))
+
+
+    def matrix(self, entities):
+        """ Membership matrix (groups x entities) for the entity labels of a
+        wide frame, sparse if scipy is available. Members missing from
+        entities are ignored. Matrices are cached per entity index."""
+        entities = pd.Index(entities)
+        key = tuple(entities)
+        if key not in self._matrices:
+            rows, columns = [], []
+            for row, members in enumerate(self.groups.values()):
+                positions = entities.get_indexer(members)
+                positions = positions[positions >= 0]
+                rows.append(np.full(len(positions), row))
+                columns.append(positions)
+            rows = np.concatenate(rows) if rows else np.array([], dtype=int)
+            columns = np.concatenate(columns) if columns else np.array([], dtype=int)
+            shape = (len(self.groups), len(entities))
+            if sparse is not None:
+                matrix = sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=shape)
+            else:
+                matrix = np.zeros(shape)
+                matrix[rows, columns] = 1.
+            self._matrices[key] = matrix
+        return self._matrices[key]
+
+
+    def _members(self, keep):
+        """ Members of each group for which keep(member) is true, leaving
+        out groups without any."""
+        members = {label: [member for member in group if keep(member)]
+                   for label, group in self.groups.items()}
+        return {label: group for label, group in members.items() if group}
+
+
+    def unmatched(self, entities):
+        """ Members of each group missing from entities, e.g. because of a
+        naming mismatch with the data source."""
+        entities = set(entities)
+        return self._members(lambda member: member not in entities)
+
+
+    def aggregate(self, wide, population=None, per=1000000, axis=1):
+        """ Sum every group of a wide frame (entity x date, or date x entity
+        with axis=0) in one matrix product. Missing values count as zero.
+
+        Returns dict with 'total', a group x date frame, and 'unmatched',
+        the members of each group missing from the frame. If population
+        (one value per entity, a Series is aligned to the entities) is given
+        also 'population' per group and 'per_capita', the group totals per
+        per residents. Members without a population are left out of both
+        sides of per_capita and listed in 'no_population'; a group without
+        any population has NaN per_capita. Unmatched members are reported.
+        """
+        if axis == 0:
+            wide = wide.T
+        values = np.nan_to_num(wide.to_numpy(dtype=float))
+        result = {'unmatched': self.unmatched(wide.index)}
+        if result['unmatched']:
+            print('Members missing from data in {}: {}'.format(self.name, result['unmatched']))
+
+        columns = [values]
+        if population is not None:
+            if isinstance(population, pd.Series):
+                population = population.reindex(wide.index)
+            population = np.asarray(population, dtype=float)
+            known = np.isfinite(population) & (population > 0)
+            # Population and the values of members with a population ride
+            # along as more columns of the same product
+            columns += [np.where(known[:, np.newaxis], values, 0.),
+                        np.where(known, population, 0.).reshape(-1, 1)]
+            without = set(wide.index[~known])
+            result['no_population'] = self._members(lambda member: member in without)
+
+        products = np.asarray(self.matrix(wide.index) @ np.hstack(columns))
+        labels = pd.Index(list(self.groups), name=self.name)
+        totals = products[:, :values.shape[1]]
+        if population is not None:
+            known_totals = products[:, values.shape[1]:-1]
+            group_population = products[:, -1]
+            result['population'] = pd.Series(group_population, index=labels)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                per_capita = np.where(group_population[:, np.newaxis] > 0,
+                                      known_totals/group_population[:, np.newaxis]*per, np.nan)
+            result['per_capita'] = pd.DataFrame(per_capita, index=labels, columns=wide.columns)
+        result['total'] = pd.DataFrame(totals, index=labels, columns=wide.columns)
+
+        if axis == 0:
+            result = {key: value.T if isinstance(value, pd.DataFrame) else value
+                      for key, value in result.items()}
+        return result
+
+
+
+@lru_cache(maxsize=None)
+def country_blocs():
+    """ G7, EU and G20 membership by JHU country name."""
+    return Grouping('bloc', {'G7': utils.G7_COUNTRIES,
+                             'EU': utils.EUROPEAN_UNION,
+                             'G20': utils.G20_COUNTRIES})
+
+
+
+def _census_grouping(name, column, labels, level):
+    table = census().table
+    if level == 'state':
+        table = table[table['SUMLEV'] == 40]
+        members = table['STATENAME']
+    elif level == 'county':
+        table = table[table['SUMLEV'] == 50]
+        members = table['COUNTYNAME'].str.cat(table['STATENAME'], sep=', ')
+    else:
+        raise TypeError('Census grouping level {} not supported'.format(level))
+    groups = members.groupby(table[column].map(labels), sort=False)
+    return Grouping(name, {label: list(groups.get_group(label))
+                           for label in labels.values() if label in groups.groups})
+
+
+
+@lru_cache(maxsize=None)
+def census_regions(level='state'):
+    """ US census regions, with state names or "County, State" names
+    (level='county') as members."""
+    return _census_grouping('region', 'REGION', REGIONS, level)
+
+
+
+@lru_cache(maxsize=None)
+def census_divisions(level='state'):
+    """ US census divisions, with state names or "County, State" names
+    (level='county') as members."""
+    return _census_grouping('division', 'DIVISION', DIVISIONS, level)
+
+
+
+def county_sets(groups, name='county set'):
+    """ User defined groups of counties, mapping of label to "County, State"
+    names, e.g. {'Bay Area': ['San Francisco, California', ...]}."""
+    return Grouping(name, groups)
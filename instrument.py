@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight timing spans and counters for the fetch, parse, aggregate and
+plot stages.
+
+Instrumentation is off by default and then costs one flag check per call.
+Once enabled, every finished span is passed to an optional user callback,
+optionally logged through the 'covid19.instrument' logger, and optionally
+written to a trace file in Chrome trace event format (open it in
+chrome://tracing, Perfetto or speedscope for a flame graph).
+
+Example:
+    instrument.enable(trace_path='trace.json')
+    State('Texas')
+    instrument.disable()
+    print(instrument.counters())
+"""
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+
+
+logger = logging.getLogger('covid19.instrument')
+
+_enabled = False
+_callback = None
+_log = False
+_trace_path = None
+_events = []
+_counters = Counter()
+_lock = threading.Lock()
+_origin = time.perf_counter()
+_disabled_span = nullcontext()
+
+
+
+def enable(callback=None, log=False, trace_path=None):
+    """ Start recording spans and counters.
+
+    Arguments:
+        callback: Called with a dict for every finished span (name, start,
+            duration in seconds, thread and any span attributes)
+        log: Log every finished span at DEBUG level
+        trace_path: Write a Chrome trace JSON file on disable()
+    """
+    global _enabled, _callback, _log, _trace_path
+    _callback = callback
+    _log = log
+    _trace_path = trace_path
+    _enabled = True
+
+
+
+def disable():
+    """ Stop recording, writing the trace file if one was requested."""
+    global _enabled
+    _enabled = False
+    if _trace_path is not None:
+        write_trace(_trace_path)
+
+
+
+def reset():
+    """ Clear recorded events and counters."""
+    with _lock:
+        _events.clear()
+        _counters.clear()
+
+
+
+def is_enabled():
+    return _enabled
+
+
+
+@contextmanager
+def _span(name, attrs):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        event = {'name': name,
+                 'start': start - _origin,
+                 'duration': duration,
+                 'thread': threading.get_ident()}
+        event.update(attrs)
+        with _lock:
+            _events.append(event)
+        if _callback is not None:
+            _callback(event)
+        if _log:
+            logger.debug('%s took %.4f s %s', name, duration, attrs or '')
+
+
+
+def span(name, **attrs):
+    """ Context manager timing the enclosed block as span name."""
+    if not _enabled:
+        return _disabled_span
+    return _span(name, attrs)
+
+
+
+def traced(func=None, name=None):
+    """ Decorator timing every call of func as a span named
+    module.qualname (or name)."""
+    if func is None:
+        return functools.partial(traced, name=name)
+    name = name or '{}.{}'.format(func.__module__, func.__qualname__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return func(*args, **kwargs)
+        with _span(name, {}):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+
+def count(name, value=1):
+    """ Add value to counter name (e.g. bytes_downloaded, rows_parsed)."""
+    if _enabled:
+        with _lock:
+            _counters[name] += value
+
+
+
+def counters():
+    """ Snapshot of counters as a dict."""
+    with _lock:
+        return dict(_counters)
+
+
+
+def events():
+    """ Snapshot of finished spans as a list of dicts."""
+    with _lock:
+        return list(_events)
+
+
+
+def write_trace(path):
+    """ Write recorded spans and final counter values as a Chrome trace
+    event JSON file."""
+    pid = os.getpid()
+    with _lock:
+        trace = [{'name': event['name'],
+                  'ph': 'X',
+                  'ts': event['start']*1e6,
+                  'dur': event['duration']*1e6,
+                  'pid': pid,
+                  'tid': event['thread'],
+                  'args': {key: value for key, value in event.items()
+                           if key not in ('name', 'start', 'duration', 'thread')}}
+                 for event in _events]
+        end = max([event['start'] + event['duration'] for event in _events], default=0)
+        trace += [{'name': name, 'ph': 'C', 'ts': end*1e6, 'pid': pid,
+                   'args': {name: value}}
+                  for name, value in _counters.items()]
+    with open(path, 'w') as fid:
+        json.dump({'traceEvents': trace}, fid, default=str)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal dependency-graph runner used to load data sources concurrently.
+
+Stages are callables with named dependencies. A stage is started as soon as
+everything it depends on has finished, on a thread pool by default or on a
+process pool for CPU-bound stages, and receives the results of its
+dependencies as positional arguments in the order they were declared.
+"""
+import time
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from contextlib import nullcontext
+
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+
+class Pipeline:
+    """ Run stages of a dependency graph concurrently.
+
+    Arguments:
+        workers: Size of the thread pool for I/O bound stages
+        processes: Size of the process pool for stages added with
+            process=True (defaults to the number of CPUs)
+        verbose: Print wall time of each stage as it finishes
+
+    Example:
+        pipeline = Pipeline()
+        pipeline.add('cases', load_cases)
+        pipeline.add('deaths', load_deaths)
+        pipeline.add('combined', combine, 'cases', 'deaths')
+        results = pipeline.run()
+    """
+
+    def __init__(self, workers=4, processes=None, verbose=False):
+        self.workers = workers
+        self.processes = processes
+        self.verbose = verbose
+        self.timings = {}
+        self._stages = {}
+
+
+    def add(self, name, func, *dependencies, process=False):
+        """ Add stage name computing func(*results of dependencies). Stages
+        run in a process pool must be picklable (module level functions,
+        functools.partial of them, or bound methods of picklable objects)."""
+        if name in self._stages:
+            raise ValueError('Stage {} already defined'.format(name))
+        self._stages[name] = (func, dependencies, process)
+        return self
+
+
+    def run(self):
+        """ Run every stage and return dict of stage name to result. Wall
+        time of each stage is recorded in the timings attribute."""
+        results = {}
+        pending = dict(self._stages)
+        running = {}
+        use_processes = any(process for _, _, process in pending.values())
+        self.timings = {}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as threads, \
+                (ProcessPoolExecutor(max_workers=self.processes)
+                 if use_processes else nullcontext()) as processes:
+            while pending or running:
+                for name, (func, dependencies, process) in list(pending.items()):
+                    if all(dependency in results for dependency in dependencies):
+                        pool = processes if process else threads
+                        args = [results[dependency] for dependency in dependencies]
+                        running[pool.submit(_timed, func, *args)] = name
+                        del pending[name]
+
+                if not running:
+                    raise ValueError('Stages {} have missing or circular '
+                                     'dependencies'.format(sorted(pending)))
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name], self.timings[name] = future.result()
+                    if self.verbose:
+                        print('Stage {} finished in {:.2f} s'.format(
+                            name, self.timings[name]))
+        return results
@@ -2,38 +2,146 @@
 
 
 import datetime
-
+import functools
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
 import pandas as pd
 import matplotlib as mpl
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 
-import databases
 import analytics
+import instrument
+from population import lookup, state_population
+from timeline import StateTimeline
+
+
+
+STYLE = {'axes.facecolor': 'white',
+         'axes.grid': True,
+         'axes.grid.axis': 'y',
+         'axes.grid.which': 'both',
+         'axes.spines.left': False,
+         'axes.spines.right': False,
+         'axes.spines.top': False,
+         'axes.spines.bottom': False,
+         'grid.color': '#efeff2',
+         'lines.linewidth': 2,
+         'lines.linestyle': '-',
+         'xtick.direction': 'in',
+         'xtick.labelsize': 11,
+         'xtick.major.size': 6,
+         'xtick.minor.size': 6,
+         'ytick.labelsize': 11,
+         'ytick.major.size': 0,
+         'ytick.direction': 'in'}
+
+
+
+@contextmanager
+def style():
+    """ Apply the library plot style (seaborn base plus STYLE overrides)
+    within a block, leaving global rcParams untouched."""
+    # The seaborn style was renamed in matplotlib 3.6
+    base = 'seaborn-v0_8' if 'seaborn-v0_8' in plt.style.available else 'seaborn'
+    with plt.style.context(base), mpl.rc_context(STYLE):
+        yield
+
+
+
+def styled(func):
+    """ Decorator running func within style()."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with style():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+
+def lttb(x, y, threshold):
+    """ Largest-Triangle-Three-Buckets downsampling. Returns sorted
+    positions of at most threshold points of (x, y) that keep the visual
+    shape of the line. Non-finite values are skipped."""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    finite = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    n = len(finite)
+    if threshold < 3 or n <= threshold:
+        return finite
+    x, y = x[finite], y[finite]
+
+    # First and last points are kept, the rest split into threshold - 2 buckets
+    every = (n - 2)/(threshold - 2)
+    bounds = np.floor(np.arange(threshold - 1)*every).astype(int) + 1
+    bounds[-1] = n - 1
+    selected = np.empty(threshold, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+    previous = 0
+    for ii in range(threshold - 2):
+        start, stop = bounds[ii], bounds[ii + 1]
+        next_stop = bounds[ii + 2] if ii + 2 < len(bounds) else n
+        mean_x = x[stop:next_stop].mean()
+        mean_y = y[stop:next_stop].mean()
+        area = np.abs((x[previous] - mean_x)*(y[start:stop] - y[previous]) -
+                      (x[previous] - x[start:stop])*(mean_y - y[previous]))
+        previous = start + np.argmax(area)
+        selected[ii + 1] = previous
+    return finite[selected]
+
+
+
+def minmax(y, buckets):
+    """ Min/max bucketing. Returns sorted positions of the smallest and
+    largest value of y in each of buckets equal slices, plus both ends."""
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    if buckets < 1 or n <= 2*buckets:
+        return np.arange(n)
+    edges = np.linspace(0, n, buckets + 1).astype(int)
+    keep = [0, n - 1]
+    for start, stop in zip(edges[:-1], edges[1:]):
+        segment = y[start:stop]
+        if np.isnan(segment).all():
+            continue
+        keep += [start + np.nanargmin(segment), start + np.nanargmax(segment)]
+    return np.unique(keep)
+
+
+
+def downsample(series, points, method='lttb'):
+    """ Reduce series to about points values for drawing, with method
+    'lttb' or 'minmax'. Series at or below points are returned unchanged."""
+    if points is None or len(series) <= points:
+        return series
+    if method == 'lttb':
+        index = series.index
+        x = index.asi8 if isinstance(index, pd.DatetimeIndex) else np.arange(len(series))
+        positions = lttb(x, series.values, points)
+    elif method == 'minmax':
+        positions = minmax(series.values, points//2)
+    else:
+        raise TypeError('Downsampling method {} not supported'.format(method))
+    return series.iloc[positions]
 
 
 
-mpl.rcParams['axes.facecolor'] = 'white'
-mpl.rcParams['axes.grid'] = True
-mpl.rcParams['axes.grid.axis'] = 'y'
-mpl.rcParams['axes.grid.which'] = 'both'
-mpl.rcParams['axes.spines.left'] = False
-mpl.rcParams['axes.spines.right'] = False
-mpl.rcParams['axes.spines.top'] = False
-mpl.rcParams['axes.spines.bottom'] = False
-mpl.rcParams['grid.color'] = '#efeff2'
-mpl.rcParams['lines.linewidth'] = 2
-mpl.rcParams['lines.linestyle'] = '-'
-mpl.rcParams['xtick.direction'] = 'in'
-mpl.rcParams['xtick.labelsize'] = 11
-mpl.rcParams['xtick.major.size'] = 6
-mpl.rcParams['xtick.minor.size'] = 6
-mpl.rcParams['ytick.labelsize'] = 11
-mpl.rcParams['ytick.major.size'] = 0
-mpl.rcParams['ytick.direction'] = 'in'
+class TimeSeriesPlotter:
+    """ Line and bar plots of time series on one axes.
 
+    downsample: None to draw every point, or 'lttb'/'minmax' to reduce lines
+        to about the pixel width of the axes and merge bars narrower than a
+        pixel, keeping draw time and file size flat as history grows.
+    """
 
-class TimeSeriesPlotter:
-    def __init__(self, ax=None, title=None, ylabel=None, fig=None):
+    @styled
+    def __init__(self, ax=None, title=None, ylabel=None, fig=None, downsample=None):
         if ax is None:
             #TODO: Should fig be included?
             fig, ax = plt.subplots(figsize=(12, 5))
@@ -41,17 +149,59 @@ class TimeSeriesPlotter:
         self.ax = ax
         self.title = title
         self.ylabel = ylabel
+        self.downsample = downsample
 
+    @styled
     def plot(self, data, **args):
-        ''' Add line plot of data argument to axis. '''
-        self.ax.plot(data, **args)
+        ''' Add line plot of data argument to axis. Returns the (possibly
+        downsampled) series drawn. '''
+        data = self.draw_line(data, **args)
         self.axes_format()
+        return data
 
+    @styled
     def bar_plot(self, groups, data, **args):
         ''' Add bar plot of data argument indexed by group to axis.'''
-        self.ax.bar(groups, data, **args)
+        self.draw_bars(groups, data, **args)
         self.axes_format()
 
+    def pixel_width(self):
+        """ Width of the axes in device pixels."""
+        return max(1, int(self.ax.get_window_extent().width))
+
+    def draw_line(self, data, **args):
+        """ Draw line of data without reformatting the axes."""
+        if self.downsample is not None:
+            data = downsample(data, self.pixel_width(), self.downsample)
+        self.ax.plot(data, **args)
+        return data
+
+    def draw_bars(self, groups, data, width=0.8, **args):
+        """ Draw bars of data centred on groups as one filled step path
+        instead of a patch per bar. With downsampling, bars are merged into
+        pixel wide buckets keeping the extreme value of each."""
+        if pd.api.types.is_datetime64_any_dtype(groups):
+            positions = mpl.dates.date2num(groups)
+        else:
+            positions = np.asarray(groups, dtype=float)
+        heights = np.asarray(data, dtype=float)
+        left = positions - width/2
+        right = positions + width/2
+
+        buckets = self.pixel_width()
+        if self.downsample is not None and len(heights) > buckets:
+            starts = np.unique(np.linspace(0, len(heights), buckets, endpoint=False).astype(int))
+            stops = np.append(starts[1:], len(heights)) - 1
+            high = np.fmax.reduceat(heights, starts)
+            low = np.fmin.reduceat(heights, starts)
+            heights = np.where(np.abs(low) > np.abs(high), low, high)
+            left, right = left[starts], right[stops]
+
+        args.setdefault('linewidth', 0)
+        edges = np.column_stack([left, right]).ravel()
+        steps = np.column_stack([heights, np.zeros_like(heights)]).ravel()
+        return self.ax.fill_between(edges, steps, step='post', **args)
+
     def axes_format(self):
         """ Internal method that applites plot settings
         and labels to figure."""
@@ -64,13 +214,17 @@ class TimeSeriesPlotter:
 
 
 class DailyPlotter(TimeSeriesPlotter):
-    def __init__(self, ax=None, title=None, ylabel=None):
-        super().__init__(ax, title, ylabel)
+    def __init__(self, ax=None, title=None, ylabel=None, downsample=None):
+        super().__init__(ax, title, ylabel, downsample=downsample)
 
 
+    @instrument.traced
+    @styled
     def summary_plot(self, data, rolling_average, per_capita=False, population=0):
         if per_capita:
             if population is None:
+                population = lookup(data.name)
+            if population is None or pd.isnull(population):
                 raise ArithmeticError('Population value not defined for ' \
                                       'population normalization')
             data = analytics.normalize(data, population)
@@ -82,6 +236,132 @@ class DailyPlotter(TimeSeriesPlotter):
 
 
 
+# Plot kind to (cumulative series attribute, rolling average attribute, ylabel)
+KINDS = {'cases': ('cases_series', 'cases_per_day', 'Cases per Day'),
+         'fatalities': ('fatalities_series', 'fatalities_per_day', 'Fatalities per Day'),
+         'hospitalizations': ('hospitalizations_series', 'hospitalizations_per_day',
+                              'Hospitalizations per Day')}
+
+_templates = {}
+
+
+
+class FigureTemplate:
+    """ Off-screen daily summary figure reused for many entities. The
+    figure, axes, style, locators and formatters are built once; rendering
+    an entity only replaces the data artists and title before saving.
+
+    Figures are drawn on an Agg canvas without pyplot, so templates work in
+    worker processes and never register with the interactive backend.
+    """
+
+    @styled
+    def __init__(self, kind, per_capita=False, figsize=(12, 5), dpi=100, downsample=None):
+        self.kind = kind
+        self.per_capita = per_capita
+        self.series_attr, self.average_attr, ylabel = KINDS[kind]
+        if per_capita:
+            ylabel += ' per Million Residents'
+
+        fig = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(fig)
+        self.plotter = DailyPlotter(fig.add_subplot(), ylabel=ylabel, downsample=downsample)
+        self.plotter.fig = fig
+        self.plotter.axes_format()
+
+
+    @styled
+    def render(self, entity, path):
+        """ Draw the summary plot of entity and save it to path."""
+        ax = self.plotter.ax
+        for artist in ax.lines + ax.patches + ax.collections:
+            artist.remove()
+        # Restart the color cycle so every entity is drawn alike
+        ax.set_prop_cycle(None)
+
+        data = getattr(entity, self.series_attr)
+        rolling_average = getattr(entity, self.average_attr)
+        if self.per_capita:
+            data = analytics.normalize(data, entity.population)
+            rolling_average = analytics.normalize(rolling_average, entity.population)
+
+        daily = data.diff()
+        self.plotter.draw_line(rolling_average)
+        self.plotter.draw_bars(daily.index, daily, width=1, alpha=0.25)
+        ax.set_title(entity.name)
+        ax.relim()
+        ax.autoscale()
+        ax.set_ylim(bottom=0)
+        self.plotter.fig.savefig(path)
+        return path
+
+
+
+def figure_path(directory, entity, kind, fmt='png'):
+    """ Output file for the kind plot of entity."""
+    name = re.sub(r'[^\w-]+', '_', str(entity.name)).strip('_')
+    return str(Path(directory).joinpath('{}_{}.{}'.format(name, kind, fmt)))
+
+
+
+def _render_chunk(entities, kinds, directory, fmt, per_capita, figsize, dpi, downsample):
+    """ Render every kind for a list of entities, reusing this process's
+    templates. Runs in pool workers."""
+    paths = []
+    for kind in kinds:
+        key = (kind, per_capita, figsize, dpi, downsample)
+        if key not in _templates:
+            _templates[key] = FigureTemplate(kind, per_capita, figsize, dpi, downsample)
+        for entity in entities:
+            paths.append(_templates[key].render(entity, figure_path(directory, entity, kind, fmt)))
+    return paths
+
+
+
+@instrument.traced
+def render_many(entities, kinds=('cases', 'fatalities'), directory='figures',
+                fmt='png', per_capita=False, processes=None, figsize=(12, 5), dpi=100,
+                downsample=None):
+    """ Render daily summary plots of many entities to image files.
+
+    Entities are split into chunks rendered by a process pool with the Agg
+    canvas, each worker reusing one figure template per plot kind.
+
+    Arguments:
+        entities: Container objects (e.g. from County.many or State.many)
+        kinds: Plot kinds, keys of KINDS
+        directory: Output directory, created if needed
+        fmt: Image format understood by matplotlib ('png', 'svg', ...)
+        per_capita: Plot data per million residents
+        processes: Worker processes (defaults to the number of CPUs,
+            0 or 1 renders in this process)
+        downsample: None, 'lttb' or 'minmax' (see TimeSeriesPlotter)
+
+    Returns list of written paths.
+    """
+    kinds = [kind.lower() for kind in kinds]
+    for kind in kinds:
+        if kind not in KINDS:
+            raise TypeError('Plot kind {} not supported for rendering'.format(kind))
+    entities = list(entities)
+    Path(directory).mkdir(parents=True, exist_ok=True)
+
+    processes = os.cpu_count() if processes is None else processes
+    if processes <= 1 or len(entities) < 2:
+        return _render_chunk(entities, kinds, directory, fmt, per_capita, figsize, dpi,
+                             downsample)
+
+    # A few chunks per worker balances load while keeping templates reused
+    size = max(1, -(-len(entities)//(processes*4)))
+    chunks = [entities[ii:ii + size] for ii in range(0, len(entities), size)]
+    with ProcessPoolExecutor(processes) as executor:
+        futures = [executor.submit(_render_chunk, chunk, kinds, directory, fmt,
+                                   per_capita, figsize, dpi, downsample)
+                   for chunk in chunks]
+        return [path for future in futures for path in future.result()]
+
+
+
 def series_window(series, start=None, end=None):
     """ Trim series to start/end window."""
     series = series[start:end]
@@ -106,7 +386,9 @@ def axis_date_fmt(gca):
 
 
 
-def plot_compare(classes, datatype, figsize=(12, 5), start=None, end=None):
+@instrument.traced
+@styled
+def plot_compare(classes, datatype, figsize=(12, 5), start=None, end=None, downsample=None):
 
     if datatype.lower() == 'cases':
         attr = 'cases_per_day'
@@ -124,14 +406,15 @@ def plot_compare(classes, datatype, figsize=(12, 5), start=None, end=None):
         raise TypeError('Datatype {} not supported for comparison'.format(datatype))
 
     fig, gca = plt.subplots(figsize=figsize, dpi=80)
-    plotter = TimeSeriesPlotter(fig, gca, title=ylabel, ylabel=ylabel)
+    plotter = TimeSeriesPlotter(gca, title=ylabel, ylabel=ylabel, fig=fig,
+                                downsample=downsample)
 
     for entry in classes:
         series = getattr(entry, attr, None)
         if datatype.lower() != 'case fatality':
             series = analytics.normalize(series, population=entry.population, per=1000000)
         series = series_window(series, start, end)
-        plotter.plot(series, label=entry.name)
+        series = plotter.plot(series, label=entry.name)
         # gca.plot(series, label=entry.name, linewidth=2.5)
         plotter.ax.fill_between(series.index, series, alpha=0.25)
     plotter.ax.legend()
@@ -160,31 +443,21 @@ def plot_compare(classes, datatype, figsize=(12, 5), start=None, end=None):
 # plot_compare([Country(ii) for ii in utils.G7_COUNTRIES], 'fatalities', figsize=(10, 5))
 # plot_compare([analytics.State(ii) for ii in ['Alabama', 'Texas', 'Florida', 'Massachusetts']], 'hospitalizations', figsize=(10, 5))
 
+@instrument.traced
+@styled
 def corr_plot():
     # all_data = pd.read_csv('https://raw.githubusercontent.com/lucascarter0/covid19-analytics/master/us_combined_covid_data.csv')
     # all_data = databases.load_us_database(save=False).reset_index()
-    all_data = pd.read_csv('us_combined_covid_data.csv')
-    all_data = all_data.set_index(['state', 'date'])
-
-    # last_record = datetime.date.today() - datetime.timedelta(1)
-    # vaccinations = all_data.xs(last_record.strftime('%Y-%m-%d'), level=1)['series_complete_yes']
-    last_record = all_data.index[-1][1]
-    vaccinations = all_data.xs(last_record, level=1)['series_complete_yes']
-
-    population = databases.JhuData().us_population(groupby='state')
+    timeline = StateTimeline.load()
 
+    last_record = timeline.last_date
     last_month = last_record - pd.DateOffset(weeks=8)
-    new_df = all_data.reset_index()
-    new_df['date'] = pd.to_datetime(new_df['date'])
-    new_df = new_df.loc[new_df['date'] == pd.to_datetime(last_record)].set_index('state') - new_df.loc[new_df['date'] == last_month].set_index('state')
-    new_df = new_df[['total_hospitalizations', 'total_deaths', 'total_cases']]
-    new_df['total_vaccinated'] = vaccinations
+    new_df = timeline.change(last_month, last_record,
+                             ['total_hospitalizations', 'total_deaths', 'total_cases'])
+    new_df['total_vaccinated'] = timeline.asof(last_record, 'series_complete_yes')['series_complete_yes']
 
     case_fatality = new_df['total_deaths'].divide(new_df['total_cases'])
-
-    population = population.drop([ii for ii in population.index if ii not in new_df.index], axis=0)
-    for column in new_df.columns:
-        new_df[column] = new_df[column].divide(population)
+    new_df = new_df.divide(state_population(new_df.index), axis=0)
 
     _, ax = plt.subplots(figsize=(10, 6))
     ax.scatter(new_df['total_vaccinated'], case_fatality)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Population lookups without network I/O.
+
+State and county populations come from the census estimates bundled with
+the repository (census_county_population_data.csv), loaded once into
+indexed Series keyed by name and by FIPS code. National populations come
+from tables registered with register_national, falling back to countryinfo.
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+
+CENSUS_PATH = Path(__file__).with_name('census_county_population_data.csv')
+
+_census = None
+_national = {}
+
+
+
+class CensusIndex:
+    """ Census population estimates indexed for lookups.
+
+    Attributes:
+        states: Population by state name
+        counties: Population by "County, State" name
+        fips: Population by state/county FIPS code (STATE*1000 + COUNTY,
+            states have county code 0)
+        table: Full census table including REGION and DIVISION codes
+    """
+
+    def __init__(self, path=CENSUS_PATH):
+        table = pd.read_csv(path)
+        table['FIPS'] = table['STATE']*1000 + table['COUNTY']
+        self.table = table
+
+        population = 'POPESTIMATE2019'
+        states = table[table['SUMLEV'] == 40]
+        counties = table[table['SUMLEV'] == 50]
+        self.states = pd.Series(states[population].values,
+                                index=states['STATENAME'].values)
+        self.counties = pd.Series(counties[population].values,
+                                  index=counties['COUNTYNAME'].str.cat(counties['STATENAME'],
+                                                                       sep=', ').values)
+        self.fips = pd.Series(table[population].values, index=table['FIPS'].values)
+
+
+
+def census():
+    """ Census index, read from disk on first use."""
+    global _census
+    if _census is None:
+        _census = CensusIndex()
+    return _census
+
+
+
+def _lookup(table, keys):
+    if np.ndim(keys) == 0:
+        return table.get(keys, np.nan)
+    return table.reindex(list(keys))
+
+
+
+def state_population(names):
+    """ Population of a state name, or Series for a list of names."""
+    return _lookup(census().states, names)
+
+
+
+def county_population(keys):
+    """ Population of a county by "County, State" name or FIPS code, or
+    Series for a list of keys."""
+    index = census()
+    if np.ndim(keys) == 0:
+        return _county(index, keys)
+    keys = list(keys)
+    return pd.Series([_county(index, key) for key in keys], index=keys, dtype=float)
+
+
+
+def _county(index, key):
+    if isinstance(key, str) and key in index.counties.index:
+        return index.counties[key]
+    try:
+        return index.fips.get(int(float(key)), np.nan)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+
+def register_national(table):
+    """ Register national populations, a mapping or Series of country name
+    to population. Later registrations take precedence."""
+    _national.update(dict(table))
+
+
+
+def country_population(names):
+    """ Population of a country, or Series for a list of names. Registered
+    national tables are used first, then countryinfo."""
+    if np.ndim(names) == 0:
+        return _country(names)
+    names = list(names)
+    return pd.Series([_country(name) for name in names], index=names, dtype=float)
+
+
+
+def _country(name):
+    if name in _national:
+        return _national[name]
+    from countryinfo import CountryInfo
+    try:
+        return CountryInfo(name).population()
+    except LookupError:
+        return np.nan
+
+
+
+def lookup(names):
+    """ Population for each name, resolved as a county ("County, State" or
+    FIPS), a state or a country. Returns scalar for one name, otherwise a
+    Series indexed by names."""
+    if np.ndim(names) == 0:
+        return _resolve(names)
+    names = list(names)
+    return pd.Series([_resolve(name) for name in names], index=names, dtype=float)
+
+
+
+def _resolve(name):
+    index = census()
+    if name in index.states.index:
+        return index.states[name]
+    population = _county(index, name)
+    if np.isnan(population):
+        population = _country(name)
+    return population
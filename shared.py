@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Shared-memory datasets for multi-process analytics workers.
+
+A DatasetServer loads the JHU county and state time series and the combined
+US database once and copies their values into multiprocessing shared memory
+blocks. Its handle (block names, shapes, dtypes and the small index
+metadata) is picklable and is passed to worker processes, which attach to
+the blocks zero-copy with attach(). The attached view answers the same
+us_county_table / us_cases / us_fatalities calls as JhuData, so it can be
+passed as the data source of County.many, State.many or RankingIndex, and
+memory use stays flat however many workers attach.
+
+Example:
+    with DatasetServer() as server:
+        with ProcessPoolExecutor(8, initializer=shared.init_worker,
+                                 initargs=(server.handle,)) as pool:
+            pool.map(task, chunks)
+
+    def task(names):
+        counties = analytics.County.many(names, data=shared.dataset())
+"""
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import instrument
+import storage
+from databases import JhuData, CountyTable, in_window, load_us_database
+
+
+
+KINDS = ['cases', 'fatalities']
+
+_attached = {}
+_worker_handle = None
+
+
+
+def _open(name):
+    """ Attach to an existing block without tracking it for cleanup."""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 always tracks, which is harmless for pool workers as
+        # they share the resource tracker of the process owning the blocks
+        return shared_memory.SharedMemory(name=name)
+
+
+
+class DatasetServer:
+    """ Owner of the shared memory blocks of the US datasets.
+
+    Arguments:
+        data: JhuData instance to load the time series from (optional)
+        combined: Also share the combined US database, read from the
+            current local store if there is one (see storage.read_combined),
+            otherwise built with load_us_database
+
+    Blocks are released by close(), or on leaving a with block.
+    """
+
+    @instrument.traced
+    def __init__(self, data=None, combined=True):
+        data = data if data is not None else JhuData()
+        self._blocks = []
+        self.handle = {'arrays': {}, 'meta': {}}
+        try:
+            self._publish(data, combined)
+        except BaseException:
+            self.close()
+            raise
+
+
+    def _publish(self, data, combined):
+        for kind in KINDS:
+            table = data.us_county_table(kind)
+            self._share('county_' + kind, table.values)
+            self.handle['meta']['county_' + kind] = {'names': table.names,
+                                                     'dates': table.dates,
+                                                     'metadata': table.metadata,
+                                                     'population': table.population}
+        for kind, frame in zip(KINDS, [data.us_cases(groupby='state'),
+                                       data.us_fatalities(groupby='state')]):
+            self._share('state_' + kind, frame.to_numpy())
+            self.handle['meta']['state_' + kind] = {'names': frame.index,
+                                                    'columns': frame.columns}
+
+        if combined:
+            if storage.current_store() is not None:
+                frame = storage.read_combined()
+            else:
+                frame = load_us_database(save=False).reset_index()
+            self._share_frame('combined', frame)
+
+
+    def _share(self, key, values):
+        values = np.ascontiguousarray(values)
+        block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        self._blocks.append(block)
+        np.ndarray(values.shape, values.dtype, buffer=block.buf)[...] = values
+        self.handle['arrays'][key] = (block.name, values.shape, values.dtype.str)
+        instrument.count('bytes_shared', values.nbytes)
+
+
+    def _share_frame(self, key, frame):
+        """ Share numeric, datetime and categorical columns of frame; other
+        columns travel with the handle."""
+        columns = {}
+        for column in frame.columns:
+            series = frame[column]
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                self._share('{}/{}'.format(key, column), series.cat.codes.to_numpy())
+                columns[column] = ('category', series.cat.categories)
+            elif pd.api.types.is_numeric_dtype(series) or \
+                    pd.api.types.is_datetime64_dtype(series):
+                self._share('{}/{}'.format(key, column), series.to_numpy())
+                columns[column] = ('array', None)
+            else:
+                columns[column] = ('object', series.to_numpy())
+        self.handle['meta'][key] = {'columns': columns}
+
+
+    @property
+    def nbytes(self):
+        """ Size of the shared blocks in bytes."""
+        return sum(block.size for block in self._blocks)
+
+
+    def close(self):
+        """ Release and unlink every block. Attached workers must be done."""
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+
+class SharedDataset:
+    """ Zero-copy, read-only view of datasets published by a DatasetServer,
+    usable wherever a JhuData instance is expected."""
+
+    def __init__(self, handle):
+        self._handle = handle
+        self._blocks = {}
+        self._tables = {}
+
+
+    def _array(self, key):
+        name, shape, dtype = self._handle['arrays'][key]
+        if name not in self._blocks:
+            self._blocks[name] = _open(name)
+        values = np.ndarray(shape, np.dtype(dtype), buffer=self._blocks[name].buf)
+        values.flags.writeable = False
+        return values
+
+
+    def us_county_table(self, kind='cases'):
+        if kind not in self._tables:
+            meta = self._handle['meta']['county_' + kind]
+            self._tables[kind] = CountyTable.from_arrays(self._array('county_' + kind),
+                                                         meta['names'], meta['dates'],
+                                                         meta['metadata'], meta['population'])
+        return self._tables[kind]
+
+
+    def _us_frame(self, kind, groupby, start, end):
+        if groupby.lower() == 'state':
+            meta = self._handle['meta']['state_' + kind]
+            frame = pd.DataFrame(self._array('state_' + kind), index=meta['names'],
+                                 columns=meta['columns'], copy=False)
+            return frame.loc[:, [in_window(day, start, end) for day in frame.columns]]
+        if groupby.lower() != 'county':
+            raise TypeError('Shared {} by {} not supported, use county or state'
+                            .format(kind, groupby))
+
+        # Assembled like the JHU county frame (metadata then m/d/yy date
+        # columns), which copies; us_county_table is the zero-copy view
+        table = self.us_county_table(kind)
+        keep = np.array([in_window(day, start, end) for day in table.dates], dtype=bool)
+        dates = table.dates[keep]
+        frames = [table.metadata]
+        if table.population is not None:
+            frames.append(table.population.rename('Population'))
+        frames.append(pd.DataFrame(table.values[:, keep], index=table.names,
+                                   columns=['{}/{}/{:%y}'.format(day.month, day.day, day)
+                                            for day in dates]))
+        frame = pd.concat(frames, axis=1)
+        frame.index.name = 'county'
+        return frame
+
+
+    def us_cases(self, groupby='county', start=None, end=None):
+        """ US confirmed cases by county or state, like JhuData.us_cases."""
+        return self._us_frame('cases', groupby, start, end)
+
+
+    def us_fatalities(self, groupby='county', start=None, end=None):
+        """ US fatalities by county or state, like JhuData.us_fatalities."""
+        return self._us_frame('fatalities', groupby, start, end)
+
+
+    def combined(self):
+        """ Combined US database as a flat dataframe (date and state columns)."""
+        if 'combined' not in self._handle['meta']:
+            raise KeyError('Combined US database was not shared')
+        columns = {}
+        for column, (kind, extra) in self._handle['meta']['combined']['columns'].items():
+            if kind == 'category':
+                codes = self._array('combined/' + column)
+                columns[column] = pd.Categorical.from_codes(codes, categories=extra)
+            elif kind == 'array':
+                columns[column] = self._array('combined/' + column)
+            else:
+                columns[column] = extra
+        return pd.DataFrame(columns, copy=False)
+
+
+    def close(self):
+        """ Detach from the shared blocks."""
+        self._tables = {}
+        for block in self._blocks.values():
+            block.close()
+        self._blocks = {}
+
+
+
+def attach(handle):
+    """ Attach to the datasets of a DatasetServer handle. Views are cached
+    per process, so repeated calls are free."""
+    key = tuple(sorted(name for name, _, _ in handle['arrays'].values()))
+    if key not in _attached:
+        _attached[key] = SharedDataset(handle)
+    return _attached[key]
+
+
+
+def init_worker(handle):
+    """ Process pool initializer recording the handle for dataset()."""
+    global _worker_handle
+    _worker_handle = handle
+
+
+
+def dataset():
+    """ Shared datasets of this worker, attached on first use."""
+    if _worker_handle is None:
+        raise RuntimeError('Worker was not initialized with shared.init_worker')
+    return attach(_worker_handle)
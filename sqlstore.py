@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite store for the combined US database and the JHU wide frames.
+
+The store is a single SQLite file in WAL mode, so any number of readers can
+query it while the nightly load_us_database job writes to it. Each write is
+one transaction of batched upserts, and every read runs inside one read
+transaction, so readers see either the previous or the new data, never a
+partial file.
+
+Tables are keyed and clustered on their lookup columns:
+    combined                    (state, date) -> one column per metric
+    state_cases, state_fatalities   (state, date) -> value
+    county_cases, county_fatalities (county, date) -> value
+
+Dates are stored as ISO 'YYYY-MM-DD' text. The time of the last save is
+kept in store_meta, so storage.read_combined can tell which store is newest.
+
+Example:
+    df = databases.load_us_database(fmt='sqlite')
+    sqlstore.read_combined(states=['Texas'], start='2021-06-01')
+    sqlstore.query('SELECT state, MAX(total_cases) FROM combined GROUP BY state')
+"""
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from itertools import islice
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import instrument
+
+
+
+SQLITE_PATH = 'us_combined_covid_data.sqlite'
+COMBINED_TABLE = 'combined'
+META_TABLE = 'store_meta'
+WIDE_TABLES = {'state_cases': 'state', 'state_fatalities': 'state',
+               'county_cases': 'county', 'county_fatalities': 'county'}
+BATCH_SIZE = 50000
+TIMEOUT = 60
+
+
+
+def _quote(name):
+    return '"{}"'.format(str(name).replace('"', '""'))
+
+
+
+def _iso_dates(dates):
+    return pd.DatetimeIndex(pd.to_datetime(dates)).strftime('%Y-%m-%d').tolist()
+
+
+
+def connect(path=None):
+    """ Connection to the store in WAL mode, created if needed.
+    Transactions are managed explicitly (autocommit otherwise)."""
+    connection = sqlite3.connect(str(path or SQLITE_PATH), timeout=TIMEOUT,
+                                 isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    # WAL keeps commits atomic and durable across crashes with NORMAL
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+
+
+def has_store(path=None, table=COMBINED_TABLE):
+    """ True if the store exists and holds table."""
+    path = Path(path or SQLITE_PATH)
+    if not path.exists():
+        return False
+    with snapshot(path) as connection:
+        found = connection.execute("SELECT 1 FROM sqlite_master WHERE type='table' "
+                                   "AND name=?", (table,)).fetchone()
+    return found is not None
+
+
+
+def saved_at(path=None):
+    """ Time of the last committed save to the store (seconds since the
+    epoch), None if there is no store."""
+    if not has_store(path):
+        return None
+    with snapshot(path) as connection:
+        try:
+            row = connection.execute('SELECT value FROM {} WHERE key=?'.format(META_TABLE),
+                                     ('saved',)).fetchone()
+        except sqlite3.OperationalError:
+            row = None
+    if row is not None:
+        return row[0]
+    # Written before saves were recorded: commits land in the WAL file
+    path = str(path or SQLITE_PATH)
+    return max(os.path.getmtime(name) for name in [path, path + '-wal']
+               if os.path.exists(name))
+
+
+
+@contextmanager
+def snapshot(path=None):
+    """ Read-only connection whose queries all see the same committed state
+    of the store, however many writes complete meanwhile."""
+    connection = connect(path)
+    try:
+        connection.execute('PRAGMA query_only=ON')
+        connection.execute('BEGIN')
+        # The read snapshot starts at the first read of the transaction
+        connection.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchall()
+        yield connection
+    finally:
+        if connection.in_transaction:
+            connection.execute('ROLLBACK')
+        connection.close()
+
+
+
+def _create(connection, table, keys, columns):
+    """ Create table clustered on keys if needed and add missing REAL
+    columns."""
+    connection.execute('CREATE TABLE IF NOT EXISTS {} ({}, PRIMARY KEY ({})) '
+                       'WITHOUT ROWID'.format(_quote(table),
+                                              ', '.join('{} TEXT NOT NULL'.format(_quote(key))
+                                                        for key in keys),
+                                              ', '.join(_quote(key) for key in keys)))
+    existing = {row[1] for row in connection.execute('PRAGMA table_info({})'.format(_quote(table)))}
+    for column in columns:
+        if column not in existing:
+            connection.execute('ALTER TABLE {} ADD COLUMN {} REAL'.format(_quote(table),
+                                                                         _quote(column)))
+
+
+
+def _upsert(connection, table, keys, columns, rows):
+    """ Insert rows (key values then column values), replacing the columns
+    of rows whose keys already exist, in batches of BATCH_SIZE."""
+    names = list(keys) + list(columns)
+    statement = 'INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({}) '.format(
+        _quote(table), ', '.join(_quote(name) for name in names),
+        ', '.join('?'*len(names)), ', '.join(_quote(key) for key in keys))
+    if columns:
+        statement += 'DO UPDATE SET ' + ', '.join('{0}=excluded.{0}'.format(_quote(column))
+                                                  for column in columns)
+    else:
+        statement += 'DO NOTHING'
+
+    count = 0
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, BATCH_SIZE))
+        if not batch:
+            break
+        connection.executemany(statement, batch)
+        count += len(batch)
+    instrument.count('rows_upserted', count)
+
+
+
+def _combined_rows(df):
+    """ Key and float columns of a combined frame, as Python values (NaN is
+    stored as NULL)."""
+    data = df.reset_index() if 'date' not in df.columns else df
+    columns = [column for column in data.columns
+               if column not in ('state', 'date')
+               and pd.api.types.is_numeric_dtype(data[column])]
+    values = [data[column].to_numpy(dtype=float).tolist() for column in columns]
+    return columns, zip(data['state'].astype(str).tolist(), _iso_dates(data['date']), *values)
+
+
+
+def _wide_rows(frame):
+    """ (entity, date, value) rows of an entity x date frame, in key order
+    so inserts append to the clustered index."""
+    if frame.index.hasnans or not frame.index.is_unique:
+        raise ValueError('Entity labels must be unique and not null, found {}'.format(
+            frame.index[frame.index.isna() | frame.index.duplicated(keep=False)].tolist()))
+    frame = frame.iloc[np.argsort(frame.index.astype(str).to_numpy(), kind='stable'),
+                       np.argsort(pd.to_datetime(frame.columns).to_numpy(), kind='stable')]
+    names = np.repeat(frame.index.astype(str).to_numpy(dtype=object), frame.shape[1])
+    dates = np.tile(np.array(_iso_dates(frame.columns), dtype=object), frame.shape[0])
+    values = frame.to_numpy(dtype=float).ravel()
+    return zip(names.tolist(), dates.tolist(), values.tolist())
+
+
+
+@instrument.traced
+def save(combined=None, frames=None, path=None):
+    """ Upsert the combined US dataframe (indexed by date, as returned by
+    databases.load_us_database) and JHU wide frames (mapping of table name
+    in WIDE_TABLES to entity x date frame) in one transaction. Returns path
+    written to."""
+    path = str(path or SQLITE_PATH)
+    frames = frames or {}
+    for table in frames:
+        if table not in WIDE_TABLES:
+            raise KeyError('Table {} not supported, use one of {}'.format(table, list(WIDE_TABLES)))
+
+    connection = connect(path)
+    try:
+        # Take the write lock up front so the batch never waits halfway
+        connection.execute('BEGIN IMMEDIATE')
+        connection.execute('CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value REAL)'
+                           .format(META_TABLE))
+        connection.execute('INSERT INTO {} VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET '
+                           'value=excluded.value'.format(META_TABLE), ('saved', time.time()))
+        if combined is not None:
+            columns, rows = _combined_rows(combined)
+            _create(connection, COMBINED_TABLE, ['state', 'date'], columns)
+            _upsert(connection, COMBINED_TABLE, ['state', 'date'], columns, rows)
+        for table, frame in frames.items():
+            key = WIDE_TABLES[table]
+            _create(connection, table, [key, 'date'], ['value'])
+            _upsert(connection, table, [key, 'date'], ['value'], _wide_rows(frame))
+        connection.execute('COMMIT')
+    except BaseException:
+        if connection.in_transaction:
+            connection.execute('ROLLBACK')
+        raise
+    finally:
+        connection.close()
+    return path
+
+
+
+def _where(key, names, start, end):
+    clauses, params = [], []
+    if names is not None:
+        names = [str(name) for name in names]
+        clauses.append('{} IN ({})'.format(_quote(key), ', '.join('?'*len(names))))
+        params += names
+    if start is not None:
+        clauses.append('date >= ?')
+        params.append(pd.Timestamp(start).strftime('%Y-%m-%d'))
+    if end is not None:
+        clauses.append('date <= ?')
+        params.append(pd.Timestamp(end).strftime('%Y-%m-%d'))
+    return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+
+
+@instrument.traced
+def read_combined(path=None, states=None, start=None, end=None, columns=None):
+    """ Read combined US data for states between start and end (inclusive,
+    optional) through the (state, date) key. Returns flat dataframe with
+    typed 'date' and categorical 'state' columns, like
+    storage.read_snapshot."""
+    selected = '*'
+    if columns is not None:
+        columns = list(dict.fromkeys(['state', 'date'] + list(columns)))
+        selected = ', '.join(_quote(column) for column in columns)
+    where, params = _where('state', states, start, end)
+    sql = 'SELECT {} FROM {}{} ORDER BY state, date'.format(selected, _quote(COMBINED_TABLE), where)
+    with snapshot(path) as connection:
+        data = pd.read_sql_query(sql, connection, params=params)
+    data['date'] = pd.to_datetime(data['date'], format='%Y-%m-%d')
+    data['state'] = data['state'].astype('category')
+    return data
+
+
+
+@instrument.traced
+def read_wide(table, names=None, start=None, end=None, path=None):
+    """ Read a JHU wide table (see WIDE_TABLES) back as an entity x date
+    frame, for names (in that order) between start and end (optional)."""
+    if table not in WIDE_TABLES:
+        raise KeyError('Table {} not supported, use one of {}'.format(table, list(WIDE_TABLES)))
+    key = WIDE_TABLES[table]
+    where, params = _where(key, names, start, end)
+    sql = 'SELECT {}, date, value FROM {}{}'.format(_quote(key), _quote(table), where)
+    with snapshot(path) as connection:
+        data = pd.read_sql_query(sql, connection, params=params)
+
+    rows = pd.Categorical(data[key], categories=names) if names is not None \
+        else pd.Categorical(data[key])
+    dates = pd.Categorical(data['date'])
+    values = np.full((len(rows.categories), len(dates.categories)), np.nan)
+    values[rows.codes, dates.codes] = data['value'].to_numpy(dtype=float)
+    return pd.DataFrame(values, index=pd.Index(rows.categories, name=key),
+                        columns=pd.DatetimeIndex(pd.to_datetime(dates.categories,
+                                                                format='%Y-%m-%d'), name='date'))
+
+
+
+def query(sql, params=(), path=None):
+    """ Run a read-only SQL query against the store in one consistent
+    snapshot. Returns dataframe of the result."""
+    with snapshot(path) as connection:
+        return pd.read_sql_query(sql, connection, params=params)
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar snapshot store for the combined US database.
+
+Snapshots are written as a Parquet dataset partitioned by state, with the
+date column stored as datetime and state as a categorical. Readers push
+state and date filters down to the file scan and memory-map the columns
+instead of parsing text. Every save writes a new version directory and
+switches the snapshot path, a symlink, over to it in one rename, so readers
+never see a partial or missing snapshot. CSV output is kept for
+compatibility. Snapshots can also be upserted into the SQLite store of
+sqlstore for concurrent readers.
+
+read_combined is the one entry point for readers of the combined data. It
+reads the store named by COVID19_STORE (or its store argument), otherwise
+whichever of the Parquet snapshot, SQLite store and CSV was saved last.
+"""
+import importlib.util
+import os
+import shutil
+import time
+from pathlib import Path
+
+import pandas as pd
+
+import instrument
+import sqlstore
+
+
+
+PARQUET_PATH = 'us_combined_covid_data.parquet'
+CSV_PATH = 'us_combined_covid_data.csv'
+# Checked without importing pyarrow so importing storage stays cheap
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+DEFAULT_FORMAT = 'parquet' if HAS_PYARROW else 'csv'
+STORES = ('parquet', 'sqlite', 'csv')
+# Store read by read_combined; unset reads the most recently saved one
+STORE = os.environ.get('COVID19_STORE') or None
+
+
+
+def _require_pyarrow():
+    if not HAS_PYARROW:
+        raise ImportError('pyarrow is required for Parquet snapshots, '
+                          'use fmt="csv" or install pyarrow')
+
+
+
+@instrument.traced
+def save_snapshot(df, path=None, fmt=None, frames=None):
+    """ Save combined US dataframe (indexed by date, as returned by
+    databases.load_us_database) to disk. Supported formats are 'parquet'
+    (partitioned by state), 'csv' and 'sqlite' (upserted into the SQLite
+    store, together with the JHU wide frames, see sqlstore.save). Returns
+    path written to."""
+    fmt = (fmt or DEFAULT_FORMAT).lower()
+    if fmt == 'sqlite':
+        return sqlstore.save(df, frames, path)
+    if fmt == 'csv':
+        path = path or CSV_PATH
+        df.to_csv(path)
+        return path
+    if fmt != 'parquet':
+        raise TypeError('Snapshot format {} not supported'.format(fmt))
+
+    _require_pyarrow()
+    path = Path(path or PARQUET_PATH)
+    data = df.reset_index()
+    data['date'] = pd.to_datetime(data['date'])
+    data['state'] = data['state'].astype('category')
+    data = data.sort_values(['state', 'date'])
+
+    # Write a new version next to the target, then switch path over to it
+    # in one rename so readers always find a complete snapshot
+    version = path.with_name('{}.{}'.format(path.name, time.time_ns()))
+    tmp_path = version.with_name(version.name + '.tmp')
+    data.to_parquet(tmp_path, partition_cols=['state'], index=False)
+    os.replace(tmp_path, version)
+    _switch(path, version)
+    _remove_old_versions(path)
+    return str(path)
+
+
+
+def _versions(path):
+    """ Complete snapshot versions written for path, oldest first."""
+    versions = [version for version in path.parent.glob(path.name + '.*')
+                if version.suffix[1:].isdigit() and version.is_dir()]
+    return sorted(versions, key=lambda version: int(version.suffix[1:]))
+
+
+
+def _switch(path, version):
+    """ Point path at version with an atomic rename of a symlink. Where
+    symlinks are unavailable, path is replaced by renames and readers fall
+    back to the newest version in between."""
+    link = path.with_name(path.name + '.link')
+    try:
+        if link.is_symlink():
+            link.unlink()
+        os.symlink(version.name, link, target_is_directory=True)
+    except (OSError, NotImplementedError):
+        if path.is_symlink():
+            path.unlink()
+        elif path.exists():
+            os.replace(path, path.with_name('{}.0'.format(path.name)))
+        os.replace(version, path)
+        return
+    if path.exists() and not path.is_symlink():
+        # Plain directory written before versioned snapshots, kept as the
+        # oldest version so readers fall back to it until the link is in
+        os.replace(path, path.with_name('{}.0'.format(path.name)))
+    os.replace(link, path)
+
+
+
+def _remove_old_versions(path, keep=2):
+    """ Remove all but the newest keep versions, leaving the version a
+    concurrent reader may still be scanning in place."""
+    current = path.resolve() if path.is_symlink() else None
+    versions = [version for version in _versions(path) if version.resolve() != current]
+    for version in versions[:max(len(versions) - keep + 1, 0)]:
+        shutil.rmtree(version, ignore_errors=True)
+
+
+
+def _snapshot_path(path=None):
+    """ Readable snapshot for path: path itself, or the newest complete
+    version while a save is switching over. None if there is neither."""
+    path = Path(path or PARQUET_PATH)
+    if path.exists():
+        # Resolved once, so a scan stays within one version while the
+        # link moves on
+        return path.resolve()
+    versions = _versions(path)
+    return versions[-1] if versions else None
+
+
+
+@instrument.traced
+def read_snapshot(path=None, states=None, start=None, end=None, columns=None):
+    """ Read combined US data from a Parquet snapshot. Only partitions for
+    the requested states and row groups within the start/end dates are read.
+    Returns flat dataframe with typed 'date' and categorical 'state' columns."""
+    _require_pyarrow()
+    snapshot = _snapshot_path(path)
+    if snapshot is None:
+        raise FileNotFoundError('No snapshot at {}'.format(path or PARQUET_PATH))
+
+    filters = []
+    if states is not None:
+        filters.append(('state', 'in', list(states)))
+    if start is not None:
+        filters.append(('date', '>=', pd.Timestamp(start)))
+    if end is not None:
+        filters.append(('date', '<=', pd.Timestamp(end)))
+    if columns is not None:
+        columns = list(dict.fromkeys(['date', 'state'] + list(columns)))
+
+    data = pd.read_parquet(snapshot, columns=columns, filters=filters or None,
+                           memory_map=True)
+    data['state'] = data['state'].astype('category').cat.remove_unused_categories()
+    return data
+
+
+
+def has_snapshot(path=None):
+    """ True if a Parquet snapshot exists and can be read."""
+    return HAS_PYARROW and _snapshot_path(path) is not None
+
+
+
+def _parquet_saved_at(path=None):
+    snapshot = _snapshot_path(path)
+    if snapshot is None or not HAS_PYARROW:
+        return None
+    # Versions are named after the time they were written
+    suffix = snapshot.suffix[1:]
+    return int(suffix)/1e9 if suffix.isdigit() and int(suffix) else snapshot.stat().st_mtime
+
+
+
+def saved_at(store, path=None):
+    """ Time the combined data was last saved to store ('parquet', 'sqlite'
+    or 'csv'), in seconds since the epoch. None if there is no such store."""
+    if store == 'parquet':
+        return _parquet_saved_at(path)
+    if store == 'sqlite':
+        return sqlstore.saved_at(path)
+    if store == 'csv':
+        path = Path(path or CSV_PATH)
+        return path.stat().st_mtime if path.exists() else None
+    raise TypeError('Store {} not supported, use one of {}'.format(store, list(STORES)))
+
+
+
+def current_store(store=None):
+    """ Store read_combined reads: store, else STORE, else the most
+    recently saved of STORES. None if there is none."""
+    store = store or STORE
+    if store is not None:
+        return store if saved_at(store) is not None else None
+    saved = {name: saved_at(name) for name in STORES}
+    saved = {name: when for name, when in saved.items() if when is not None}
+    return max(saved, key=saved.get) if saved else None
+
+
+
+@instrument.traced
+def read_combined(states=None, start=None, end=None, columns=None, store=None):
+    """ Read combined US data from the current store (see current_store),
+    for states between start and end (inclusive, optional). Returns flat
+    dataframe with typed 'date' and categorical 'state' columns. Raises
+    FileNotFoundError if there is no store."""
+    name = current_store(store)
+    if name is None:
+        raise FileNotFoundError('No combined US data saved{}'.format(
+            ' in store ' + (store or STORE) if store or STORE else ''))
+    if name == 'parquet':
+        return read_snapshot(states=states, start=start, end=end, columns=columns)
+    if name == 'sqlite':
+        return sqlstore.read_combined(states=states, start=start, end=end, columns=columns)
+
+    data = pd.read_csv(CSV_PATH, parse_dates=['date'])
+    if states is not None:
+        data = data[data['state'].isin(states)]
+    if start is not None:
+        data = data[data['date'] >= pd.Timestamp(start)]
+    if end is not None:
+        data = data[data['date'] <= pd.Timestamp(end)]
+    if columns is not None:
+        data = data[list(dict.fromkeys(['date', 'state'] + list(columns)))]
+    data = data.reset_index(drop=True)
+    data['state'] = data['state'].astype('category')
+    return data
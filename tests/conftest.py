@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures: a local HTTP stand-in for the remote data sources and an
+isolated download cache.
+"""
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+# Repository modules are imported flat, as the scripts do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import benchmark
+import cache
+
+
+
+class StandIn:
+    """ Local HTTP server answering GET requests from handlers registered
+    per path. A handler takes (query dict, request headers) and returns
+    (status, headers dict, body bytes). Every request is recorded."""
+
+    def __init__(self):
+        self.handlers = {}
+        self.requests = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                stand_in.requests.append((url.path, query, dict(self.headers)))
+                handler = stand_in.handlers.get(url.path)
+                if handler is None:
+                    status, headers, body = 404, {}, b''
+                else:
+                    status, headers, body = handler(query, self.headers)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.server.server_port, path)
+
+
+    def serve(self, path, body, headers=None, status=200):
+        """ Serve fixed content on path."""
+        body = body.encode('utf-8') if isinstance(body, str) else body
+        self.handlers[path] = lambda query, request_headers: (status, headers or {}, body)
+
+
+    def hits(self, path):
+        return sum(1 for request_path, _, _ in self.requests if request_path == path)
+
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+
+@pytest.fixture
+def stand_in():
+    server = StandIn()
+    yield server
+    server.close()
+
+
+
+@pytest.fixture
+def download_cache(tmp_path):
+    """ Empty cache that always revalidates, also installed as the shared
+    cache for loaders that are not given one."""
+    previous = cache.get_cache()
+    download_cache = cache.configure(directory=tmp_path.joinpath('cache'), ttl=0)
+    yield download_cache
+    cache._default_cache = previous
+
+
+
+@pytest.fixture
+def seeded(tmp_path):
+    """ Offline shared cache seeded with synthetic JHU and HealthData.gov
+    fixtures of 30 counties x 60 days. Returns the raw fixtures."""
+    previous = cache.get_cache()
+    yield benchmark.seed_cache(tmp_path.joinpath('seeded'), 30, 60)
+    cache._default_cache = previous
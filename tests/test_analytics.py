@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+import analytics
+from databases import JhuData
+from population import county_population
+
+
+
+NAMES = ['County {}, {}'.format(ii, state) for ii, state in
+         [(0, 'Alabama'), (5, 'California'), (11, 'Georgia')]]
+
+
+
+def test_county_population_from_census_or_jhu(seeded):
+    table = JhuData().us_county_table('fatalities')
+    for name in NAMES:
+        county = analytics.County(name)
+        census = county_population(county.fips)
+        expected = census if not np.isnan(census) else table.population[name]
+        assert county.population == expected
+
+
+
+def test_many_matches_single_counties(seeded):
+    for single, batched in zip([analytics.County(name) for name in NAMES],
+                               analytics.County.many(NAMES)):
+        assert single.name == batched.name
+        assert single.population == batched.population
+        assert single.cases_series.equals(batched.cases_series)
+        assert single.fatalities_per_capita.equals(batched.fatalities_per_capita)
+
+
+
+def test_unknown_county(seeded):
+    with pytest.raises(KeyError):
+        analytics.County('Nowhere, Texas')
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import batch
+
+
+
+DAYS = 90
+
+
+
+def cumulative(daily):
+    return np.cumsum(np.asarray(daily, dtype=float))
+
+
+
+def test_serial_interval_is_a_distribution():
+    weights = batch.serial_interval(4.7, 2.9, days=30)
+    assert weights.sum() == pytest.approx(1.)
+    # Lag k is the pdf at the midpoint k - 0.5
+    assert (weights*(np.arange(1, 31) - 0.5)).sum() == pytest.approx(4.7, abs=0.05)
+
+
+
+def test_constant_incidence_has_rt_one_and_no_growth():
+    cases = cumulative(np.full(DAYS, 200.))
+    result = batch.transmission(cases)
+    assert result['rt'][-1] == pytest.approx(1., abs=0.01)
+    assert result['growth_rate'][-1] == pytest.approx(0.)
+    assert np.isnan(result['doubling_time'][-1])
+
+
+
+def test_exponential_growth_matches_theory():
+    r = 0.05
+    cases = cumulative(100*np.exp(r*np.arange(DAYS)))
+    weights = batch.serial_interval()
+    expected_rt = 1/np.sum(weights*np.exp(-r*np.arange(1, len(weights) + 1)))
+
+    result = batch.transmission(cases)
+    assert result['growth_rate'][-1] == pytest.approx(r)
+    assert result['doubling_time'][-1] == pytest.approx(math.log(2)/r)
+    assert result['rt'][-1] == pytest.approx(expected_rt, rel=0.02)
+
+
+
+def test_no_recent_cases_is_unknown_not_prior():
+    daily = np.r_[np.full(40, 100.), np.zeros(DAYS - 40)]
+    cases = pd.DataFrame([np.zeros(DAYS), cumulative(daily)], index=['none', 'stopped'])
+
+    result = batch.transmission(cases)
+    assert result['rt'].iloc[:, -1].isna().all()
+    assert result['growth_rate'].iloc[:, -1].isna().all()
+    assert batch.reproduction_number(cases).iloc[0].isna().all()
+
+
+
+def test_too_few_cases_are_masked():
+    cases = cumulative(np.full(DAYS, 1.))
+    assert np.isnan(batch.reproduction_number(cases)[-1])
+    assert np.isnan(batch.growth_rate(cases)[-1])
+    # Posterior mean with the gamma(1, 5) prior and 7 cases per window
+    assert batch.reproduction_number(cases, min_cases=1)[-1] == pytest.approx((1 + 7)/(1/5 + 7))
+
+
+
+def test_frame_orientation_and_labels():
+    cases = pd.DataFrame(np.vstack([cumulative(np.full(DAYS, 50.)),
+                                    cumulative(np.full(DAYS, 500.))]),
+                         index=['a', 'b'], columns=pd.date_range('2021-01-01', periods=DAYS))
+    rows = batch.reproduction_number(cases)
+    columns = batch.reproduction_number(cases.T, axis=0)
+    assert rows.index.tolist() == ['a', 'b']
+    pd.testing.assert_frame_equal(rows, columns.T)
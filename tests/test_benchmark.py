@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import benchmark
+import cache
+
+
+
+def test_run_restores_the_shared_cache(download_cache):
+    record = benchmark.run(counties=10, days=20, repeat=1, only=['jhu_parse_us_state'])
+    assert list(record['stages']) == ['jhu_parse_us_state']
+    assert cache.get_cache() is download_cache
+
+
+
+def test_failed_run_restores_the_shared_cache(download_cache, monkeypatch):
+    def fail(fixtures, counties):
+        raise RuntimeError('stage failed')
+
+    monkeypatch.setattr(benchmark, 'stages', fail)
+    with pytest.raises(RuntimeError):
+        benchmark.run(counties=10, days=20, repeat=1)
+    assert cache.get_cache() is download_cache
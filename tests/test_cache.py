@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+
+import cache
+
+
+
+def counting_parser(calls):
+    def parser(buffer):
+        calls.append(1)
+        return buffer.read().decode('utf-8').upper()
+    return parser
+
+
+
+def test_ttl_serves_without_network(tmp_path, stand_in):
+    stand_in.serve('/data.csv', 'a,b\n1,2\n')
+    download_cache = cache.DownloadCache(tmp_path, ttl=60)
+    url = stand_in.url('/data.csv')
+
+    assert download_cache.fetch(url) == b'a,b\n1,2\n'
+    assert download_cache.fetch(url) == b'a,b\n1,2\n'
+    assert stand_in.hits('/data.csv') == 1
+
+
+
+def test_expired_entry_revalidates_with_etag(tmp_path, stand_in):
+    def handler(query, headers):
+        if headers.get('If-None-Match') == '"v1"':
+            return 304, {}, b''
+        return 200, {'ETag': '"v1"'}, b'content'
+    stand_in.handlers['/data.csv'] = handler
+    download_cache = cache.DownloadCache(tmp_path, ttl=0)
+    url = stand_in.url('/data.csv')
+
+    assert download_cache.fetch(url) == b'content'
+    assert download_cache.fetch(url) == b'content'
+    (_, _, first), (_, _, second) = stand_in.requests
+    assert 'If-None-Match' not in first
+    assert second['If-None-Match'] == '"v1"'
+
+
+
+def test_changed_download_is_parsed_again(tmp_path, stand_in):
+    stand_in.serve('/data.csv', 'old')
+    download_cache = cache.DownloadCache(tmp_path, ttl=0)
+    url = stand_in.url('/data.csv')
+    calls = []
+
+    assert download_cache.frame(url, counting_parser(calls)) == 'OLD'
+    assert download_cache.frame(url, counting_parser(calls)) == 'OLD'
+    assert len(calls) == 1
+
+    stand_in.serve('/data.csv', 'new')
+    assert download_cache.frame(url, counting_parser(calls)) == 'NEW'
+    assert len(calls) == 2
+
+
+
+def test_parser_version_invalidates_frames(tmp_path, stand_in):
+    stand_in.serve('/data.csv', 'abc')
+    download_cache = cache.DownloadCache(tmp_path, ttl=60)
+    url = stand_in.url('/data.csv')
+
+    assert download_cache.frame(url, lambda buffer: 'v1', version=1) == 'v1'
+    assert download_cache.frame(url, lambda buffer: 'v2', version=1) == 'v1'
+    assert download_cache.frame(url, lambda buffer: 'v2', version=2) == 'v2'
+
+
+
+def test_offline_serves_stale_and_refuses_missing(tmp_path, stand_in):
+    stand_in.serve('/data.csv', 'cached')
+    url = stand_in.url('/data.csv')
+    cache.DownloadCache(tmp_path, ttl=0).fetch(url)
+
+    offline = cache.DownloadCache(tmp_path, ttl=0, offline=True)
+    assert offline.fetch(url) == b'cached'
+    assert stand_in.hits('/data.csv') == 1
+    with pytest.raises(ConnectionError):
+        offline.fetch(stand_in.url('/other.csv'))
+
+
+
+def test_lru_cap_evicts_least_recently_used(tmp_path, stand_in):
+    for name in 'abc':
+        stand_in.serve('/{}.csv'.format(name), name*1000)
+    download_cache = cache.DownloadCache(tmp_path, ttl=60, max_bytes=2600)
+
+    download_cache.fetch(stand_in.url('/a.csv'))
+    time.sleep(0.01)
+    download_cache.fetch(stand_in.url('/b.csv'))
+    time.sleep(0.01)
+    # Touch a so b is the least recently used
+    download_cache.fetch(stand_in.url('/a.csv'))
+    time.sleep(0.01)
+    download_cache.fetch(stand_in.url('/c.csv'))
+
+    assert download_cache.size() <= 2600
+    assert download_cache.fetch(stand_in.url('/a.csv')) == b'a'*1000
+    assert stand_in.hits('/a.csv') == 1
+    download_cache.fetch(stand_in.url('/b.csv'))
+    assert stand_in.hits('/b.csv') == 2
+
+
+
+def test_clear_tolerates_files_removed_by_another_process(tmp_path, stand_in, monkeypatch):
+    stand_in.serve('/data.csv', 'abc')
+    url = stand_in.url('/data.csv')
+    download_cache = cache.DownloadCache(tmp_path, ttl=60)
+    download_cache.frame(url, lambda buffer: 'parsed')
+    listed = list(tmp_path.glob('*'))
+
+    # Another process sharing the directory removes the files after listing
+    cache.DownloadCache(tmp_path).clear()
+    monkeypatch.setattr(type(tmp_path), 'glob', lambda self, pattern: iter(listed))
+    download_cache._drop_frames(url)
+    download_cache.clear()
+
+
+
+def test_concurrent_hits_and_writes(tmp_path, stand_in):
+    stand_in.serve('/data.csv', 'cached')
+    url = stand_in.url('/data.csv')
+    download_cache = cache.DownloadCache(tmp_path, ttl=60)
+    download_cache.fetch(url)
+    meta_path = download_cache._paths(url)[1]
+    meta = meta_path.read_bytes()
+    errors = []
+
+    def work(thread):
+        try:
+            for ii in range(200):
+                assert download_cache.fetch(url) == b'cached'
+                # Writes to other entries in the same directory meanwhile
+                download_cache.put('mirror://{}/{}'.format(thread, ii % 3), b'x')
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=work, args=(ii,)) for ii in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert stand_in.hits('/data.csv') == 1
+    # Hits mark the entry as used without rewriting its metadata
+    assert meta_path.read_bytes() == meta
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+
+def test_writes_under_the_cap_do_not_scan(tmp_path, monkeypatch):
+    download_cache = cache.DownloadCache(tmp_path, max_bytes=10**6)
+    scans = []
+    entries = download_cache._entries
+    monkeypatch.setattr(download_cache, '_entries', lambda: scans.append(1) or entries())
+
+    for ii in range(200):
+        download_cache.put('mirror://{}'.format(ii), b'x'*100)
+    assert len(scans) == 1
+    assert download_cache.size() <= 10**6
+
+    # Over the cap, the scan evicts down to it
+    download_cache.max_bytes = 5000
+    download_cache.put('mirror://last', b'x'*100)
+    assert download_cache.size() <= 5000
+    assert download_cache.fetch('mirror://last') == b'x'*100
+
+
+
+def test_frame_hit_does_not_read_the_download(tmp_path, stand_in, monkeypatch):
+    stand_in.serve('/data.csv', 'abc')
+    url = stand_in.url('/data.csv')
+    download_cache = cache.DownloadCache(tmp_path, ttl=60)
+    assert download_cache.frame(url, lambda buffer: buffer.read().upper()) == b'ABC'
+
+    def read_bytes(self):
+        raise AssertionError('read {}'.format(self))
+    monkeypatch.setattr(type(tmp_path), 'read_bytes', read_bytes)
+    assert download_cache.frame(url, lambda buffer: 'parsed again') == b'ABC'
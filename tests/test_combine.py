@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import pytest
+
+import databases
+
+
+
+DATES = pd.date_range('2021-01-01', periods=6, name='date')
+
+
+
+def long_source(states, dates, columns, seed):
+    rng = np.random.default_rng(seed)
+    rows = pd.MultiIndex.from_product([states, dates], names=['state', 'date'])
+    frame = pd.DataFrame({column: rng.integers(0, 100, len(rows)).astype(float)
+                          for column in columns}, index=rows)
+    return frame.reset_index('state')
+
+
+
+def wide_source(states, dates, seed):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(rng.integers(0, 100, (len(states), len(dates))).astype(float),
+                        index=pd.Index(states, name='state'),
+                        columns=pd.DatetimeIndex(dates, name='date'))
+
+
+
+@pytest.fixture
+def sources():
+    """ Sources that each miss some states and dates, with a column shared
+    by the hospital and vaccine frames."""
+    hospital = long_source(['Alabama', 'Texas', 'Utah'], DATES[:5], ['beds', 'note'], 0)
+    vaccine = long_source(['Alabama', 'Texas', 'Maine'], DATES[1:], ['doses', 'note'], 1)
+    cases = wide_source(['Alabama', 'Maine', 'Texas', 'Utah'], DATES[:4], 2)
+    deaths = wide_source(['Alabama', 'Texas'], DATES, 3)
+    return hospital, vaccine, cases, deaths
+
+
+
+def merge_chain(hospital, vaccine, cases, deaths, how):
+    """ The pd.merge chain combine_databases replaces."""
+    cases = cases.stack().rename('total_cases').reset_index()
+    deaths = deaths.stack().rename('total_deaths').reset_index()
+    combined = pd.merge(hospital.reset_index(), vaccine.reset_index(),
+                        on=['state', 'date'], how=how)
+    combined = pd.merge(combined, cases, on=['state', 'date'], how=how)
+    return pd.merge(combined, deaths, on=['state', 'date'], how=how)
+
+
+
+def normalized(frame):
+    frame = frame.assign(state=frame['state'].astype(str))
+    frame = frame.sort_values(['state', 'date'], ignore_index=True)
+    return frame[sorted(frame.columns)]
+
+
+
+@pytest.mark.parametrize('how', ['inner', 'left', 'outer'])
+def test_matches_merge_chain(sources, how):
+    combined = databases.combine_databases(*sources, how=how)
+    expected = merge_chain(*sources, how=how)
+    assert {'note_x', 'note_y'} <= set(combined.columns)
+    assert len(combined) == len(expected)
+    pd.testing.assert_frame_equal(normalized(combined), normalized(expected),
+                                  check_dtype=False)
+
+
+
+def test_unknown_join(sources):
+    with pytest.raises(TypeError):
+        databases.combine_databases(*sources, how='right')
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import pytest
+
+import cache
+import databases
+
+
+
+# An early vintage (People_Tested, Mortality_Rate) and a later one
+# (Total_Test_Results, Case_Fatality_Ratio) of the US daily reports
+EARLY = ('\ufeffProvince_State,Country_Region,Confirmed,Deaths,People_Tested,'
+         'People_Hospitalized,Mortality_Rate\n'
+         'Texas,US,100,2,1000,10,2.0\n'
+         'Alabama ,US,50,1,500,,2.0\n')
+LATE = ('Province_State,Country_Region,Confirmed,Deaths,Total_Test_Results,'
+        'Case_Fatality_Ratio,Incident_Rate\n'
+        'Texas,US,200,4,3000,2.0,10.5\n'
+        'Alabama,US,80,2,900,2.5,5.2\n'
+        'Alabama,US,90,2,950,2.2,5.3\n')
+
+
+
+def report(day, confirmed):
+    return ('Province_State,Country_Region,Confirmed,Deaths,Total_Test_Results\n'
+            'Texas,US,{},1,100\n'.format(confirmed)).encode()
+
+
+
+def test_report_vintages_share_columns():
+    early = databases.parse_daily_report('2020-04-12', EARLY.encode('utf-8'))
+    late = databases.parse_daily_report('2021-01-01', LATE.encode())
+    assert early.columns.tolist() == late.columns.tolist() == \
+        ['state', 'date'] + databases.DAILY_REPORT_FIELDS
+
+    early = early.set_index('state')
+    # The byte order mark and padded names do not leak into the panel
+    assert early.index.tolist() == ['Texas', 'Alabama']
+    assert early.loc['Texas', 'total_test_results'] == 1000.
+    assert early.loc['Texas', 'case_fatality_ratio'] == 2.
+    assert np.isnan(early.loc['Alabama', 'people_hospitalized'])
+    assert np.isnan(early.loc['Texas', 'incident_rate'])
+
+    late = late.set_index('state')
+    assert late.loc['Texas', 'total_test_results'] == 3000.
+    # Repeated rows of a state keep the last one
+    assert late.loc['Alabama', 'confirmed'] == 90.
+    assert late['date'].eq(pd.Timestamp('2021-01-01')).all()
+
+
+
+def test_rerun_only_parses_new_and_recent_days(tmp_path, monkeypatch):
+    mirror = tmp_path.joinpath('mirror')
+    mirror.mkdir()
+    days = pd.date_range('2021-01-01', periods=5)
+    for ii, day in enumerate(days[:3]):
+        mirror.joinpath('{:%m-%d-%Y}.csv'.format(day)).write_bytes(report(day, ii))
+
+    parsed = []
+    parse = databases.parse_daily_report
+    monkeypatch.setattr(databases, 'parse_daily_report',
+                        lambda day, content: parsed.append(day) or parse(day, content))
+    jhu = databases.JhuData(download_cache=cache.DownloadCache(tmp_path.joinpath('cache')),
+                            revision_window=1)
+    panel = jhu.daily_reports(source=mirror, processes=0)
+    assert panel.loc['Texas', 'confirmed'].tolist() == [0., 1., 2.]
+    assert parsed == list(days[:3])
+
+    # The last known day is revised and two new days are published
+    for ii, day in enumerate(days[2:]):
+        mirror.joinpath('{:%m-%d-%Y}.csv'.format(day)).write_bytes(report(day, 10 + ii))
+    del parsed[:]
+    panel = jhu.daily_reports(source=mirror, processes=0)
+    assert parsed == list(days[2:])
+    assert panel.loc['Texas', 'confirmed'].tolist() == [0., 1., 10., 11., 12.]
+    assert jhu.daily_reports(source=mirror, start=days[3], processes=0).shape[0] == 2
+
+
+
+def test_window_without_published_reports_is_empty(tmp_path):
+    jhu = databases.JhuData(download_cache=cache.DownloadCache(tmp_path, offline=True))
+    panel = jhu.daily_reports(start='2021-01-01', end='2021-01-03', processes=0)
+    assert panel.empty
+    assert panel.columns.tolist() == databases.DAILY_REPORT_FIELDS
+    assert panel.index.names == ['state', 'date']
+
+
+
+@pytest.mark.parametrize('processes', [0, 2])
+def test_process_pool_matches_serial_parse(tmp_path, processes):
+    mirror = tmp_path.joinpath('mirror')
+    mirror.mkdir()
+    for ii, day in enumerate(pd.date_range('2021-01-01', periods=4)):
+        mirror.joinpath('{:%m-%d-%Y}.csv'.format(day)).write_bytes(report(day, ii))
+    jhu = databases.JhuData(download_cache=cache.DownloadCache(tmp_path.joinpath(str(processes))))
+    panel = jhu.daily_reports(source=mirror, processes=processes)
+    assert panel.loc['Texas', 'confirmed'].tolist() == [0., 1., 2., 3.]
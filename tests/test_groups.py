@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import pytest
+
+import groups
+
+
+
+@pytest.fixture(params=['sparse', 'dense'])
+def grouping(request, monkeypatch):
+    if request.param == 'dense':
+        monkeypatch.setattr(groups, 'sparse', None)
+    elif groups.sparse is None:
+        pytest.skip('scipy not installed')
+    return groups.Grouping('test', {'AB': ['A', 'B'], 'BC': ['B', 'C'], 'CX': ['C', 'X']})
+
+
+
+def wide():
+    return pd.DataFrame([[1., 2.], [10., 20.], [100., np.nan]], index=['A', 'B', 'C'],
+                        columns=pd.date_range('2021-01-01', periods=2))
+
+
+
+def test_totals_match_groupby(grouping):
+    result = grouping.aggregate(wide())
+    assert result['total'].loc['AB'].tolist() == [11., 22.]
+    assert result['total'].loc['BC'].tolist() == [110., 20.]
+    assert grouping.aggregate(wide().T, axis=0)['total'].equals(result['total'].T)
+
+
+
+def test_unmatched_members_are_reported(grouping, capsys):
+    result = grouping.aggregate(wide())
+    assert result['unmatched'] == {'CX': ['X']}
+    assert 'X' in capsys.readouterr().out
+
+
+
+def test_members_without_population_leave_per_capita(grouping):
+    population = pd.Series({'A': 1000., 'B': np.nan, 'C': 0.})
+    result = grouping.aggregate(wide(), population, per=1000)
+
+    # B has no population, so its cases count in total but not per capita
+    assert result['total'].loc['AB'].tolist() == [11., 22.]
+    assert result['per_capita'].loc['AB'].tolist() == [1., 2.]
+    assert result['population'].loc['AB'] == 1000.
+    assert result['no_population'] == {'AB': ['B'], 'BC': ['B', 'C'], 'CX': ['C']}
+    assert result['per_capita'].loc[['BC', 'CX']].isna().all().all()
+
+
+
+def test_eu_members_match_jhu_names():
+    assert 'Czechia' in groups.country_blocs().groups['EU']
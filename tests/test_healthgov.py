@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pandas as pd
+import pytest
+
+import cache
+import databases
+
+
+
+ROWS = [{'date': '2021-01-{:02d}T00:00:00.000'.format(day), 'location': state,
+         'series_complete_yes': str(day*10), 'administered_dose1_recip': str(day*20)}
+        for state in ['TX', 'AL', 'FL'] for day in range(1, 11)]
+
+
+
+class Socrata:
+    """ Socrata endpoint stand-in serving ROWS in $offset/$limit pages.
+    failures maps an offset to the number of 503 responses sent before the
+    page is served; count=False makes the count query fail."""
+
+    def __init__(self, rows=ROWS, count=True, failures=None):
+        self.rows = rows
+        self.count = count
+        self.failures = dict(failures or {})
+
+
+    def __call__(self, query, headers):
+        if query.get('$select') == 'count(*)':
+            if not self.count:
+                return 500, {}, b''
+            return 200, {}, json.dumps([{'count': str(len(self.rows))}]).encode()
+        offset, limit = int(query['$offset']), int(query['$limit'])
+        if self.failures.get(offset, 0) > 0:
+            self.failures[offset] -= 1
+            return 503, {}, b''
+        return 200, {}, json.dumps(self.rows[offset:offset + limit]).encode()
+
+
+
+def pages(stand_in):
+    return sorted(int(query['$offset']) for path, query, _ in stand_in.requests
+                  if '$offset' in query)
+
+
+
+def healthgov(stand_in, tmp_path, **kwargs):
+    download_cache = cache.DownloadCache(tmp_path, ttl=kwargs.pop('ttl', 0))
+    return databases.HealthGovData(download_cache, vaccine_url=stand_in.url('/vaccine.json'),
+                                   hospital_url=stand_in.url('/hospital.json'),
+                                   page_size=7, workers=3, retry_delay=0, **kwargs)
+
+
+
+def test_pages_cover_every_row(stand_in, tmp_path):
+    stand_in.handlers['/vaccine.json'] = Socrata()
+    df = healthgov(stand_in, tmp_path).load_vaccinations()
+
+    assert len(df) == len(ROWS)
+    assert df.index.is_monotonic_increasing
+    assert set(df['state']) == {'Texas', 'Alabama', 'Florida'}
+    assert pages(stand_in) == [0, 7, 14, 21, 28]
+
+
+
+def test_server_errors_are_retried(stand_in, tmp_path):
+    stand_in.handlers['/vaccine.json'] = Socrata(failures={7: 2})
+    df = healthgov(stand_in, tmp_path, retries=3).load_vaccinations()
+
+    assert len(df) == len(ROWS)
+    assert pages(stand_in).count(7) == 3
+
+
+
+def test_retries_give_up(stand_in, tmp_path):
+    stand_in.handlers['/vaccine.json'] = Socrata(failures={7: 5})
+    with pytest.raises(OSError):
+        healthgov(stand_in, tmp_path, retries=1).load_vaccinations()
+
+
+
+def test_rerun_resumes_from_completed_pages(stand_in, tmp_path):
+    stand_in.handlers['/vaccine.json'] = Socrata(failures={14: 5})
+    with pytest.raises(OSError):
+        healthgov(stand_in, tmp_path, retries=0, ttl=3600).load_vaccinations()
+
+    stand_in.requests.clear()
+    stand_in.handlers['/vaccine.json'] = Socrata()
+    df = healthgov(stand_in, tmp_path, retries=0, ttl=3600).load_vaccinations()
+    assert len(df) == len(ROWS)
+    assert pages(stand_in) == [14]
+
+
+
+def test_pages_until_short_without_row_count(stand_in, tmp_path):
+    stand_in.handlers['/vaccine.json'] = Socrata(count=False)
+    df = healthgov(stand_in, tmp_path, retries=0).load_vaccinations()
+
+    assert len(df) == len(ROWS)
+    # Three pages per batch until page 28 comes back short
+    assert pages(stand_in) == [0, 7, 14, 21, 28, 35]
+
+
+
+def test_endpoint_without_rows(stand_in, tmp_path):
+    stand_in.handlers['/vaccine.json'] = Socrata(rows=[])
+    stand_in.handlers['/hospital.json'] = Socrata(rows=[])
+    data = healthgov(stand_in, tmp_path)
+
+    vaccinations = data.load_vaccinations()
+    hospitalizations = data.load_hosptializations()
+    assert len(vaccinations) == 0 and 'series_complete_yes' in vaccinations.columns
+    assert len(hospitalizations) == 0 and 'total_hospitalizations' in hospitalizations.columns
+    assert isinstance(vaccinations.index, pd.DatetimeIndex)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import io
+
+import pandas as pd
+import pytest
+
+import benchmark
+import cache
+import databases
+
+
+
+START, END = '2020-03-01', '2020-03-10'
+
+
+
+def jhu_with(tmp_path, name, content, **kwargs):
+    """ JhuData over an offline cache holding content as the US cases."""
+    download_cache = cache.DownloadCache(tmp_path.joinpath(name), offline=True, max_bytes=None)
+    jhu = databases.JhuData(download_cache=download_cache, **kwargs)
+    download_cache.put(jhu._us_url('cases'), content)
+    return jhu
+
+
+
+@pytest.fixture
+def downloads():
+    """ An earlier download of 70 days, and a later one of 80 days that also
+    revises day 68."""
+    frame = pd.read_csv(io.BytesIO(benchmark.jhu_us_fixture(40, 80)))
+    metadata = 11
+    earlier = frame.iloc[:, :metadata + 70].to_csv(index=False).encode()
+    frame.iloc[:, metadata + 67] += 3
+    return earlier, frame.to_csv(index=False).encode()
+
+
+
+@pytest.mark.parametrize('groupby', ['county', 'state'])
+def test_incremental_refresh_equals_full_parse(tmp_path, downloads, groupby):
+    earlier, later = downloads
+    jhu = jhu_with(tmp_path, 'incremental', earlier, incremental=True, revision_window=5)
+    assert len(databases.date_labels(jhu.us_cases(groupby=groupby).columns)) == 70
+    jhu._cache.put(jhu._us_url('cases'), later)
+
+    expected = jhu_with(tmp_path, 'full', later).us_cases(groupby=groupby)
+    pd.testing.assert_frame_equal(jhu.us_cases(groupby=groupby), expected)
+
+
+
+@pytest.mark.parametrize('groupby', ['county', 'state'])
+def test_windowed_load_equals_sliced_full_load(tmp_path, downloads, groupby):
+    jhu = jhu_with(tmp_path, 'window', downloads[1])
+    full = jhu.us_cases(groupby=groupby)
+    dates = databases.date_labels(full.columns)
+    keep = [label for label in full.columns
+            if label not in dates or databases.in_window(dates[label], START, END)]
+
+    windowed = jhu.us_cases(groupby=groupby, start=START, end=END)
+    pd.testing.assert_frame_equal(windowed, full[keep])
+    assert len(databases.date_labels(windowed.columns)) == 10
+
+
+
+def test_incremental_windowed_load(tmp_path, downloads):
+    jhu = jhu_with(tmp_path, 'both', downloads[1], incremental=True)
+    expected = jhu_with(tmp_path, 'plain', downloads[1]).us_cases(groupby='state', start=START,
+                                                                 end=END)
+    pd.testing.assert_frame_equal(jhu.us_cases(groupby='state', start=START, end=END), expected)
+
+
+
+def test_county_table_lookups(seeded):
+    table = databases.JhuData().us_county_table('cases')
+    name = table.names[3]
+    fips = int(table.metadata['FIPS'].iloc[3])
+    assert table.locate(name) == table.locate(fips) == table.locate(str(fips)) == 3
+    assert table.series(name).equals(table.frame([name]).iloc[0])
+    with pytest.raises(KeyError):
+        table.locate('Nowhere, Texas')
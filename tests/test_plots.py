@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import analytics
+import plots
+
+
+
+class Entity:
+    """ Picklable stand-in for a Container with cumulative series and
+    rolling averages."""
+
+    def __init__(self, name, seed):
+        rng = np.random.default_rng(seed)
+        dates = pd.date_range('2021-01-01', periods=60)
+        for kind, scale in [('cases', 100), ('fatalities', 2)]:
+            series = pd.Series(np.cumsum(rng.poisson(scale, len(dates))), index=dates,
+                               dtype=float)
+            setattr(self, kind + '_series', series)
+            setattr(self, kind + '_per_day', series.diff().rolling(7).mean())
+        self.name = name
+        self.population = 10000.
+
+
+
+@pytest.mark.parametrize('processes', [0, 2])
+def test_render_many_writes_one_file_per_entity_and_kind(tmp_path, processes):
+    entities = [Entity('County {}, Texas'.format(ii), ii) for ii in range(5)]
+    paths = plots.render_many(entities, directory=tmp_path, processes=processes)
+
+    expected = [plots.figure_path(tmp_path, entity, kind)
+                for kind in ['cases', 'fatalities'] for entity in entities]
+    assert sorted(paths) == sorted(expected)
+    assert sorted(str(path) for path in tmp_path.iterdir()) == sorted(expected)
+    assert all(Path(path).stat().st_size > 0 for path in paths)
+
+
+
+def test_template_reuse_draws_each_entity_alone(tmp_path):
+    template = plots.FigureTemplate('cases', downsample='lttb')
+    for ii in range(3):
+        template.render(Entity('County {}, Utah'.format(ii), ii),
+                        tmp_path.joinpath('{}.svg'.format(ii)))
+        ax = template.plotter.ax
+        # One average line and one bar path, whatever was drawn before
+        assert len(ax.lines) == 1 and len(ax.collections) == 1
+        assert ax.get_title() == 'County {}, Utah'.format(ii)
+
+
+
+def test_render_many_counties(tmp_path, seeded):
+    counties = analytics.County.many(['County 0, Alabama', 'County 5, California'])
+    paths = plots.render_many(counties, kinds=['Cases'], directory=tmp_path, fmt='svg',
+                              per_capita=True, processes=0)
+    assert [Path(path).name for path in paths] == ['County_0_Alabama_cases.svg',
+                                                   'County_5_California_cases.svg']
+    with pytest.raises(TypeError):
+        plots.render_many(counties, kinds=['vaccinations'], directory=tmp_path)
+
+
+
+def signal(n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    y = np.sin(np.linspace(0, 20, n)) + rng.normal(0, 0.1, n)
+    y[700], y[1300] = 10., -10.
+    return y
+
+
+
+def test_lttb_keeps_endpoints_and_spikes():
+    y = signal()
+    y[5] = np.nan
+    positions = plots.lttb(np.arange(len(y)), y, 100)
+    assert len(positions) == 100
+    assert positions[0] == 0 and positions[-1] == len(y) - 1
+    assert (np.diff(positions) > 0).all()
+    assert {700, 1300} <= set(positions)
+    assert 5 not in positions
+    # Short series are kept whole
+    assert plots.lttb(np.arange(50), y[:50], 100).tolist() == [ii for ii in range(50) if ii != 5]
+
+
+
+def test_minmax_keeps_endpoints_and_bucket_extremes():
+    y = signal()
+    positions = plots.minmax(y, 50)
+    assert positions[0] == 0 and positions[-1] == len(y) - 1
+    assert len(positions) <= 2*50 + 2
+    edges = np.linspace(0, len(y), 51).astype(int)
+    for start, stop in zip(edges[:-1], edges[1:]):
+        kept = y[positions[(positions >= start) & (positions < stop)]]
+        assert kept.max() == y[start:stop].max() and kept.min() == y[start:stop].min()
+
+
+
+def test_downsample_series(tmp_path):
+    series = pd.Series(signal(), index=pd.date_range('2015-01-01', periods=2000))
+    for method in ['lttb', 'minmax']:
+        drawn = plots.downsample(series, 200, method)
+        assert len(drawn) <= 202
+        assert drawn.max() == 10. and drawn.min() == -10.
+        assert drawn.index[0] == series.index[0] and drawn.index[-1] == series.index[-1]
+    assert plots.downsample(series, 5000) is series
+    with pytest.raises(TypeError):
+        plots.downsample(series, 200, 'mean')
+
+
+
+@pytest.mark.parametrize('method', [None, 'minmax'])
+def test_draw_bars_is_one_path_keeping_extremes(method):
+    figure = plots.Figure(figsize=(4, 2), dpi=100)
+    plots.FigureCanvasAgg(figure)
+    plotter = plots.TimeSeriesPlotter(figure.add_subplot(), fig=figure, downsample=method)
+    dates = pd.date_range('2015-01-01', periods=3000)
+    heights = np.abs(signal(3000))
+
+    bars = plotter.draw_bars(dates, heights, width=1)
+    vertices = bars.get_paths()[0].vertices
+    assert len(plotter.ax.collections) == 1 and not plotter.ax.patches
+    assert vertices[:, 1].max() == heights.max()
+    if method is None:
+        assert len(vertices) >= 4*len(heights)
+    else:
+        # Merged into pixel wide buckets, a few vertices each
+        assert len(vertices) < len(heights)
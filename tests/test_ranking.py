@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import pytest
+
+from ranking import RankingIndex
+
+
+
+NAMES = ['Autauga, Alabama', 'Unassigned, Alabama', 'Harris, Texas',
+         'Travis, Texas', 'Out of TX, Texas']
+DATES = pd.date_range('2021-01-01', periods=20)
+
+
+
+@pytest.fixture
+def index():
+    # Daily cases grow with the row number, so per-capita rates are known
+    daily = np.array([[10.], [50.], [300.], [40.], [25.]])*np.ones((1, len(DATES)))
+    cumulative = pd.DataFrame(daily.cumsum(axis=1), index=NAMES, columns=DATES)
+    population = pd.Series({'Autauga, Alabama': 10000., 'Unassigned, Alabama': 0.,
+                            'Harris, Texas': 100000., 'Travis, Texas': 20000.,
+                            'Out of TX, Texas': 0.})
+    return RankingIndex(cumulative, population, window=7, per=1000)
+
+
+
+def test_top_and_bottom_order(index):
+    top = index.top(DATES[-1], 3)
+    assert top.index.tolist() == ['Harris, Texas', 'Travis, Texas', 'Autauga, Alabama']
+    assert top.tolist() == pytest.approx([3., 2., 1.])
+    assert index.bottom(DATES[-1], 1).index.tolist() == ['Autauga, Alabama']
+
+
+
+def test_zero_population_rows_never_rank(index):
+    top = index.top(DATES[-1], 10)
+    assert 'Unassigned, Alabama' not in top.index
+    assert 'Out of TX, Texas' not in top.index
+    assert np.isfinite(top).all()
+    assert 'Unassigned, Alabama' not in index.bottom(DATES[-1], 10).index
+
+
+
+def test_percentiles_ignore_rows_without_rate(index):
+    assert index.percentile(DATES[-1], 99) == pytest.approx(np.percentile([1., 2., 3.], 99))
+    ranks = index.percentile_rank(DATES[-1])
+    assert ranks['Harris, Texas'] == 100.
+    assert np.isnan(ranks['Unassigned, Alabama'])
+
+
+
+def test_state_filter_and_date_range(index):
+    top = index.top(DATES[10], 5, end=DATES[-1], states=['Alabama'])
+    assert top.index.tolist() == ['Autauga, Alabama']
+    with pytest.raises(KeyError):
+        index.top('2020-01-01', 5)
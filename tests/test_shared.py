@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+import pytest
+
+import shared
+from databases import JhuData
+
+
+
+@pytest.fixture
+def dataset(seeded):
+    with shared.DatasetServer(JhuData(), combined=False) as server:
+        dataset = shared.SharedDataset(server.handle)
+        yield dataset
+        dataset.close()
+
+
+
+@pytest.mark.parametrize('kind', ['cases', 'fatalities'])
+@pytest.mark.parametrize('groupby', ['county', 'state'])
+def test_frames_match_jhu(dataset, kind, groupby):
+    expected = getattr(JhuData(), 'us_' + kind)(groupby=groupby)
+    pd.testing.assert_frame_equal(getattr(dataset, 'us_' + kind)(groupby=groupby), expected,
+                                  check_dtype=False, check_index_type=False,
+                                  check_column_type=False, check_categorical=False)
+
+
+
+def test_default_groupby_and_window_match_jhu(dataset):
+    jhu = JhuData()
+    assert dataset.us_cases().shape == jhu.us_cases().shape
+    window = dict(start='2020-02-01', end='2020-02-10')
+    assert list(dataset.us_cases(groupby='state', **window).columns) == \
+        list(pd.date_range(**window))
+    assert dataset.us_fatalities(**window).shape[1] == jhu.us_fatalities(**window).shape[1]
+
+
+
+def test_unsupported_groupby(dataset):
+    with pytest.raises(TypeError):
+        dataset.us_cases(groupby='country')
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import storage
+
+pytest.importorskip('pyarrow')
+
+
+
+def combined(value=1.):
+    dates = pd.date_range('2021-01-01', periods=10)
+    frame = pd.DataFrame({'date': np.tile(dates, 3),
+                          'state': np.repeat(['Alabama', 'Florida', 'Texas'], 10),
+                          'total_cases': value})
+    return frame.set_index('date')
+
+
+
+def test_snapshot_round_trip_with_filters(tmp_path):
+    path = tmp_path.joinpath('snapshot.parquet')
+    storage.save_snapshot(combined(), path=path, fmt='parquet')
+
+    data = storage.read_snapshot(path, states=['Texas'], start='2021-01-05')
+    assert list(data['state'].unique()) == ['Texas']
+    assert data['date'].min() == pd.Timestamp('2021-01-05')
+    assert len(data) == 6
+
+
+
+def test_save_replaces_snapshot_and_keeps_one_previous_version(tmp_path):
+    path = tmp_path.joinpath('snapshot.parquet')
+    for value in range(4):
+        storage.save_snapshot(combined(value), path=path, fmt='parquet')
+
+    assert (storage.read_snapshot(path)['total_cases'] == 3).all()
+    assert len(storage._versions(path)) == 2
+
+
+
+def test_plain_directory_snapshot_is_migrated(tmp_path):
+    path = tmp_path.joinpath('snapshot.parquet')
+    combined(1.).reset_index().to_parquet(path, partition_cols=['state'], index=False)
+
+    storage.save_snapshot(combined(2.), path=path, fmt='parquet')
+    assert (storage.read_snapshot(path)['total_cases'] == 2).all()
+
+
+
+def test_readers_fall_back_to_newest_version(tmp_path):
+    path = tmp_path.joinpath('snapshot.parquet')
+    storage.save_snapshot(combined(1.), path=path, fmt='parquet')
+    storage.save_snapshot(combined(2.), path=path, fmt='parquet')
+
+    # As seen by a reader between two renames, or after a crash there
+    os.unlink(path)
+    assert storage.has_snapshot(path)
+    assert (storage.read_snapshot(path)['total_cases'] == 2).all()
+
+
+
+def test_concurrent_readers_always_find_a_snapshot(tmp_path):
+    path = tmp_path.joinpath('snapshot.parquet')
+    storage.save_snapshot(combined(0.), path=path, fmt='parquet')
+    errors = []
+    done = threading.Event()
+
+    def read():
+        while not done.is_set():
+            try:
+                assert storage.has_snapshot(path)
+                assert len(storage.read_snapshot(path)) == 30
+            except Exception as error:
+                errors.append(error)
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    for value in range(1, 8):
+        storage.save_snapshot(combined(value), path=path, fmt='parquet')
+    done.set()
+    reader.join()
+    assert errors == []
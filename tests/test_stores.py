@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import analytics
+import benchmark
+import cache
+import shared
+import sqlstore
+import storage
+from databases import JhuData
+from timeline import StateTimeline
+
+
+
+def combined(value):
+    dates = pd.date_range('2021-01-01', periods=10)
+    frame = pd.DataFrame({'date': np.tile(dates, 2),
+                          'state': np.repeat(['Florida', 'Texas'], 10),
+                          'positiveIncrease': value, 'total_cases': value,
+                          'total_deaths': value, 'total_hospitalizations': value,
+                          'series_complete_yes': value, 'administered_dose1_recip': value})
+    return frame.set_index('date')
+
+
+
+@pytest.fixture
+def directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(storage, 'STORE', None)
+    return tmp_path
+
+
+
+def test_no_store(directory):
+    assert storage.current_store() is None
+    with pytest.raises(FileNotFoundError):
+        storage.read_combined()
+
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'sqlite', 'parquet'])
+def test_single_store_serves_every_reader(directory, seeded, fmt):
+    if fmt == 'parquet':
+        pytest.importorskip('pyarrow')
+    storage.save_snapshot(combined(3.), fmt=fmt)
+    assert storage.current_store() == fmt
+
+    data = storage.read_combined(states=['Texas'], start='2021-01-05')
+    assert len(data) == 6 and (data['total_cases'] == 3).all()
+    assert StateTimeline.load().latest(['total_cases']).iloc[:, 0].tolist() == [3., 3.]
+    assert analytics.State('Florida').cases_series.iloc[-1] == 3.
+    with shared.DatasetServer(JhuData()) as server:
+        dataset = shared.SharedDataset(server.handle)
+        assert (dataset.combined()['total_cases'] == 3).all()
+        dataset.close()
+
+
+
+def test_most_recent_store_wins(directory):
+    storage.save_snapshot(combined(1.), fmt='sqlite')
+    storage.save_snapshot(combined(2.), fmt='csv')
+    assert storage.current_store() == 'csv'
+    assert (storage.read_combined()['total_cases'] == 2).all()
+
+    # A later save to the SQLite store makes the CSV the stale one
+    sqlstore.save(combined(4.))
+    assert storage.current_store() == 'sqlite'
+    assert (storage.read_combined()['total_cases'] == 4).all()
+
+
+
+def test_configured_store_wins(directory, monkeypatch):
+    storage.save_snapshot(combined(1.), fmt='sqlite')
+    storage.save_snapshot(combined(2.), fmt='csv')
+    assert (storage.read_combined(store='sqlite')['total_cases'] == 1).all()
+
+    monkeypatch.setattr(storage, 'STORE', 'sqlite')
+    assert storage.current_store() == 'sqlite'
+    monkeypatch.setattr(storage, 'STORE', 'parquet')
+    with pytest.raises(FileNotFoundError):
+        storage.read_combined()
+
+
+
+def test_county_rows_without_admin2_round_trip(directory, tmp_path):
+    # Territories and cruise ships have a blank Admin2 in the JHU US series
+    frame = pd.read_csv(io.BytesIO(benchmark.jhu_us_fixture(10, 20)))
+    frame.loc[[0, 1], 'Admin2'] = np.nan
+    frame.loc[[0, 1], 'Province_State'] = ['American Samoa', 'Diamond Princess']
+    download_cache = cache.DownloadCache(tmp_path.joinpath('cache'), offline=True)
+    jhu = JhuData(download_cache=download_cache)
+    download_cache.put(jhu._us_url('cases'), frame.to_csv(index=False).encode())
+
+    counties = jhu.us_county_table('cases').frame()
+    assert counties.index[:2].tolist() == ['American Samoa', 'Diamond Princess']
+    sqlstore.save(frames={'county_cases': counties})
+    read = sqlstore.read_wide('county_cases', names=counties.index.tolist())
+    np.testing.assert_array_equal(read.to_numpy(), counties.to_numpy(dtype=float))
+
+
+
+def test_wide_rows_need_unique_labels(directory):
+    frame = pd.DataFrame([[1.], [2.]], index=['A', np.nan],
+                         columns=pd.date_range('2021-01-01', periods=1))
+    with pytest.raises(ValueError):
+        sqlstore.save(frames={'county_cases': frame})
+    with pytest.raises(ValueError):
+        sqlstore.save(frames={'county_cases': frame.set_axis(['A', 'A'])})
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import pytest
+
+from timeline import StateTimeline
+
+
+
+DATES = pd.date_range('2021-01-01', periods=30)
+# Dates before the first record, inside gaps and after the last record
+QUERIES = pd.DatetimeIndex(['2020-12-25', '2021-01-01', '2021-01-08', '2021-01-15',
+                            '2021-01-22', '2021-01-30', '2021-03-01'])
+
+
+
+@pytest.fixture
+def data():
+    """ Shuffled records of states that start late, stop early or skip
+    days, with missing values."""
+    rng = np.random.default_rng(0)
+    records = []
+    for state, first, last in [('Alabama', 0, 30), ('Texas', 5, 30), ('Utah', 0, 20),
+                               ('Maine', 10, 11)]:
+        for day in DATES[first:last]:
+            if rng.random() < 0.3 and state != 'Maine':
+                continue
+            records.append({'state': state, 'date': day,
+                            'total_cases': rng.integers(0, 1000),
+                            'total_deaths': rng.integers(0, 10) if rng.random() < 0.7 else np.nan})
+    frame = pd.DataFrame(records)
+    return frame.sample(frac=1, random_state=1, ignore_index=True)
+
+
+
+def brute_asof(data, date, column, skipna=False, exact=False):
+    """ As-of values of one column by scanning every state's records."""
+    result = {}
+    for state, records in data.sort_values('date').groupby('state'):
+        records = records[records['date'] <= date]
+        if exact:
+            found = records['date'] == date
+            values = records[column].ffill() if skipna else records[column]
+            result[state] = values[found].iloc[-1] if found.any() else np.nan
+        elif skipna:
+            values = records[column].dropna()
+            result[state] = values.iloc[-1] if len(values) else np.nan
+        else:
+            result[state] = records[column].iloc[-1] if len(records) else np.nan
+    return pd.Series(result, dtype=float)
+
+
+
+@pytest.mark.parametrize('skipna', [False, True])
+@pytest.mark.parametrize('exact', [False, True])
+def test_asof_matches_scan(data, skipna, exact):
+    timeline = StateTimeline(data)
+    for date in QUERIES:
+        result = timeline.asof(date, skipna=skipna, exact=exact)
+        for column in ['total_cases', 'total_deaths']:
+            expected = brute_asof(data, date, column, skipna, exact)
+            pd.testing.assert_series_equal(result[column], expected[result.index],
+                                           check_names=False)
+
+
+
+@pytest.mark.parametrize('skipna', [False, True])
+def test_change_and_at_match_scan(data, skipna):
+    timeline = StateTimeline(data)
+    for start, end in zip(QUERIES[:-1], QUERIES[1:]):
+        change = timeline.change(start, end, ['total_deaths'], skipna=skipna)['total_deaths']
+        expected = brute_asof(data, end, 'total_deaths', skipna) \
+            - brute_asof(data, start, 'total_deaths', skipna)
+        pd.testing.assert_series_equal(change, expected[change.index], check_names=False)
+
+    table = timeline.at(QUERIES, 'total_cases', skipna=skipna)
+    for date in QUERIES:
+        expected = brute_asof(data, date, 'total_cases', skipna)
+        pd.testing.assert_series_equal(table[date], expected[table.index], check_names=False)
+
+
+
+def test_latest_and_bounds(data):
+    timeline = StateTimeline(data)
+    assert timeline.first_date == DATES[0]
+    assert timeline.last_date == data['date'].max()
+    pd.testing.assert_frame_equal(timeline.latest(['total_cases'], states=['Utah', 'Maine']),
+                                  timeline.asof(QUERIES[-1], ['total_cases'],
+                                                states=['Utah', 'Maine'], skipna=True))
+    assert timeline.asof(QUERIES[0]).isna().all().all()
+
+
+
+def test_unknown_state_or_column(data):
+    timeline = StateTimeline(data)
+    with pytest.raises(KeyError):
+        timeline.asof(DATES[0], states=['Ohio'])
+    with pytest.raises(KeyError):
+        timeline.asof(DATES[0], columns=['positiveIncrease'])
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Point-in-time queries over the combined US state x date data.
+
+StateTimeline sorts the combined data once by state and date and keeps a
+single sorted integer key per row (state code and day number). "Value as of
+date D", "change between D1 and D2" and "latest available value" for every
+state and any set of columns are then answered with one binary search
+(np.searchsorted) per state instead of scanning and masking the full frame.
+
+Example:
+    timeline = StateTimeline.load()
+    timeline.change('2021-06-01', '2021-07-27', ['total_cases', 'total_deaths'])
+    timeline.latest(['series_complete_yes'], states=['Texas', 'Ohio'])
+"""
+import numpy as np
+import pandas as pd
+
+import instrument
+import storage
+
+
+
+class StateTimeline:
+    """ As-of index over combined data with 'state' and 'date' columns (or
+    index levels) and numeric value columns, such as the frame saved by
+    databases.load_us_database.
+    """
+
+    @instrument.traced
+    def __init__(self, data):
+        if 'state' not in data.columns or 'date' not in data.columns:
+            data = data.reset_index()
+        states = pd.Categorical(data['state'])
+        days = pd.to_datetime(data['date']).to_numpy().astype('datetime64[D]').astype(np.int64)
+        order = np.lexsort((days, states.codes))
+
+        self.states = pd.Index(states.categories, name='state')
+        self.columns = pd.Index([column for column in data.columns
+                                 if column not in ('state', 'date')
+                                 and pd.api.types.is_numeric_dtype(data[column])])
+        self._codes = states.codes[order].astype(np.int64)
+        self._days = days[order]
+        self._first = self._days.min() if len(self._days) else 0
+        self._span = (self._days.max() - self._first + 2) if len(self._days) else 2
+        self._keys = self._codes*self._span + self._days - self._first
+        self._starts = np.searchsorted(self._codes, np.arange(len(self.states)))
+        self._values = data[self.columns].to_numpy(dtype=float)[order]
+        self._filled = None
+
+
+    @classmethod
+    def load(cls, store=None):
+        """ Timeline of the combined data in the current local store (see
+        storage.read_combined)."""
+        return cls(storage.read_combined(store=store))
+
+
+    @property
+    def first_date(self):
+        return pd.Timestamp(self._first, unit='D')
+
+
+    @property
+    def last_date(self):
+        return pd.Timestamp(self._first + self._span - 2, unit='D')
+
+
+    def _state_codes(self, states):
+        if states is None:
+            return np.arange(len(self.states))
+        codes = self.states.get_indexer(list(states))
+        if (codes < 0).any():
+            raise KeyError([state for state, code in zip(states, codes) if code < 0])
+        return codes
+
+
+    def _column_positions(self, columns):
+        if columns is None:
+            return self.columns, np.arange(len(self.columns))
+        columns = pd.Index([columns] if isinstance(columns, str) else list(columns))
+        positions = self.columns.get_indexer(columns)
+        if (positions < 0).any():
+            raise KeyError(list(columns[positions < 0]))
+        return columns, positions
+
+
+    def _rows(self, codes, dates, exact=False):
+        """ Row of the last record on or before each date (states x dates),
+        -1 where a state has none."""
+        days = pd.DatetimeIndex(dates).to_numpy().astype('datetime64[D]').astype(np.int64)
+        offsets = np.clip(days - self._first, -1, self._span - 2)
+        targets = codes[:, np.newaxis]*self._span + offsets[np.newaxis, :]
+        rows = np.searchsorted(self._keys, targets, side='right') - 1
+        found = rows >= self._starts[codes][:, np.newaxis]
+        if exact:
+            found &= self._keys[np.maximum(rows, 0)] == codes[:, np.newaxis]*self._span \
+                + (days - self._first)[np.newaxis, :]
+        return np.where(found, rows, -1)
+
+
+    def _table(self, skipna):
+        if not skipna:
+            return self._values
+        if self._filled is None:
+            # Carry each column's last reported value forward within a state
+            frame = pd.DataFrame(self._values)
+            self._filled = frame.groupby(self._codes).ffill().to_numpy()
+        return self._filled
+
+
+    def _gather(self, rows, positions, skipna):
+        values = self._table(skipna)[np.maximum(rows, 0)][..., positions]
+        values[rows < 0] = np.nan
+        return values
+
+
+    def asof(self, date, columns=None, states=None, skipna=False, exact=False):
+        """ Value of columns for every state on date, or on the last earlier
+        date a state has a record for. With skipna, missing values are
+        replaced by the last reported value of the column; with exact, only
+        records on date itself are used. Returns state x column frame."""
+        codes = self._state_codes(states)
+        columns, positions = self._column_positions(columns)
+        rows = self._rows(codes, [date], exact)[:, 0]
+        return pd.DataFrame(self._gather(rows, positions, skipna),
+                            index=self.states[codes], columns=columns)
+
+
+    def change(self, start, end, columns=None, states=None, skipna=False):
+        """ Difference of the as-of values at end and at start for every
+        state. Returns state x column frame."""
+        codes = self._state_codes(states)
+        columns, positions = self._column_positions(columns)
+        rows = self._rows(codes, [start, end])
+        values = self._gather(rows, positions, skipna)
+        return pd.DataFrame(values[:, 1] - values[:, 0],
+                            index=self.states[codes], columns=columns)
+
+
+    def latest(self, columns=None, states=None, skipna=True):
+        """ Latest available value of columns for every state. Returns
+        state x column frame."""
+        return self.asof(self.last_date, columns, states, skipna)
+
+
+    def at(self, dates, column, states=None, skipna=False):
+        """ As-of values of one column for many dates in one search, e.g.
+        to compare many windows. Returns state x date frame."""
+        codes = self._state_codes(states)
+        _, positions = self._column_positions([column])
+        dates = pd.DatetimeIndex(dates)
+        rows = self._rows(codes, dates)
+        return pd.DataFrame(self._gather(rows, positions, skipna)[..., 0],
+                            index=self.states[codes], columns=dates)
@@ -76,7 +76,7 @@ G7_COUNTRIES = ['Japan', 'Canada', 'Germany', 'Italy',
 
 
 EUROPEAN_UNION = ['Austria', 'Belgium', 'Bulgaria', 'Croatia', 'Cyprus',
-                  'Czech Republic', 'Denmark', 'Estonia', 'Finland', 'France',
+                  'Czechia', 'Denmark', 'Estonia', 'Finland', 'France',
                   'Germany', 'Greece', 'Hungary', 'Ireland', 'Italy', 'Latvia',
                   'Lithuania', 'Luxembourg', 'Malta', 'Netherlands', 'Poland',
                   'Portugal', 'Romania', 'Slovakia', 'Slovenia', 'Spain',